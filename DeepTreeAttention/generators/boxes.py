@@ -1,77 +1,133 @@
 #### tf.data input pipeline ###
+import fcntl
 import geopandas as gpd
+import glob
 import numpy as np
 import os
 import pandas as pd
 import rasterio
 import random
 import tensorflow as tf
-import cv2
-import math
+import json
+
+from collections import OrderedDict
+from functools import partial
 
 from rasterio.windows import from_bounds
 from DeepTreeAttention.generators import neighbors
+from DeepTreeAttention.generators.crops import crop_image, crop_images, box_indices, read_crops
+from DeepTreeAttention.generators.preprocess import resize, resize_batch, image_normalize, preprocess_crops
+from DeepTreeAttention.utils import cache
+from DeepTreeAttention.utils.Hyperspectral import open_raster
 
 from shapely import wkt
 
-def image_normalize(image):
-    """normalize a 3d numoy array simiiar to tf.image.per_image_standardization"""
-    mean = image.mean()
-    stddev = image.std()
-    adjusted_stddev = max(stddev, 1.0/math.sqrt(image.size))
-    standardized_image = (image - mean) / adjusted_stddev
-    
-    return standardized_image
-
-def resize(img, height, width):
-    # resize image
-    dim = (width, height)
-    resized = cv2.resize(img, dim, interpolation=cv2.INTER_NEAREST)
+#Record schema versions. Version 1 stores crops as float lists, version 2 stores crops as raw bytes in a compact dtype.
+SCHEMA_VERSION = 2
+ENCODINGS = ["float32", "float16", "uint16"]
+#Records written before the schema manifest, crop sizes were fixed
+LEGACY_SCHEMA = {
+    "schema_version": 1,
+    "HSI_encoding": "float32",
+    "HSI_height": 20,
+    "HSI_width": 20,
+    "HSI_depth": 369,
+    "RGB_encoding": "float32",
+    "RGB_height": 100,
+    "RGB_width": 100,
+    "RGB_depth": 3,
+    "k_neighbors": 5,
+    "n_neighbor_features": None
+}
 
-    return resized
+#Per directory manifest describing the records written there, see write_schema
+SCHEMA_FILE = "schema.json"
 
-def crop_image(src, box, expand=0): 
-    """Read sensor data and crop a bounding box
+class CropCache():
+    """Least recently used cache of resized crops from one tile, so a crown that is both a target and a neighbor of other crowns is read once.
+    Crops are keyed by box bounds, expansion and resized size. Misses are read together with read_crops, each box once for all expands.
     Args:
-        src: a rasterio opened path
-        box: geopandas geometry polygon object
-        expand: add padding in percent to the edge of the crop
-    Returns:
-        masked_image: a crop of sensor data at specified bounds
+        max_bytes: size limit of the cached crops, 0 reads through without caching
+        expands: expansions cropped from the same read whichever is requested first, such as the extend_HSI_box of targets and 0 of neighbors
     """
-    #Read data and mask
-    try:    
-        left, bottom, right, top = box.bounds
+    
+    def __init__(self, max_bytes=1e9, expands=()):
+        self.max_bytes = max_bytes
+        self.expands = expands
+        self.crops = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.read_stats = {"crowns_served": 0, "reads": 0, "blocks_read": 0}
+    
+    def crop(self, src, boxes, expand=0, size=20):
+        """Resized crops of many bounding boxes, see crop_images
+        Args:
+            src: a rasterio opened path, the same tile for every call
+            boxes: geopandas dataframe with a polygon geometry column
+            expand: add padding in percent to the edge of the crop
+            size: size in pixels of one side of the resized crop
+        Returns:
+            crops: dictionary of boxes index -> (size, size, channels) float32 crop. Boxes that cannot be cropped are left out.
+        """
+        crops = {}
+        missing = []
+        for index, geometry in zip(boxes.index, boxes.geometry):
+            key = self._key(geometry, expand, size)
+            if key in self.crops:
+                self.crops.move_to_end(key)
+                crop, raw_bytes = self.crops[key]
+                crops[index] = crop
+                self.hits += 1
+                self.bytes_saved += raw_bytes
+            else:
+                missing.append((index, geometry))
         
-        expand_width = (right - left) * expand /2
-        expand_height = (top - bottom) * expand / 2
+        if len(missing) == 0:
+            return crops
         
-        #If expand is greater than increase both size
-        if expand >= 0:
-            expanded_left = left - expand_width
-            expanded_bottom = bottom - expand_height
-            expanded_right = right + expand_width
-            expanded_top =  top+expand_height
-        else:
-            #Make sure of no negative boxes
-            expanded_left = left+expand_width
-            expanded_bottom = bottom+expand
-            expanded_right = right-expand_width
-            expanded_top =  top-expand_height            
+        self.misses += len(missing)
         
-        window = rasterio.windows.from_bounds(expanded_left, expanded_bottom, expanded_right, expanded_top, transform=src.transform)
-        masked_image = src.read(window=window)
-    except Exception as e:
-        raise ValueError("sensor path: {} failed at reading window {} with error {}".format(src, box.bounds,e))
+        #Crop the other expansions of a box from the same read, unless nothing is kept
+        expands = [expand]
+        if self.max_bytes > 0:
+            expands += [x for x in self.expands if x != expand]
         
-    #Roll depth to channel last
-    masked_image = np.rollaxis(masked_image, 0, 3)
-    
-    #Skip empty frames
-    if masked_image.size ==0:
-        raise ValueError("Empty frame crop for box {} in sensor path {}".format(box, src))
+        box_windows = []
+        for index, geometry in missing:
+            windows = box_indices(src, geometry, expands=expands)
+            box_windows.append([((index, x, self._key(geometry, x, size)), rows, cols) for x, rows, cols in windows])
+        raw_crops, stats = read_crops(src, [x for x in box_windows if len(x) > 0])
+        for key in self.read_stats:
+            self.read_stats[key] += stats[key]
         
-    return masked_image
+        for (index, crop_expand, key), raw_crop in raw_crops.items():
+            crop = resize_batch([raw_crop], size, size)[0]
+            if crop_expand == expand:
+                crops[index] = crop
+            self._add(key, crop, raw_crop.nbytes)
+        
+        return crops
+    
+    def _key(self, geometry, expand, size):
+        return (tuple(np.round(geometry.bounds, 3)), expand, size)
+    
+    def _add(self, key, crop, raw_bytes):
+        #The same box twice in one request
+        if key in self.crops or crop.nbytes > self.max_bytes:
+            return
+        self.crops[key] = (crop, raw_bytes)
+        self.bytes += crop.nbytes
+        while self.bytes > self.max_bytes:
+            evicted, (evicted_crop, evicted_raw_bytes) = self.crops.popitem(last=False)
+            self.bytes -= evicted_crop.nbytes
+    
+    def stats(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests > 0 else 0
+        
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": hit_rate, "bytes_saved": self.bytes_saved}
     
 def generate_tfrecords(
                        HSI_sensor_path,
@@ -96,15 +152,19 @@ def generate_tfrecords(
                        csv_file=None,
                        label_column="label",
                        ensemble_model=None,
-                       k_neighbors=5):
-    """Yield one instance of data with one hot labels
+                       k_neighbors=5,
+                       encoding="float32",
+                       embedding_store=None,
+                       crop_cache_bytes=1e9):
+    """Yield one instance of data with one hot labels. Crops are streamed to disk one chunk at a time, so memory is bounded by chunk_size rather than the number of crowns in a tile.
     Args:
+        HSI_sensor_path: converted hyperspectral .tif, or a NEON reflectance .h5 to crop directly without conversion
         chunk_size: number of windows per tfrecord
         savedir: directory to save tfrecords
         domain: metadata site domain as integer
         site: metadata site label as integer
         elevation: height above sea level in meters
-        heights: height in m
+        heights: height in m, one per row of the shapefile or csv_file
         label_dict: taxonID -> numeric label
         RGB_size: size in pixels of one side of image
         HSI_size: size in pixels of one side of image
@@ -112,9 +172,12 @@ def generate_tfrecords(
         number_of_sites: total number of sites used for one-hot encoding
         extend_HSI_box: units in meters to expand DeepForest bounding box to give crop more context
         extend_RGB_box: units in meters to expand DeepForest bounding box to give crop more context
-        include_neighbors: logical, whether to extract HSI data from neighbor trees.
-        ensemble_model: an ensemble model that predicts neighbor features
+        shuffle: shuffle the order of boxes before cropping, so that every tfrecord is a random sample of the tile
+        ensemble_model: an ensemble model that predicts neighbor features, if None no neighbor features are written
         k_neighbors: number of neighbors to extract
+        encoding: how crops are stored, "float32" float lists or raw bytes as "float16" or scaled "uint16", see create_record
+        embedding_store: optional cache.EmbeddingStore of neighbor embeddings, keyed by individualID or by tile and crown bounds, see neighbors.crown_ids
+        crop_cache_bytes: size limit of resized HSI crops kept in memory when extracting neighbors, so crowns that are both targets and neighbors are read once, see CropCache
 
     Returns:
         filename: tfrecords path
@@ -123,7 +186,7 @@ def generate_tfrecords(
     if all([x is None for x in [csv_file, shapefile]]):
         raise AttributeError("Either pass a shapefile=, or csv_file argument")
     
-    HSI_src = rasterio.open(HSI_sensor_path)
+    HSI_src = open_raster(HSI_sensor_path)
     RGB_src = rasterio.open(RGB_sensor_path)
     
     #Read csv file
@@ -139,93 +202,106 @@ def generate_tfrecords(
         basename = os.path.splitext(os.path.basename(shapefile))[0]        
         gdf = gpd.read_file(shapefile)
     
+    #Heights are given in row order, align them before any rows are dropped
+    heights = pd.Series(np.asarray(heights), index=gdf.index)
+    
     #Remove any nan and species not in the label dict if provided
     gdf = gdf[~gdf[label_column].isnull()]
     if species_label_dict is not None:
         gdf = gdf[gdf[label_column].isin(list(species_label_dict.keys()))]
     
     gdf["box_index"] = gdf.index.values
-    labels = []
-    HSI_crops = []
-    RGB_crops = []
-    indices = []
-    neighbor_arrays = []
-    neighbor_distances = []
     
     #Give an individual column
     gdf["individual"] = gdf.index.values
     
-    for index, row in gdf.iterrows():
-        #Add training label, ignore unclassified 0 class
-        if train:
-            labels.append(row[label_column])
-        try:
-            HSI_crop = crop_image(HSI_src, row["geometry"], extend_HSI_box)
-            RGB_crop = crop_image(RGB_src, row["geometry"], extend_RGB_box)
-        except Exception as e:
-            print("row {} failed with {}".format(index, e))
-            continue
-        
-        HSI_crops.append(HSI_crop)
-        RGB_crops.append(RGB_crop)
-        indices.append(int(row["box_index"]))
-    
-        #extract neighbors
-        #Encode metadata
-        one_hot_sites = tf.one_hot(site, number_of_sites)  
-        one_hot_domains = tf.one_hot(domain, number_of_domains)
-        metadata = [elevation, one_hot_sites, one_hot_domains]
-        
-        neighbor_pool = gdf[~(gdf.individual == row["individual"])].reset_index(drop=True)
-        raster = rasterio.open(HSI_sensor_path)
-        neighbor_array, neighbor_distance = neighbors.predict_neighbors(row, metadata=metadata, HSI_size=HSI_size, raster=raster, neighbor_pool=neighbor_pool, model=ensemble_model, k_neighbors=k_neighbors)
-        neighbor_arrays.append(neighbor_array)
-        neighbor_distances.append(neighbor_distance)
-            
     #If passes a species label dict
     if species_label_dict is None:
         #Create and save a new species and site label dict
-        unique_species_labels = np.unique(labels)
+        unique_species_labels = np.unique(gdf[label_column])
         species_label_dict = {}
         for index, label in enumerate(unique_species_labels):
             species_label_dict[label] = index
         pd.DataFrame(species_label_dict.items(), columns=["taxonID","label"]).to_csv("{}/species_class_labels.csv".format(savedir))
     
-    numeric_species_labels = [species_label_dict[x] for x in labels]
-
-    #shuffle before writing to help with validation data split
+    #Encode metadata, identical for all boxes in a tile
+    one_hot_sites = tf.one_hot(site, number_of_sites)  
+    one_hot_domains = tf.one_hot(domain, number_of_domains)
+    metadata = [elevation, one_hot_sites, one_hot_domains]
+    
+    #shuffle the box order before cropping to help with validation data split, this is a full shuffle of the tile at the cost of an index.
     if shuffle:
         if train:
-            z = list(zip(HSI_crops, RGB_crops, heights, indices, numeric_species_labels, neighbor_arrays, neighbor_distances))
-            random.shuffle(z)
-            HSI_crops, RGB_crops, heights, indices, numeric_species_labels, neighbor_arrays, neighbor_distances = zip(*z)
-
-    #get keys and divide into chunks for a single tfrecord
+            gdf = gdf.sample(frac=1)
+    
+    #HSI crops are only cached when crowns are also cropped as neighbors
+    HSI_cache = CropCache(max_bytes=crop_cache_bytes if ensemble_model is not None else 0, expands=(extend_HSI_box, 0))
+    
+    #Find the neighbors of every crown in the tile with one query, each crown is embedded at most once
+    if ensemble_model is not None:
+        neighbor_ids = neighbors.crown_ids(gdf, tile=os.path.splitext(os.path.basename(RGB_sensor_path))[0])
+        neighbor_features = neighbors.NeighborFeatures(gdf, raster=HSI_src, metadata=metadata, model=ensemble_model, HSI_size=HSI_size, k_neighbors=k_neighbors, store=embedding_store, ids=neighbor_ids, crop_cache=HSI_cache)
+    
+    #Crop, resize and write one chunk at a time
     filenames = []
     counter = 0
-    for i in range(0, len(HSI_crops) + 1, chunk_size):
-        chunk_HSI_crops = HSI_crops[i:i + chunk_size]
-        chunk_RGB_crops = RGB_crops[i:i + chunk_size]        
-        chunk_index = indices[i:i + chunk_size]
-        chunk_height = heights[i:i + chunk_size]
-        chunk_neighbor_arrays = neighbor_arrays[i:i + chunk_size]
-        chunk_neighbor_distances = neighbor_distances[i:i + chunk_size]
+    for i in range(0, gdf.shape[0], chunk_size):
+        chunk = gdf.iloc[i:i + chunk_size]
+        
+        #Read all crops in the chunk with batched windowed reads
+        chunk_HSI_crops = HSI_cache.crop(HSI_src, chunk, expand=extend_HSI_box, size=HSI_size)
+        chunk_RGB_crops, RGB_stats = crop_images(RGB_src, chunk, extend_RGB_box)
+        
+        #Embed the neighbors of the whole chunk in large batches
+        if ensemble_model is not None:
+            neighbor_features.embed(neighbor_features.indices[i:i + chunk_size].ravel())
+        
+        HSI_crops = []
+        RGB_crops = []
+        chunk_index = []
+        chunk_height = []
+        chunk_labels = []
+        neighbor_arrays = []
+        neighbor_distances = []
+        
+        for position, (index, row) in enumerate(chunk.iterrows(), start=i):
+            if not (index in chunk_HSI_crops and index in chunk_RGB_crops):
+                print("row {} failed with an empty or unreadable crop for box {}".format(index, row["geometry"].bounds))
+                continue
+            
+            HSI_crops.append(chunk_HSI_crops[index])
+            RGB_crops.append(chunk_RGB_crops[index])
+            chunk_index.append(int(row["box_index"]))
+            chunk_height.append(heights[index])
+            
+            #Add training label, ignore unclassified 0 class
+            if train:
+                chunk_labels.append(species_label_dict[row[label_column]])
+            
+            #extract neighbors
+            if ensemble_model is not None:
+                neighbor_array, neighbor_distance = neighbor_features.features(position)
+                neighbor_arrays.append(neighbor_array)
+                neighbor_distances.append(neighbor_distance)
+        
+        if len(chunk_index) == 0:
+            continue
         
         #All records in a single shapefile are the same site
         chunk_sites = np.repeat(site, len(chunk_index))
         chunk_domains = np.repeat(domain, len(chunk_index))
         chunk_elevations = np.repeat(elevation, len(chunk_index))
         
-        if train:
-            chunk_labels = numeric_species_labels[i:i + chunk_size]
-        else:
+        if not train:
             chunk_labels = None
-
-        #resize crops
-        resized_HSI_crops = [resize(x, HSI_size, HSI_size).astype(np.float32) for x in chunk_HSI_crops]
-        resized_RGB_crops = [resize(x, RGB_size, RGB_size).astype(np.float32) for x in chunk_RGB_crops]
         
-        resized_HSI_crops = [image_normalize(x) for x in resized_HSI_crops]
+        if ensemble_model is None:
+            neighbor_arrays = None
+            neighbor_distances = None
+
+        #resize crops into a single array, standardize HSI
+        resized_HSI_crops = preprocess_crops(HSI_crops, HSI_size, HSI_size, normalize=True)
+        resized_RGB_crops = preprocess_crops(RGB_crops, RGB_size, RGB_size, normalize=False)
 
         filename = "{}/{}_{}.tfrecord".format(savedir, basename, counter)
         
@@ -238,15 +314,22 @@ def generate_tfrecords(
                        heights=chunk_height,
                        elevations= chunk_elevations,
                        indices=chunk_index,
-                       neighbor_arrays=chunk_neighbor_arrays,
-                       neighbor_distances=chunk_neighbor_distances,
+                       neighbor_arrays=neighbor_arrays,
+                       neighbor_distances=neighbor_distances,
                        number_of_sites=number_of_sites,
                        number_of_domains=number_of_domains,     
-                       classes=classes)
+                       classes=classes,
+                       encoding=encoding)
 
         filenames.append(filename)
         counter += 1
-
+    
+    HSI_read_stats = HSI_cache.read_stats
+    print("Read {} HSI blocks in {} reads for {} crowns".format(HSI_read_stats["blocks_read"], HSI_read_stats["reads"], HSI_read_stats["crowns_served"]))
+    if ensemble_model is not None:
+        print("Embedded {} neighbor crowns in {} model calls".format(len(neighbor_features.embeddings), neighbor_features.model_calls))
+        print("HSI crop cache: {}".format(HSI_cache.stats()))
+    
     return filenames
 
 def _float32_feature(value):
@@ -258,12 +341,58 @@ def _int64_feature(value):
 def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
-def write_tfrecord(filename, HSI_images, RGB_images, domains, sites, elevations, heights, indices, number_of_domains, number_of_sites, classes, neighbor_arrays, neighbor_distances, labels=None):
+def encode_image(image, encoding="float16"):
+    """Encode an image as raw bytes in a compact dtype
+    Args:
+        image: a numpy array
+        encoding: "float16", or "uint16" to quantize the range of each image into 16 bits
+    Returns:
+        data: raw bytes
+        scale: multiply decoded values by scale
+        offset: then add offset to recover the image
+    """
+    if encoding == "float16":
+        return image.astype(np.float16).tobytes(), 1.0, 0.0
+    elif encoding == "uint16":
+        offset = float(image.min())
+        value_range = float(image.max()) - offset
+        scale = value_range / np.iinfo(np.uint16).max if value_range > 0 else 1.0
+        quantized = np.round((image - offset) / scale).astype(np.uint16)
+        return quantized.tobytes(), scale, offset
+    else:
+        raise ValueError("Accepted raw encodings are 'float16' and 'uint16', not {}".format(encoding))
+
+def _image_feature(name, image, encoding="float32"):
+    """Features of a single image, stored as a float list for float32 encoding, otherwise as raw bytes"""
+    feature = {
+        '{}/height'.format(name): _int64_feature(image.shape[0]),
+        '{}/width'.format(name): _int64_feature(image.shape[1]),
+        '{}/depth'.format(name): _int64_feature(image.shape[2])
+    }
+    
+    if encoding == "float32":
+        feature['{}/data'.format(name)] = tf.train.Feature(float_list=tf.train.FloatList(value=image.reshape(-1)))
+    else:
+        data, scale, offset = encode_image(image, encoding)
+        feature['{}/raw'.format(name)] = _bytes_feature(data)
+        feature['{}/encoding'.format(name)] = _bytes_feature(encoding.encode())
+        feature['{}/scale'.format(name)] = _float32_feature(scale)
+        feature['{}/offset'.format(name)] = _float32_feature(offset)
+    
+    return feature
+
+def write_tfrecord(filename, HSI_images, RGB_images, domains, sites, elevations, heights, indices, number_of_domains, number_of_sites, classes, neighbor_arrays=None, neighbor_distances=None, labels=None, encoding="float32"):
     """Write a training or prediction tfrecord
         Args:
             train: True -> create a training record with labels. False -> a prediciton record with raster indices
+            neighbor_arrays: Optional list of neighbor feature arrays, if None no neighbor features are written
+            encoding: how crops are stored, see create_record
         """
     writer = tf.io.TFRecordWriter(filename)
+    
+    if neighbor_arrays is None:
+        neighbor_arrays = [None for x in HSI_images]
+        neighbor_distances = [None for x in HSI_images]
 
     if labels is not None:
         #Write parser
@@ -281,7 +410,8 @@ def write_tfrecord(filename, HSI_images, RGB_images, domains, sites, elevations,
                 number_of_domains=number_of_domains,   
                 neighbor_arrays=neighbor_arrays[index],
                 neighbor_distances=neighbor_distances[index],
-                classes=classes)
+                classes=classes,
+                encoding=encoding)
             writer.write(tf_example.SerializeToString())
     else:
         for index, image in enumerate(HSI_images):
@@ -297,13 +427,107 @@ def write_tfrecord(filename, HSI_images, RGB_images, domains, sites, elevations,
                 number_of_domains=number_of_domains,   
                 neighbor_arrays=neighbor_arrays[index],
                 neighbor_distances=neighbor_distances[index],                
-                classes=classes)
+                classes=classes,
+                encoding=encoding)
             writer.write(tf_example.SerializeToString())
 
     writer.close()
+    
+    #Describe the records in the directory manifest
+    if len(HSI_images) > 0:
+        schema = create_schema(HSI_images[0], RGB_images[0], neighbor_array=neighbor_arrays[0], encoding=encoding)
+        write_schema(os.path.dirname(filename) or ".", schema, tfrecord=filename)
+
+
+def create_schema(HSI_image, RGB_image, neighbor_array=None, encoding="float32"):
+    """Describe the records written by create_record for a given crop shape
+    Args:
+        HSI_image: a HSI crop in height, width, channels order
+        RGB_image: a RGB crop in height, width, channels order
+        neighbor_array: optional k_neighbors x n_neighbor_features array
+        encoding: crop encoding, see create_record
+    Returns:
+        schema: a dict with the same keys as LEGACY_SCHEMA
+    """
+    schema = {"schema_version": 1 if encoding == "float32" else SCHEMA_VERSION}
+    for sensor, image in [("HSI", HSI_image), ("RGB", RGB_image)]:
+        schema["{}_encoding".format(sensor)] = encoding
+        schema["{}_height".format(sensor)] = int(image.shape[0])
+        schema["{}_width".format(sensor)] = int(image.shape[1])
+        schema["{}_depth".format(sensor)] = int(image.shape[2])
+    
+    if neighbor_array is None:
+        schema["k_neighbors"] = None
+        schema["n_neighbor_features"] = None
+    else:
+        schema["k_neighbors"] = int(neighbor_array.shape[0])
+        schema["n_neighbor_features"] = int(neighbor_array.shape[1])
+    
+    return schema
 
+def read_schema(savedir):
+    """Read the schema manifest of a directory of tfrecords, None if there is no manifest or the directory holds mixed schemas"""
+    path = os.path.join(savedir, SCHEMA_FILE)
+    if not os.path.exists(path):
+        return None
+    
+    with open(path) as f:
+        schema = json.load(f)
+    
+    if schema.get("mixed"):
+        return None
+    
+    return schema
+
+def _matches_existing(savedir, tfrecord):
+    """Whether every other readable tfrecord in a directory has the same header as tfrecord, used before the first manifest of a directory that may hold older records"""
+    reference = _sniff_schema(tfrecord)
+    for path in glob.glob(os.path.join(savedir, "*.tfrecord")):
+        if os.path.samefile(path, tfrecord):
+            continue
+        try:
+            schema = _sniff_schema(path)
+        except tf.errors.OpError:
+            #Still being written by another job, it updates the manifest when it finishes
+            continue
+        if schema is not None and schema != reference:
+            return False
+    
+    return True
 
-def create_record(HSI_image, RGB_image, index, domain, site, elevation, height, classes, number_of_sites,number_of_domains, neighbor_arrays=None, neighbor_distances=None, label=None):
+def write_schema(savedir, schema, tfrecord=None):
+    """Write the schema manifest of a directory of tfrecords. Writers hold a lock on the manifest while updating it and replace it atomically, so parallel writers and readers never see a partial file.
+    If a directory receives records with a different schema than its manifest, it is marked as mixed and readers fall back to each file's own header.
+    Args:
+        savedir: directory of tfrecords
+        schema: dict, see create_schema
+        tfrecord: optional file just written with this schema. When the directory has no manifest yet, the other records there are checked against it, so records written before manifests existed mark the directory as mixed.
+    Returns:
+        path: path to the manifest
+    """
+    path = os.path.join(savedir, SCHEMA_FILE)
+    with open("{}.lock".format(path), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(path):
+                with open(path) as f:
+                    existing = json.load(f)
+                if existing == schema or existing.get("mixed"):
+                    return path
+                schema = {"mixed": True}
+            elif tfrecord is not None and not _matches_existing(savedir, tfrecord):
+                schema = {"mixed": True}
+            
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(schema, f, indent=2)
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    return path
+
+def create_record(HSI_image, RGB_image, index, domain, site, elevation, height, classes, number_of_sites,number_of_domains, neighbor_arrays=None, neighbor_distances=None, label=None, encoding="float32"):
     """
     Generate one record from an image 
     Args:
@@ -314,38 +538,29 @@ def create_record(HSI_image, RGB_image, index, domain, site, elevation, height,
         sites: number of geographic sites in train/test to one-hot labels
         elevation: height above sea level in meters
         label: Optional label for training class
+        encoding: "float32" stores crops as float lists (schema version 1). "float16" or "uint16" store crops as raw bytes (schema version 2), uint16 quantizes the range of each crop with a scale and offset.
     Returns:
         tf example parser
     """
+    if encoding not in ENCODINGS:
+        raise ValueError("Accepted encodings = {}, not {}".format(ENCODINGS, encoding))
     
-    #Standardize HSI normalization, perform now instead of at runtime.
-    HSI_rows = HSI_image.shape[0]
-    HSI_cols = HSI_image.shape[1]
-    HSI_depth = HSI_image.shape[2]
-    
-    RGB_rows = RGB_image.shape[0]
-    RGB_cols = RGB_image.shape[1]
-    RGB_depth = RGB_image.shape[2]
-
     feature={
+        'schema_version': _int64_feature(1 if encoding == "float32" else SCHEMA_VERSION),
         'box_index': _int64_feature(index),
-        'HSI_image/data': tf.train.Feature(float_list=tf.train.FloatList(value=HSI_image.reshape(-1))),
         'domain': _int64_feature(domain),                    
         'site': _int64_feature(site),    
         'elevation': _float32_feature(elevation),                                
-        'HSI_image/height': _int64_feature(HSI_rows),
-        'HSI_image/width': _int64_feature(HSI_cols),
-        'HSI_image/depth': _int64_feature(HSI_depth),
-        'RGB_image/data': tf.train.Feature(float_list=tf.train.FloatList(value=RGB_image.reshape(-1))),                            
-        'RGB_image/height': _int64_feature(RGB_rows),
-        'RGB_image/width': _int64_feature(RGB_cols),
-        'RGB_image/depth': _int64_feature(RGB_depth),                
         'classes': _int64_feature(classes),                
         'number_of_domains': _int64_feature(number_of_domains),                
         'number_of_sites': _int64_feature(number_of_sites),
         'height': _float32_feature(height)
     }
     
+    #Standardize HSI normalization, perform now instead of at runtime.
+    feature.update(_image_feature("HSI_image", HSI_image, encoding))
+    feature.update(_image_feature("RGB_image", RGB_image, encoding))
+    
     if label is not None:
         feature["label"] = _int64_feature(label)
     
@@ -361,7 +576,56 @@ def create_record(HSI_image, RGB_image, index, domain, site, elevation, height,
 
     return example
 
-def _neighbor_parse_(tfrecord):
+def _parse_features(tfrecord, features):
+    """Parse a single serialized record, or a vector of records at once with tf.io.parse_example"""
+    if tfrecord.shape.rank == 1:
+        return tf.io.parse_example(tfrecord, features)
+    else:
+        return tf.io.parse_single_example(tfrecord, features)
+
+def _depth(value):
+    """Scalar int32 from a per record feature, the first element of a batch since these are constant within a record file"""
+    return tf.cast(tf.reshape(value, [-1])[0], tf.int32)
+
+def _image_features(name, schema):
+    """Feature spec to parse an image written by _image_feature, sized from the schema"""
+    sensor = name.split("_")[0]
+    encoding = schema["{}_encoding".format(sensor)]
+    features = {}
+    
+    if encoding == "float32":
+        size = schema["{}_height".format(sensor)] * schema["{}_width".format(sensor)] * schema["{}_depth".format(sensor)]
+        features["{}/data".format(name)] = tf.io.FixedLenFeature([size], tf.float32)
+    else:
+        features["{}/raw".format(name)] = tf.io.FixedLenFeature([], tf.string)
+        features["{}/scale".format(name)] = tf.io.FixedLenFeature([], tf.float32)
+        features["{}/offset".format(name)] = tf.io.FixedLenFeature([], tf.float32)
+    
+    return features
+
+def _decode_image(example, name, schema):
+    """Decode and reshape an image from a parsed example"""
+    sensor = name.split("_")[0]
+    encoding = schema["{}_encoding".format(sensor)]
+    if encoding == "float32":
+        data = example["{}/data".format(name)]
+    else:
+        if encoding == "float16":
+            data = tf.io.decode_raw(example["{}/raw".format(name)], tf.float16)
+        else:
+            data = tf.io.decode_raw(example["{}/raw".format(name)], tf.uint16)
+        data = tf.cast(data, tf.float32) * example["{}/scale".format(name)][..., None] + example["{}/offset".format(name)][..., None]
+    
+    #All crops share the schema shape, a batch keeps its leading dimension
+    image_shape = [schema["{}_height".format(sensor)], schema["{}_width".format(sensor)], schema["{}_depth".format(sensor)]]
+    image_shape = tf.concat([tf.shape(data)[:-1], image_shape], axis=0)
+    
+    # Reshape to known shape
+    loaded_image = tf.reshape(data, image_shape, name="cast_loaded_{}".format(name))
+    
+    return loaded_image
+    
+def _neighbor_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
         "classes": tf.io.FixedLenFeature([], tf.int64),
         "label": tf.io.FixedLenFeature([], tf.int64),
@@ -374,45 +638,46 @@ def _neighbor_parse_(tfrecord):
         "k_neighbors": tf.io.FixedLenFeature([],tf.int64),
         "n_neighbor_features": tf.io.FixedLenFeature([],tf.int64),
         'neighbor_arrays' : tf.io.FixedLenFeature([], tf.string),   
-        'neighbor_distances': tf.io.FixedLenFeature([5],tf.float32)
+        'neighbor_distances': tf.io.FixedLenFeature([schema["k_neighbors"]],tf.float32)
     }
     
-    features['HSI_image/data'] = tf.io.FixedLenFeature([20*20*369], tf.float32)        
-    features["HSI_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/depth"] = tf.io.FixedLenFeature([], tf.int64)
+    features.update(_image_features("HSI_image", schema))
           
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
     
     # Load HSI image from file
-    HSI_image_shape = tf.stack([example['HSI_image/height'],example['HSI_image/width'], example['HSI_image/depth']])
-    
-    # Reshape to known shape
-    loaded_HSI_image = tf.reshape(example['HSI_image/data'], HSI_image_shape, name="cast_loaded_HSI_image")
+    loaded_HSI_image = _decode_image(example, "HSI_image", schema)
     
     ## Parse and reshape neighbor matrix
     flat_neighbor_arrays = tf.io.decode_raw(example["neighbor_arrays"], tf.float32)
-    neighbor_array_shape = tf.stack([example["k_neighbors"], example["n_neighbor_features"]])
+    neighbor_array_shape = tf.stack([_depth(example["k_neighbors"]), _depth(example["n_neighbor_features"])])
+    neighbor_array_shape = tf.concat([tf.shape(example["k_neighbors"]), neighbor_array_shape], axis=0)
     
     neighbor_arrays = tf.reshape(flat_neighbor_arrays, neighbor_array_shape)
     
     site = example['site']
-    sites = tf.cast(example['number_of_sites'], tf.int32)    
+    sites = _depth(example['number_of_sites'])    
     
     #one hot
     one_hot_sites = tf.one_hot(site, sites)
     
     #labels
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
     domain = example['domain']
-    domains = tf.cast(example['number_of_domains'], tf.int32)    
+    domains = _depth(example['number_of_domains'])    
     one_hot_domains = tf.one_hot(domain, domains)
     
+    if ids:
+        return example["box_index"], ((loaded_HSI_image, neighbor_arrays, example['elevation'], one_hot_sites, one_hot_domains), one_hot_labels)
+    
     return (loaded_HSI_image, neighbor_arrays, example['elevation'], one_hot_sites, one_hot_domains), one_hot_labels
 
-def _ensemble_parse_(tfrecord):
+def _ensemble_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
         "classes": tf.io.FixedLenFeature([], tf.int64),
         "label": tf.io.FixedLenFeature([], tf.int64),
@@ -421,165 +686,158 @@ def _ensemble_parse_(tfrecord):
         "height": tf.io.FixedLenFeature([], tf.float32),     
         "domain": tf.io.FixedLenFeature([], tf.int64),  
         "number_of_domains": tf.io.FixedLenFeature([], tf.int64),           
-        "elevation": tf.io.FixedLenFeature([], tf.float32),   
-        "k_neighbors": tf.io.FixedLenFeature([],tf.int64),
-        "n_neighbor_features": tf.io.FixedLenFeature([],tf.int64),
-        'neighbor_arrays' : tf.io.FixedLenFeature([], tf.string),   
-        'neighbor_distances': tf.io.FixedLenFeature([5],tf.float32)
+        "elevation": tf.io.FixedLenFeature([], tf.float32)
     }
     
-    features['HSI_image/data'] = tf.io.FixedLenFeature([20*20*369], tf.float32)        
-    features["HSI_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/depth"] = tf.io.FixedLenFeature([], tf.int64)
+    features.update(_image_features("HSI_image", schema))
           
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
     
     # Load HSI image from file
-    HSI_image_shape = tf.stack([example['HSI_image/height'],example['HSI_image/width'], example['HSI_image/depth']])
+    loaded_HSI_image = _decode_image(example, "HSI_image", schema)
     
-    # Reshape to known shape
-    loaded_HSI_image = tf.reshape(example['HSI_image/data'], HSI_image_shape, name="cast_loaded_HSI_image")
-    
-    ## Parse and reshape neighbor matrix    
     site = example['site']
-    sites = tf.cast(example['number_of_sites'], tf.int32)    
+    sites = _depth(example['number_of_sites'])    
     
     #one hot
     one_hot_sites = tf.one_hot(site, sites)
     
     #labels
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
     domain = example['domain']
-    domains = tf.cast(example['number_of_domains'], tf.int32)    
+    domains = _depth(example['number_of_domains'])    
     one_hot_domains = tf.one_hot(domain, domains)
     
+    if ids:
+        return example["box_index"], ((loaded_HSI_image, example['elevation'], one_hot_sites, one_hot_domains), one_hot_labels)
+    
     return (loaded_HSI_image, example['elevation'], one_hot_sites, one_hot_domains), one_hot_labels
 
-def _HSI_parse_(tfrecord):
+def _HSI_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
         "classes": tf.io.FixedLenFeature([], tf.int64),
         "label": tf.io.FixedLenFeature([], tf.int64),   
     }
     
-    features['HSI_image/data'] = tf.io.FixedLenFeature([20*20*369], tf.float32)        
-    features["HSI_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/depth"] = tf.io.FixedLenFeature([], tf.int64)
+    features.update(_image_features("HSI_image", schema))
     
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
 
     # Load HSI image from file
-    HSI_image_shape = tf.stack([example['HSI_image/height'],example['HSI_image/width'], example['HSI_image/depth']])
-    loaded_HSI_image = tf.reshape(example['HSI_image/data'], HSI_image_shape, name="cast_loaded_HSI_image")
+    loaded_HSI_image = _decode_image(example, "HSI_image", schema)
         
     #labels
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
+    if ids:
+        return example["box_index"], (loaded_HSI_image, one_hot_labels)
+    
     return loaded_HSI_image, one_hot_labels
 
-def _HSI_autoencoder_parse_(tfrecord):
+def _HSI_autoencoder_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
     }
     
-    features['HSI_image/data'] = tf.io.FixedLenFeature([20*20*369], tf.float32)        
-    features["HSI_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/depth"] = tf.io.FixedLenFeature([], tf.int64)
+    features.update(_image_features("HSI_image", schema))
     
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
 
     # Load HSI image from file
-    HSI_image_shape = tf.stack([example['HSI_image/height'],example['HSI_image/width'], example['HSI_image/depth']])
-    loaded_HSI_image = tf.reshape(example['HSI_image/data'], HSI_image_shape, name="cast_loaded_HSI_image")
+    loaded_HSI_image = _decode_image(example, "HSI_image", schema)
+    
+    if ids:
+        return example["box_index"], (loaded_HSI_image, loaded_HSI_image)
     
     return loaded_HSI_image, loaded_HSI_image
 
-def _HSI_submodel_parse_(tfrecord):
+def _HSI_submodel_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
         "classes": tf.io.FixedLenFeature([], tf.int64),
         "label": tf.io.FixedLenFeature([], tf.int64),   
     }
     
-    features['HSI_image/data'] = tf.io.FixedLenFeature([20*20*369], tf.float32)        
-    features["HSI_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["HSI_image/depth"] = tf.io.FixedLenFeature([], tf.int64)
+    features.update(_image_features("HSI_image", schema))
     
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
 
     # Load HSI image from file
-    HSI_image_shape = tf.stack([example['HSI_image/height'],example['HSI_image/width'], example['HSI_image/depth']])
-    loaded_HSI_image = tf.reshape(example['HSI_image/data'], HSI_image_shape, name="cast_loaded_HSI_image")
+    loaded_HSI_image = _decode_image(example, "HSI_image", schema)
         
     #labels
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
+    if ids:
+        return example["box_index"], (loaded_HSI_image, (one_hot_labels,one_hot_labels,one_hot_labels))
+    
     return loaded_HSI_image, (one_hot_labels,one_hot_labels,one_hot_labels)
 
-def _RGB_parse_(tfrecord):
+def _RGB_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
         "classes": tf.io.FixedLenFeature([], tf.int64),
         "label": tf.io.FixedLenFeature([], tf.int64),  
     }
     
-    features['RGB_image/data'] = tf.io.FixedLenFeature([100*100*3], tf.float32)        
-    features["RGB_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["RGB_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["RGB_image/depth"] = tf.io.FixedLenFeature([], tf.int64)             
+    features.update(_image_features("RGB_image", schema))
     
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
     
     # Load RGB image from file
-    RGB_image_shape = tf.stack([example['RGB_image/height'],example['RGB_image/width'], example['RGB_image/depth']])
-    
-    # Reshape to known shape
-    loaded_RGB_image = tf.reshape(example['RGB_image/data'], RGB_image_shape, name="cast_loaded_RGB_image")
+    loaded_RGB_image = _decode_image(example, "RGB_image", schema)
     
     #labels
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
+    if ids:
+        return example["box_index"], (loaded_RGB_image, one_hot_labels)
+    
     return loaded_RGB_image, one_hot_labels
 
-def _RGB_submodel_parse_(tfrecord):
+def _RGB_submodel_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     features = {
         "classes": tf.io.FixedLenFeature([], tf.int64),
         "label": tf.io.FixedLenFeature([], tf.int64),  
     }
     
-    features['RGB_image/data'] = tf.io.FixedLenFeature([100*100*3], tf.float32)        
-    features["RGB_image/height"] =  tf.io.FixedLenFeature([], tf.int64)
-    features["RGB_image/width"] = tf.io.FixedLenFeature([], tf.int64)
-    features["RGB_image/depth"] = tf.io.FixedLenFeature([], tf.int64)             
+    features.update(_image_features("RGB_image", schema))
     
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
     
     # Load RGB image from file
-    RGB_image_shape = tf.stack([example['RGB_image/height'],example['RGB_image/width'], example['RGB_image/depth']])
-    
-    # Reshape to known shape
-    loaded_RGB_image = tf.reshape(example['RGB_image/data'], RGB_image_shape, name="cast_loaded_RGB_image")
+    loaded_RGB_image = _decode_image(example, "RGB_image", schema)
     
     #labels
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
+    if ids:
+        return example["box_index"], (loaded_RGB_image, (one_hot_labels,one_hot_labels,one_hot_labels))
+    
     return loaded_RGB_image, (one_hot_labels,one_hot_labels,one_hot_labels)
 
-def _box_index_parse_(tfrecord):
-    features = {
-        'box_index': tf.io.FixedLenFeature([], tf.int64), 
-    }
-    example = tf.io.parse_single_example(tfrecord, features)
-    
-    return example["box_index"]
-    
-def _metadata_parse_(tfrecord):
+def _metadata_parse_(tfrecord, schema=LEGACY_SCHEMA, ids=False):
     """Tfrecord generator parse for a metadata model only"""
     # Define features
     features = {
@@ -593,21 +851,27 @@ def _metadata_parse_(tfrecord):
         "label": tf.io.FixedLenFeature([], tf.int64)   
     }
 
-    example = tf.io.parse_single_example(tfrecord, features)
+    if ids:
+        features["box_index"] = tf.io.FixedLenFeature([], tf.int64)
+        
+    example = _parse_features(tfrecord, features)
     
     #One hot site
     site = example['site']
-    sites = tf.cast(example['number_of_sites'], tf.int32)    
+    sites = _depth(example['number_of_sites'])    
     one_hot_sites = tf.one_hot(site, sites)
     
     domain = example['domain']
-    domains = tf.cast(example['number_of_domains'], tf.int32)    
+    domains = _depth(example['number_of_domains'])    
     one_hot_domains = tf.one_hot(domain, domains)
     
     #one hot elevation
-    classes = tf.cast(example['classes'], tf.int32)    
+    classes = _depth(example['classes'])    
     one_hot_labels = tf.one_hot(example['label'], classes)
     
+    if ids:
+        return example["box_index"], ((example['elevation'], one_hot_sites, one_hot_domains), one_hot_labels)
+    
     return (example['elevation'], one_hot_sites, one_hot_domains), one_hot_labels
 
 def augment(data, label):
@@ -650,6 +914,104 @@ def normalize(data):
     
     return data
 
+def record_schema(tfrecord):
+    """Read the schema of a tfrecord file from its directory manifest, or from its first record if there is no manifest
+    Args:
+        tfrecord: path to a tfrecord file
+    Returns:
+        schema: dict with the same keys as LEGACY_SCHEMA, None for an empty file
+    """
+    schema = read_schema(os.path.dirname(tfrecord) or ".")
+    if schema is not None:
+        return schema
+    
+    return _sniff_schema(tfrecord)
+
+def _sniff_schema(tfrecord):
+    """Build a schema from the first record of a tfrecord file"""
+    for record in tf.data.TFRecordDataset(tfrecord).take(1):
+        example = tf.train.Example.FromString(record.numpy())
+        features = example.features.feature
+        schema = dict(LEGACY_SCHEMA)
+        if "schema_version" in features:
+            schema["schema_version"] = features["schema_version"].int64_list.value[0]
+        for name in ["HSI_image", "RGB_image"]:
+            sensor = name.split("_")[0]
+            key = "{}/encoding".format(name)
+            if key in features:
+                schema["{}_encoding".format(sensor)] = features[key].bytes_list.value[0].decode()
+            for dimension in ["height", "width", "depth"]:
+                schema["{}_{}".format(sensor, dimension)] = features["{}/{}".format(name, dimension)].int64_list.value[0]
+        
+        if "k_neighbors" in features:
+            schema["k_neighbors"] = features["k_neighbors"].int64_list.value[0]
+            schema["n_neighbor_features"] = features["n_neighbor_features"].int64_list.value[0]
+        
+        return schema
+    
+    return None
+
+def _with_ids(augment_fn):
+    """Apply an augmentation to the data of an (ids, (data, label)) element"""
+    def augment_with_ids(box_index, sample):
+        return box_index, augment_fn(*sample)
+    
+    return augment_with_ids
+
+def _cache_file(cache_dir, tfrecords, **description):
+    """Cache filename of decoded tfrecords, see cache.dataset_key and cache.dataset_cache. tf_dataset takes a cache argument, so the module is used here."""
+    return cache.dataset_cache(cache_dir, cache.dataset_key(tfrecords, **description))
+
+def _parse_dataset(tfrecords, schema, shuffle, mode, ids, augmentation, cache, cores, batch_size=None, cache_file=None):
+    """Parse a set of tfrecords that share the same schema, see tf_dataset. If batch_size is given, serialized records are batched before parsing.
+    If cache_file is given, decoded records are cached to disk and shuffled after the cache, so each epoch sees a new order."""
+    dataset = tf.data.TFRecordDataset(tfrecords, num_parallel_reads=cores)     
+    
+    #batch and shuffle
+    if shuffle and cache_file is None:
+        dataset = dataset.shuffle(buffer_size=100)
+    
+    if batch_size:
+        dataset = dataset.batch(batch_size=batch_size)
+    
+    #parser, augmentation, whether to cache and parse in parallel for each mode
+    if mode == "ensemble":
+        parser, augment_fn, cacheable, parallel = _ensemble_parse_, ensemble_augment, True, True
+    elif mode == "HSI_autoencoder":
+        parser, augment_fn, cacheable, parallel = _HSI_autoencoder_parse_, None, True, False
+    elif mode == "HSI":
+        parser, augment_fn, cacheable, parallel = _HSI_parse_, augment, True, False
+    elif mode == "HSI_submodel":
+        parser, augment_fn, cacheable, parallel = _HSI_submodel_parse_, augment, True, False
+    elif mode == "RGB":
+        parser, augment_fn, cacheable, parallel = _RGB_parse_, augment, False, False
+    elif mode == "RGB_submodel":
+        parser, augment_fn, cacheable, parallel = _RGB_submodel_parse_, augment, False, False
+    elif mode == "metadata":
+        parser, augment_fn, cacheable, parallel = _metadata_parse_, None, False, False
+    elif mode == "neighbors":
+        parser, augment_fn, cacheable, parallel = _neighbor_parse_, neighbor_augment, True, True
+    else:
+        raise ValueError("Accepted types = 'ensemble', 'HSI', 'HSI_submodel', 'RGB', 'RGB_submodel', 'metadata', 'HSI_autoencoder', 'neighbors'")   
+    
+    #Box ids come from the same parse as the data, so they stay aligned under shuffle and interleaved reads
+    dataset = dataset.map(partial(parser, schema=schema, ids=ids), num_parallel_calls=cores if parallel else None)
+    if cache_file is not None:
+        dataset = dataset.cache(cache_file)
+        if shuffle and batch_size:
+            #Shuffle records rather than whole cached batches
+            dataset = dataset.unbatch().shuffle(buffer_size=100).batch(batch_size)
+        elif shuffle:
+            dataset = dataset.shuffle(buffer_size=100)
+    elif cache and cacheable:
+        dataset = dataset.cache()
+    if augmentation and augment_fn is not None:
+        if ids:
+            augment_fn = _with_ids(augment_fn)
+        dataset = dataset.map(augment_fn, num_parallel_calls=cores)
+    
+    return dataset
+    
 def tf_dataset(tfrecords,
                batch_size=2,
                shuffle=True,
@@ -657,7 +1019,9 @@ def tf_dataset(tfrecords,
                ids = False,
                augmentation = True,
                cache=False,
-               cores=32):
+               cores=32,
+               batch_parse=False,
+               cache_dir=None):
     """Create a tf.data dataset that yields sensor data and ground truth
     Args:
         tfrecords: path to tfrecords, see generate.py
@@ -667,66 +1031,59 @@ def tf_dataset(tfrecords,
         metadata: include metadata 
         labels: training record labels
         submodel: Logical. "spectral" or "spatial submodels" have three label inputs
+        shuffle: shuffle records, files with different schemas are interleaved. Without shuffle they are read one schema group after another.
+        batch_parse: batch serialized records and parse each batch with tf.io.parse_example, instead of parsing one record at a time
+        cache_dir: optional directory to cache decoded records on disk, reused by later calls with the same records, mode and schema, see utils/cache.py
     Returns:
         dataset: a tf.data dataset yielding crops and labels for train: True, crops and raster indices for train: False
         """
     AUTO = tf.data.experimental.AUTOTUNE
     #For the moment be explicit.
     
-    dataset = tf.data.TFRecordDataset(tfrecords, num_parallel_reads=cores)     
-    
-    #batch and shuffle
-    if shuffle:
-        dataset = dataset.shuffle(buffer_size=100)
-        
-    if mode == "ensemble":
-        dataset = dataset.map(_ensemble_parse_, num_parallel_calls=cores)
-        if cache:
-            dataset = dataset.cache()        
-        if augmentation:
-            dataset = dataset.map(ensemble_augment, num_parallel_calls=cores)        
-    elif mode == "HSI_autoencoder":
-        dataset = dataset.map(_HSI_autoencoder_parse_)
-        if cache:
-            dataset = dataset.cache()            
-    elif mode == "HSI":
-        dataset = dataset.map(_HSI_parse_)
-        if cache:
-            dataset = dataset.cache()        
-        if augmentation:
-            dataset = dataset.map(augment, num_parallel_calls=cores)                
-    elif mode == "HSI_submodel":
-        dataset = dataset.map(_HSI_submodel_parse_)
-        if cache:
-            dataset = dataset.cache()        
-        if augmentation:
-            dataset = dataset.map(augment, num_parallel_calls=cores)                
-    elif mode == "RGB":
-        dataset = dataset.map(_RGB_parse_)
-        if augmentation:
-            dataset = dataset.map(augment, num_parallel_calls=cores)                
-    elif mode == "RGB_submodel":
-        dataset = dataset.map(_RGB_submodel_parse_)        
-        if augmentation:
-            dataset = dataset.map(augment, num_parallel_calls=cores)                
-    elif mode == "metadata":
-        dataset = dataset.map(_metadata_parse_)
-    elif mode == "neighbors":
-        dataset = dataset.map(_neighbor_parse_, num_parallel_calls=cores)
-        if cache:
-            dataset = dataset.cache()        
-        if augmentation:
-            dataset = dataset.map(neighbor_augment, num_parallel_calls=cores)        
+    if isinstance(tfrecords, str):
+        tfrecords = [tfrecords]
+    
+    #Files written with different schemas need different parsers, parse each group and concatenate.
+    manifests = {}
+    groups = {}
+    for tfrecord in tfrecords:
+        savedir = os.path.dirname(tfrecord) or "."
+        if savedir not in manifests:
+            manifests[savedir] = read_schema(savedir)
+        schema = manifests[savedir]
+        if schema is None:
+            schema = _sniff_schema(tfrecord)
+        if schema is None:
+            continue
+        key = tuple(sorted(schema.items()))
+        groups.setdefault(key, []).append(tfrecord)
+    
+    if len(groups) == 0:
+        groups[tuple(sorted(LEGACY_SCHEMA.items()))] = tfrecords
+    
+    datasets = []
+    for key, group in groups.items():
+        parse_batch_size = batch_size if batch_parse else None
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = _cache_file(cache_dir, group, mode=mode, schema=dict(key), ids=ids, batch_size=parse_batch_size)
+        datasets.append(_parse_dataset(group, schema=dict(key), shuffle=shuffle, mode=mode, ids=ids, augmentation=augmentation, cache=cache, cores=cores, batch_size=parse_batch_size, cache_file=cache_file))
+    
+    if len(datasets) == 1:
+        dataset = datasets[0]
+    elif shuffle:
+        #Draw from each schema group in proportion to its files, so a mixed directory is not read one schema after another
+        files = sum([len(group) for group in groups.values()])
+        weights = [len(group) / files for group in groups.values()]
+        dataset = tf.data.Dataset.sample_from_datasets(datasets, weights=weights)
     else:
-        raise ValueError("Accepted types = 'ensemble', 'HSI', 'HSI_submodel', 'RGB', 'RGB_submodel', 'metadata', 'HSI_autoencoder', 'neighbors'")   
-                        
-    if ids:
-        ids_dataset = tf.data.TFRecordDataset(tfrecords, num_parallel_reads=cores)     
-        ids_dataset = ids_dataset.map(_box_index_parse_)
-        dataset = tf.data.Dataset.zip((ids_dataset, dataset))  
-        
-    dataset = dataset.batch(batch_size=batch_size)
+        dataset = datasets[0]
+        for group_dataset in datasets[1:]:
+            dataset = dataset.concatenate(group_dataset)
+    
+    if not batch_parse:
+        dataset = dataset.batch(batch_size=batch_size)
     
     dataset = dataset.prefetch(buffer_size=1)    
     
-    return dataset
\ No newline at end of file
+    return dataset
@@ -1,12 +1,17 @@
 import geopandas as gpd
-import glob
+import hashlib
 import numpy as np
+import os
 import pandas as pd
-import rasterstats
+import rasterio
 
+from concurrent.futures import ProcessPoolExecutor
+from affine import Affine
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from scipy import sparse
 from shapely.geometry import Point
-from DeepTreeAttention.utils.paths import find_sensor_path
-from distributed import as_completed
+from DeepTreeAttention.utils.paths import find_sensor_path, sensor_index
 
 def non_zero_99_quantile(x):
     """Get height quantile of all cells that are no zero"""
@@ -15,39 +20,263 @@ def non_zero_99_quantile(x):
     percentile = np.nanpercentile(mdata, 99)
     return (percentile)
 
-def postprocess_CHM(df, lookup_pool):
-    """Field measured height must be within min_diff meters of canopy model"""
-    #Extract zonal stats
-    try:
-        CHM_path = find_sensor_path(lookup_pool=lookup_pool, bounds=df.total_bounds)
-    except Exception as e:
-        raise ValueError("Cannot find CHM path for {} from plot {} in lookup_pool: {}".format(df.total_bounds, df.plotID.unique(),e))
-    draped_boxes = rasterstats.zonal_stats(df.geometry.__geo_interface__,
-                                           CHM_path,
-                                           add_stats={'q99': non_zero_99_quantile})
-    df["CHM_height"] = [x["q99"] for x in draped_boxes]
+#Columns of the vst field data used to build the train and test shapefiles, and their types
+FIELD_DTYPES = {
+    "individualID": str,
+    "eventID": str,
+    "domainID": "category",
+    "siteID": "category",
+    "plotID": "category",
+    "taxonID": "category",
+    "scientificName": "category",
+    "utmZone": "category",
+    "itcEasting": np.float64,
+    "itcNorthing": np.float64,
+    "elevation": np.float64,
+    "height": np.float64,
+    "stemDiameter": np.float64,
+    "growthForm": "category",
+    "plantStatus": "category",
+    "canopyPosition": "category"
+}
 
-    #if height is null, assign it
-    df.height.fillna(df["CHM_height"], inplace=True)
-        
-    return df
+#Version of the filters in clean_field_data, part of the load_field_data cache key. Increment it when the filters change.
+FIELD_DATA_VERSION = 1
+
+def clean_field_data(field):
+    """Select live, unshaded trees with a stem over 10cm and keep the latest measurement of each individual
+    Args:
+        field: DataFrame of NEON vst field data
+    Returns:
+        field: filtered DataFrame, one row per individualID
+    """
+    #List of hand cleaned errors
+    known_errors = ["NEON.PLA.D03.OSBS.03422","NEON.PLA.D03.OSBS.03422","NEON.PLA.D03.OSBS.03382", "NEON.PLA.D17.TEAK.01883"]
+    
+    keep = (field.individualID.notnull()
+            & field.elevation.notnull()
+            & field.growthForm.notnull()
+            & ~field.growthForm.isin(["liana","small shrub"])
+            & field.plantStatus.str.contains("Live", na=False)
+            & ~field.canopyPosition.isin(["Full shade", "Mostly shaded"])
+            & ((field.height > 3) | field.height.isnull())
+            & (field.stemDiameter > 10)
+            & ~field.taxonID.isin(["BETUL", "FRAXI", "HALES", "PICEA", "PINUS", "QUERC", "ULMUS", "2PLANT"])
+            & ~field.eventID.str.contains("2014", na=False)
+            #remove multibole
+            & ~field.individualID.str.contains('[A-Z]$', regex=True, na=False)
+            & ~field.individualID.isin(known_errors))
+    field = field[keep]
+    
+    #Latest event of each individual, sorted by individualID
+    field = field.sort_values(["individualID", "eventID"], ascending=[True, False], kind="mergesort")
+    field = field.drop_duplicates("individualID")
+    
+    #The plot of the latest event
+    field = field[field.plotID != "SOAP_054"].reset_index(drop=True)
+    
+    for column in field.select_dtypes("category").columns:
+        field[column] = field[column].cat.remove_unused_categories()
+    
+    return field
 
+def load_field_data(path, cache_dir=None, dtypes=FIELD_DTYPES):
+    """Read the needed columns of the vst field data and clean them, optionally caching the cleaned table as parquet
+    Args:
+        path: csv of NEON vst field data
+        cache_dir: optional directory for the parquet cache, keyed by the csv path, size, modification time and FIELD_DATA_VERSION. Requires pyarrow.
+        dtypes: dict of columns to read and their types, None reads every column
+    Returns:
+        field: DataFrame, see clean_field_data
+    """
+    cache_path = None
+    if cache_dir is not None:
+        try:
+            import pyarrow
+        except ImportError:
+            print("pyarrow is not installed, field data will not be cached")
+        else:
+            stat = os.stat(path)
+            key = "{}_{}_{}_{}_{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, sorted((dtypes or {}).items(), key=str), FIELD_DATA_VERSION)
+            cache_path = os.path.join(cache_dir, "{}_{}.parquet".format(
+                os.path.splitext(os.path.basename(path))[0], hashlib.sha1(key.encode()).hexdigest()[:16]))
+            if os.path.exists(cache_path):
+                return pd.read_parquet(cache_path)
+    
+    if dtypes is None:
+        field = pd.read_csv(path)
+    else:
+        field = pd.read_csv(path, usecols=list(dtypes.keys()), dtype=dtypes)
+    field = clean_field_data(field)
+    
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        field.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    
+    return field
+
+def geometry_cells(geometries, transform, shape):
+    """Raster cells under each geometry, selected as rasterstats.zonal_stats does: the cell containing a point, or the cells whose centers fall within a polygon
+    Args:
+        geometries: list of shapely geometries
+        transform: affine transform of the raster
+        shape: (rows, cols) of the raster
+    Returns:
+        groups: position in geometries of each cell
+        rows: row of each cell
+        cols: column of each cell
+    """
+    groups, rows, cols = [], [], []
+    is_point = np.array([x.geom_type == "Point" for x in geometries], dtype=bool)
+    
+    #Points are a single vectorized lookup
+    positions = np.flatnonzero(is_point)
+    if len(positions) > 0:
+        xs = np.array([geometries[x].x for x in positions])
+        ys = np.array([geometries[x].y for x in positions])
+        point_cols, point_rows = ~transform * (xs, ys)
+        groups.append(positions)
+        rows.append(np.floor(point_rows).astype(int))
+        cols.append(np.floor(point_cols).astype(int))
+    
+    #Polygons are rasterized within their own window
+    for position in np.flatnonzero(~is_point):
+        left, bottom, right, top = geometries[position].bounds
+        col_start, row_start = np.floor(~transform * (left, top)).astype(int)
+        col_stop, row_stop = np.ceil(~transform * (right, bottom)).astype(int)
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        row_stop, col_stop = min(row_stop, shape[0]), min(col_stop, shape[1])
+        if row_stop <= row_start or col_stop <= col_start:
+            continue
+        window_transform = transform * Affine.translation(col_start, row_start)
+        mask = geometry_mask([geometries[position]], out_shape=(row_stop - row_start, col_stop - col_start), transform=window_transform, invert=True)
+        polygon_rows, polygon_cols = np.nonzero(mask)
+        groups.append(np.repeat(position, len(polygon_rows)))
+        rows.append(polygon_rows + row_start)
+        cols.append(polygon_cols + col_start)
+    
+    if not groups:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int)
+    
+    groups, rows, cols = np.concatenate(groups), np.concatenate(rows), np.concatenate(cols)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    
+    return groups[inside], rows[inside], cols[inside]
+
+def grouped_percentile(groups, values, n_groups, q=99):
+    """Percentile of the non-nan values of each group, interpolated linearly like np.nanpercentile. Groups without values are nan.
+    Args:
+        groups: group of each value, from 0 to n_groups - 1
+        values: array of values
+        n_groups: number of groups
+        q: percentile from 0 to 100
+    Returns:
+        percentiles: array of length n_groups
+    """
+    valid = ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+    
+    #Sort by group, then value, so each group is a sorted run
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    
+    percentiles = np.full(n_groups, np.nan)
+    present = counts > 0
+    rank = q / 100 * (counts[present] - 1)
+    lower = np.floor(rank).astype(int)
+    upper = np.ceil(rank).astype(int)
+    lower_values = values[starts[present] + lower]
+    upper_values = values[starts[present] + upper]
+    percentiles[present] = lower_values + (rank - lower) * (upper_values - lower_values)
+    
+    return percentiles
+
+def CHM_heights(CHM_path, geometries):
+    """99th percentile canopy height of the cells over 0.5m under each geometry, the same values as rasterstats.zonal_stats with non_zero_99_quantile
+    Args:
+        CHM_path: path of a canopy height model tile
+        geometries: list of shapely geometries
+    Returns:
+        heights: array of heights, nan where a geometry has no canopy cells
+    """
+    heights = np.full(len(geometries), np.nan)
+    if len(geometries) == 0:
+        return heights
+    
+    #Read only the part of the tile covering the geometries
+    bounds = np.array([x.bounds for x in geometries])
+    with rasterio.open(CHM_path) as src:
+        col_start, row_start = np.floor(~src.transform * (bounds[:, 0].min(), bounds[:, 3].max())).astype(int)
+        col_stop, row_stop = np.floor(~src.transform * (bounds[:, 2].max(), bounds[:, 1].min())).astype(int) + 1
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        row_stop, col_stop = min(row_stop, src.height), min(col_stop, src.width)
+        if row_stop <= row_start or col_stop <= col_start:
+            return heights
+        window = Window.from_slices((row_start, row_stop), (col_start, col_stop))
+        CHM = src.read(1, window=window, masked=True).astype(float).filled(np.nan)
+        transform = src.window_transform(window)
+    
+    groups, rows, cols = geometry_cells(geometries, transform, CHM.shape)
+    values = CHM[rows, cols]
+    values[values < 0.5] = np.nan
+    
+    return grouped_percentile(groups, values, len(geometries))
+
+def _tile_heights(CHM_path, geometries):
+    """Run CHM_heights for one tile, failures are returned instead of raised so one tile cannot stop the run"""
+    try:
+        return CHM_heights(CHM_path, geometries)
+    except Exception as e:
+        return e
         
-def filter_CHM(shp, lookup_glob):
-        """For each plotID extract the heights from LiDAR derived CHM
+def filter_CHM(shp, lookup_glob, catalog_path=None, workers=1):
+        """For each plotID extract the heights from LiDAR derived CHM. Plots are grouped by CHM tile so each tile is read once.
         Args:
             shp: shapefile of data to filter
             lookup_glob: recursive glob search for CHM files
+            catalog_path: optional sensor catalog to search instead of globbing
+            workers: number of processes to read CHM tiles, 1 runs in this process
         """    
-        filtered_results = []
-        lookup_pool = glob.glob(lookup_glob, recursive=True)        
+        lookup_pool = sensor_index(lookup_glob, catalog_path)
+        plots = []
+        tiles = {}
         for name, group in shp.groupby("plotID"):
             try:
-                result = postprocess_CHM(group, lookup_pool=lookup_pool)
-                filtered_results.append(result)
+                CHM_path = find_sensor_path(lookup_pool=lookup_pool, bounds=group.total_bounds)
             except Exception as e:
-                print("plotID {} raised: {}".format(name,e))
-                
+                print("plotID {} raised: Cannot find CHM path for {} in lookup_pool: {}".format(name, group.total_bounds, e))
+                continue
+            tiles.setdefault(CHM_path, []).append(len(plots))
+            plots.append(group.copy())
+        
+        #All the geometries of a tile in one call
+        CHM_paths = list(tiles.keys())
+        geometries = [[x for index in tiles[path] for x in plots[index].geometry] for path in CHM_paths]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_tile_heights, CHM_paths, geometries))
+        else:
+            results = [_tile_heights(path, tile_geometries) for path, tile_geometries in zip(CHM_paths, geometries)]
+        
+        failed = []
+        for path, heights in zip(CHM_paths, results):
+            if isinstance(heights, Exception):
+                failed.extend(tiles[path])
+                print("plotIDs {} raised: {}".format([plots[index].plotID.iloc[0] for index in tiles[path]], heights))
+                continue
+            start = 0
+            for index in tiles[path]:
+                plot = plots[index]
+                plot["CHM_height"] = heights[start:start + plot.shape[0]]
+                #if height is null, assign it
+                plot["height"] = plot.height.fillna(plot["CHM_height"])
+                start += plot.shape[0]
+        
+        filtered_results = [plot for index, plot in enumerate(plots) if index not in failed]
         filtered_shp = gpd.GeoDataFrame(pd.concat(filtered_results,ignore_index=True))
         
         return filtered_shp
@@ -66,62 +295,176 @@ def sample_if(x,n):
     else:
         return x
 
-def sample_plots(shp):
-    #split by plot level
-    test_plots = shp.plotID.drop_duplicates().sample(frac=0.10)
+def missing_pairs(train, test, columns=["taxonID", "siteID"]):
+    """Find the test samples whose combination of columns has no sample in train, with one anti-join
+    Args:
+        train: DataFrame of train samples
+        test: DataFrame of test samples
+        columns: columns that together must be present in train
+    Returns:
+        missing: boolean array, True for test samples without a matching train sample
+    """
+    train_pairs = train[columns].drop_duplicates()
+    #A left merge on unique right keys keeps the rows and order of test
+    merged = test[columns].merge(train_pairs, on=columns, how="left", indicator=True)
+    missing = (merged["_merge"] == "left_only").values
+    
+    return missing
+
+def validate_split(train, test):
+    """Move test samples of a species without train samples from the same site into train, then keep only species in both
+    Args:
+        train: shapefile of train samples
+        test: shapefile of test samples
+    Returns:
+        train, test: shapefiles
+    """
+    #remove any test species that don't have site distributions in train
+    missing = missing_pairs(train, test)
+    train = pd.concat([train, test[missing]])
+    test = test[~missing]
     
+    train = train[train.taxonID.isin(test.taxonID.unique())]
+    test = test[test.taxonID.isin(train.taxonID.unique())]
+    
+    return train, test
+
+def split_plots(shp, test_plots):
+    """Split a shapefile into train and test by plot, keeping only species in both and moving test samples without a train sample of the same species and site to train
+    Args:
+        shp: shapefile of field data with plotID, taxonID and siteID
+        test_plots: list of plotIDs to hold out
+    Returns:
+        train, test: shapefiles
+    """
     test = shp[shp.plotID.isin(test_plots)]
     train = shp[~shp.plotID.isin(test_plots)]
     
     test = test.groupby("taxonID").filter(lambda x: x.shape[0] > 5)
     
-    train = train[train.taxonID.isin(test.taxonID)]
-    test = test[test.taxonID.isin(train.taxonID)]
+    train = train[train.taxonID.isin(test.taxonID.unique())]
+    test = test[test.taxonID.isin(train.taxonID.unique())]
+    
+    return validate_split(train, test)
 
-    #remove any test species that don't have site distributions in train
-    to_remove = []
-    for index,row in test.iterrows():
-        if train[(train.taxonID==row["taxonID"]) & (train.siteID==row["siteID"])].empty:
-            to_remove.append(index)
+def sample_plots(shp):
+    #split by plot level
+    test_plots = shp.plotID.drop_duplicates().sample(frac=0.10)
+    
+    return split_plots(shp, test_plots)
+
+class SplitSearch:
+    """Search random plot level splits for the one that keeps the most species, without building any DataFrames.
+    Samples are counted once into a sparse plot x (taxonID, siteID) matrix. The species kept by split_plots for a set of test plots are then
+    the species with more than min_test_samples test samples and at least one (taxonID, siteID) pair in both train and test, so many candidate
+    splits are scored together with sparse matrix products.
+    Args:
+        shp: shapefile of field data with plotID, taxonID and siteID
+        test_fraction: fraction of plots held out in each candidate, as in sample_plots
+        min_test_samples: species need more than this many samples in the test plots
+    """
+    def __init__(self, shp, test_fraction=0.10, min_test_samples=5):
+        self.plots, plot_index = np.unique(shp.plotID.values, return_inverse=True)
+        pair_index, pairs = pd.MultiIndex.from_arrays([shp.taxonID.values, shp.siteID.values]).factorize()
+        taxon_index, self.taxa = pd.factorize(pairs.get_level_values(0))
         
-    add_to_train = test[test.index.isin(to_remove)]
-    train = pd.concat([train, add_to_train])
-    test = test[~test.index.isin(to_remove)]    
+        #Samples of each (taxonID, siteID) pair in each plot, and the species of each pair
+        self.counts = sparse.csr_matrix((np.ones(shp.shape[0]), (plot_index, pair_index)), shape=(len(self.plots), len(pairs)))
+        self.pair_taxa = sparse.csr_matrix((np.ones(len(pairs)), (np.arange(len(pairs)), taxon_index)), shape=(len(pairs), len(self.taxa)))
+        self.totals = np.asarray(self.counts.sum(axis=0)).ravel()
+        
+        self.n_test = int(round(test_fraction * len(self.plots)))
+        self.min_test_samples = min_test_samples
     
-    train = train[train.taxonID.isin(test.taxonID)]
-    test = test[test.taxonID.isin(train.taxonID)]
+    def sample(self, n, random_state=None):
+        """Draw n random sets of test plots
+        Args:
+            n: number of candidates
+            random_state: optional seed, otherwise numpy's global random state is used
+        Returns:
+            candidates: sparse (n, plots) matrix, 1 for test plots
+        """
+        rng = np.random if random_state is None else np.random.RandomState(random_state)
+        test_plots = np.argsort(rng.random_sample((n, len(self.plots))), axis=1)[:, :self.n_test]
+        candidates = sparse.csr_matrix((np.ones(test_plots.size), (np.repeat(np.arange(n), self.n_test), test_plots.ravel())), shape=(n, len(self.plots)))
+        
+        return candidates
     
-    return train, test
-
-def train_test_split(ROOT=".", lookup_glob=None, n=None, debug=False, client = None, regenerate=False):
+    def score(self, candidates):
+        """Number of species split_plots keeps in train for each candidate
+        Args:
+            candidates: sparse (n, plots) matrix, 1 for test plots
+        Returns:
+            species: array of length n
+        """
+        test = (candidates @ self.counts).tocsr()
+        
+        #Pairs with samples in both test and train
+        shared = test.copy()
+        shared.data = (shared.data < self.totals[shared.indices]).astype(float)
+        shared.eliminate_zeros()
+        shared_taxa = (shared @ self.pair_taxa) > 0
+        
+        #Species with enough test samples over all sites
+        test_taxa = (test @ self.pair_taxa) > self.min_test_samples
+        species = shared_taxa.multiply(test_taxa).getnnz(axis=1)
+        
+        return species
+    
+    def best(self, n, random_state=None):
+        """Sample and score n candidates
+        Returns:
+            species: number of species of the best candidate
+            test_plots: its plotIDs
+        """
+        candidates = self.sample(n, random_state=random_state)
+        species = self.score(candidates)
+        best = np.argmax(species)
+        test_plots = self.plots[candidates[best].indices]
+        
+        return species[best], test_plots
+    
+    def search(self, iterations, batch_size=1000, client=None):
+        """Score iterations random candidates and keep the first one with the most species
+        Args:
+            iterations: number of candidates
+            batch_size: candidates scored together
+            client: optional dask client to score batches across workers
+        Returns:
+            species: number of species of the best candidate
+            test_plots: its plotIDs
+        """
+        batches = [min(batch_size, iterations - x) for x in range(0, iterations, batch_size)]
+        if client:
+            seeds = np.random.randint(0, 2**31 - 1, len(batches))
+            futures = [client.submit(self.best, n, random_state=seed) for n, seed in zip(batches, seeds)]
+            results = [x.result() for x in futures]
+        else:
+            results = [self.best(n) for n in batches]
+        
+        #Batches are kept in order so ties go to the earliest candidate
+        species, test_plots = max(results, key=lambda x: x[0])
+        
+        return species, test_plots
+    
+def train_test_split(ROOT=".", lookup_glob=None, n=None, debug=False, client = None, regenerate=False, catalog_path=None, workers=1, iterations=10000, cache_dir=None):
     """Create the train test split
     Args:
         ROOT: 
         lookup_glob: The recursive glob path for the canopy height models to create a pool of .tif to search
         min_diff: minimum height diff between field and CHM data
         n: number of resampled points per class
-        client: optional dask client
+        client: optional dask client to search splits across workers
+        catalog_path: optional sensor catalog to search for canopy height models instead of globbing
+        workers: number of processes to extract canopy heights
+        iterations: number of random plot splits to search when regenerating
+        cache_dir: optional directory to cache the cleaned field data, see load_field_data
         """
-    field = pd.read_csv("{}/data/raw/2020_vst_december.csv".format(ROOT))
-    field = field[~field.elevation.isnull()]
-    field = field[~field.growthForm.isin(["liana","small shrub"])]
-    field = field[~field.growthForm.isnull()]
-    field = field[~field.plantStatus.isnull()]        
-    field = field[field.plantStatus.str.contains("Live")]    
-    field = field[~(field.canopyPosition.isin(["Full shade", "Mostly shaded"]))]
-    field = field[(field.height > 3) | (field.height.isnull())]
-    field = field[field.stemDiameter > 10]
-    field = field[~field.taxonID.isin(["BETUL", "FRAXI", "HALES", "PICEA", "PINUS", "QUERC", "ULMUS", "2PLANT"])]
-    field = field[~(field.eventID.str.contains("2014"))]
-    field = field.groupby("individualID").apply(lambda x: x.sort_values(["eventID"],ascending=False).head(1)).reset_index(drop=True)
-    
-    #remove multibole
-    field = field[~(field.individualID.str.contains('[A-Z]$',regex=True))]
-
-    #List of hand cleaned errors
-    known_errors = ["NEON.PLA.D03.OSBS.03422","NEON.PLA.D03.OSBS.03422","NEON.PLA.D03.OSBS.03382", "NEON.PLA.D17.TEAK.01883"]
-    field = field[~(field.individualID.isin(known_errors))]
-    field = field[~(field.plotID == "SOAP_054")]
+    field = load_field_data("{}/data/raw/2020_vst_december.csv".format(ROOT), cache_dir=cache_dir)
+    
+    #Downstream groupbys and shapefiles expect plain strings
+    for column in field.select_dtypes("category").columns:
+        field[column] = field[column].astype(object)
     
     #Create shapefile
     field["geometry"] = [Point(x,y) for x,y in zip(field["itcEasting"], field["itcNorthing"])]
@@ -143,7 +486,7 @@ def train_test_split(ROOT=".", lookup_glob=None, n=None, debug=False, client = N
     
     #Interpolate CHM height
     if lookup_glob:
-        shp = filter_CHM(shp, lookup_glob)
+        shp = filter_CHM(shp, lookup_glob, catalog_path=catalog_path, workers=workers)
         
         #Remove NULL CHM_heights
         #shp = shp[~(shp.CHM_height.isnull())]
@@ -161,58 +504,16 @@ def train_test_split(ROOT=".", lookup_glob=None, n=None, debug=False, client = N
     
     #TODO make regenerate flag.
     if regenerate:     
-        most_species = 0
         if debug:
             iterations = 1
-        else:
-            iterations = 500
         
-        if client:
-            futures = [ ]
-            for x in np.arange(iterations):
-                future = client.submit(sample_plots, shp=shp)
-                futures.append(future)
-            
-            for x in as_completed(futures):
-                train, test = x.result()
-                if len(train.taxonID.unique()) > most_species:
-                    print(len(train.taxonID.unique()))
-                    saved_train = train
-                    saved_test = test
-                    most_species = len(train.taxonID.unique())            
-        else:
-            for x in np.arange(iterations):
-                train, test = sample_plots(shp)
-                if len(train.taxonID.unique()) > most_species:
-                    print(len(train.taxonID.unique()))
-                    saved_train = train
-                    saved_test = test
-                    most_species = len(train.taxonID.unique())
-        
-        train = saved_train
-        test = saved_test
+        search = SplitSearch(shp)
+        most_species, test_plots = search.search(iterations, client=client)
+        print("Best of {} splits keeps {} species".format(iterations, most_species))
+        train, test = split_plots(shp, test_plots)
     else:
         test_plots = gpd.read_file("{}/data/processed/test.shp".format(ROOT)).plotID.unique()
-        test = shp[shp.plotID.isin(test_plots)]
-        train = shp[~shp.plotID.isin(test_plots)]
-        
-        test = test.groupby("taxonID").filter(lambda x: x.shape[0] > 5)
-        
-        train = train[train.taxonID.isin(test.taxonID)]
-        test = test[test.taxonID.isin(train.taxonID)]
-    
-        #remove any test species that don't have site distributions in train
-        to_remove = []
-        for index,row in test.iterrows():
-            if train[(train.taxonID==row["taxonID"]) & (train.siteID==row["siteID"])].empty:
-                to_remove.append(index)
-            
-        add_to_train = test[test.index.isin(to_remove)]
-        train = pd.concat([train, add_to_train])
-        test = test[~test.index.isin(to_remove)]    
-        
-        train = train[train.taxonID.isin(test.taxonID)]
-        test = test[test.taxonID.isin(train.taxonID)]        
+        train, test = split_plots(shp, test_plots)
     
     print("There are {} records for {} species for {} sites in filtered train".format(
         train.shape[0],
@@ -0,0 +1,157 @@
+#Crop sensor data under bounding boxes. Boxes that share raster blocks are read together and sliced from memory.
+import math
+import numpy as np
+import rasterio
+
+from DeepTreeAttention.utils.windows import window_indices
+
+def expand_bounds(bounds, expand=0):
+    """Pad the bounds of a box
+    Args:
+        bounds: left, bottom, right, top of a box
+        expand: add padding in percent to the edge of the crop
+    Returns:
+        expanded bounds: left, bottom, right, top
+    """
+    left, bottom, right, top = bounds
+    
+    expand_width = (right - left) * expand /2
+    expand_height = (top - bottom) * expand / 2
+    
+    #If expand is greater than increase both size
+    if expand >= 0:
+        expanded_left = left - expand_width
+        expanded_bottom = bottom - expand_height
+        expanded_right = right + expand_width
+        expanded_top =  top+expand_height
+    else:
+        #Make sure of no negative boxes
+        expanded_left = left+expand_width
+        expanded_bottom = bottom+expand
+        expanded_right = right-expand_width
+        expanded_top =  top-expand_height     
+    
+    return expanded_left, expanded_bottom, expanded_right, expanded_top
+
+def crop_image(src, box, expand=0): 
+    """Read sensor data and crop a bounding box
+    Args:
+        src: a rasterio opened path
+        box: geopandas geometry polygon object
+        expand: add padding in percent to the edge of the crop
+    Returns:
+        masked_image: a crop of sensor data at specified bounds
+    """
+    #Read data and mask
+    try:    
+        expanded_left, expanded_bottom, expanded_right, expanded_top = expand_bounds(box.bounds, expand)
+        window = rasterio.windows.from_bounds(expanded_left, expanded_bottom, expanded_right, expanded_top, transform=src.transform)
+        masked_image = src.read(window=window)
+    except Exception as e:
+        raise ValueError("sensor path: {} failed at reading window {} with error {}".format(src, box.bounds,e))
+        
+    #Roll depth to channel last
+    masked_image = np.rollaxis(masked_image, 0, 3)
+    
+    #Skip empty frames
+    if masked_image.size ==0:
+        raise ValueError("Empty frame crop for box {} in sensor path {}".format(box, src))
+        
+    return masked_image
+
+def crop_images(src, boxes, expand=0, read_size=256):
+    """Read sensor data and crop many bounding boxes, reading each raster block once
+    Boxes are sorted by the raster block that holds their upper left pixel and grouped into tiles of at least read_size pixels.
+    Each tile is read in a single window that covers all its boxes, which are then sliced from memory.
+    Sources with group_reads set to False, such as Hyperspectral.H5Raster, read each box on its own since they have no per read overhead to amortize.
+    Args:
+        src: a rasterio opened path
+        boxes: geopandas dataframe with a polygon geometry column
+        expand: add padding in percent to the edge of the crop
+        read_size: minimum size in pixels of one side of a grouped read
+    Returns:
+        crops: dictionary of boxes index -> crop of sensor data, identical to crop_image. Boxes that cannot be cropped are left out.
+        stats: dictionary with the number of crowns_served, reads and blocks_read
+    """
+    box_windows = []
+    for index, geometry in zip(boxes.index, boxes.geometry):
+        windows = box_indices(src, geometry, expands=[expand])
+        if len(windows) > 0:
+            box_windows.append([(index, rows, cols) for expand, rows, cols in windows])
+    
+    return read_crops(src, box_windows, read_size=read_size)
+
+def box_indices(src, geometry, expands):
+    """Pixel rows and columns of a box at each expansion, see crop_image
+    Args:
+        src: a rasterio opened path
+        geometry: polygon of the box
+        expands: list of expansions in percent
+    Returns:
+        windows: list of (expand, rows, cols), expansions that cannot be cropped are left out
+    """
+    windows = []
+    for expand in expands:
+        try:
+            window = rasterio.windows.from_bounds(*expand_bounds(geometry.bounds, expand), transform=src.transform)
+        except Exception as e:
+            continue
+        rows, cols = window_indices(window, height=src.height, width=src.width)
+        
+        #Skip empty frames
+        if rows.size == 0 or cols.size == 0:
+            continue
+        windows.append((expand, rows, cols))
+    
+    return windows
+
+def read_crops(src, box_windows, read_size=256):
+    """Read the pixels of many boxes in grouped windows and slice their crops, see crop_images
+    Args:
+        src: a rasterio opened path
+        box_windows: list with the (key, rows, cols) of each box, the crops of one box are always in the same read
+        read_size: minimum size in pixels of one side of a grouped read
+    Returns:
+        crops: dictionary of key -> crop of sensor data
+        stats: dictionary with the number of crowns_served, reads and blocks_read
+    """
+    block_height, block_width = src.block_shapes[0]
+    tile_height = int(math.ceil(max(read_size, block_height) / block_height)) * block_height
+    tile_width = int(math.ceil(max(read_size, block_width) / block_width)) * block_width
+    
+    #Find the tile that holds the upper left pixel of each box
+    tiles = {}
+    for windows in box_windows:
+        if getattr(src, "group_reads", True):
+            key = (min([rows[0] for index, rows, cols in windows]) // tile_height, min([cols[0] for index, rows, cols in windows]) // tile_width)
+        else:
+            key = (len(tiles),)
+        tiles.setdefault(key, []).append(windows)
+    
+    crops = {}
+    stats = {"crowns_served": 0, "reads": 0, "blocks_read": 0}
+    for key in sorted(tiles):
+        members = [window for windows in tiles[key] for window in windows]
+        row_min = min([rows[0] for index, rows, cols in members])
+        row_max = max([rows[-1] for index, rows, cols in members])
+        col_min = min([cols[0] for index, rows, cols in members])
+        col_max = max([cols[-1] for index, rows, cols in members])
+        
+        window = rasterio.windows.Window(col_min, row_min, col_max - col_min + 1, row_max - row_min + 1)
+        data = src.read(window=window)
+        
+        stats["reads"] += 1
+        stats["blocks_read"] += int((row_max // block_height - row_min // block_height + 1) * (col_max // block_width - col_min // block_width + 1))
+        stats["crowns_served"] += len(tiles[key])
+        
+        for index, rows, cols in members:
+            if rows.size == data.shape[1] and cols.size == data.shape[2]:
+                #The box is the whole read
+                crop = data
+            else:
+                crop = data[:, rows - row_min][:, :, cols - col_min]
+            
+            #Roll depth to channel last
+            crops[index] = np.rollaxis(crop, 0, 3)
+    
+    return crops, stats
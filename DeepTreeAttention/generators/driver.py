@@ -0,0 +1,230 @@
+#Generation driver. Build the sensor lookup and label dicts once, then generate tfrecords for many tiles across a local process pool or a dask cluster.
+import json
+import multiprocessing
+import os
+import time
+import traceback
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from DeepTreeAttention.generators import boxes
+from DeepTreeAttention.utils.cache import ConversionCache, EmbeddingStore, model_hash
+from DeepTreeAttention.utils.paths import lookup_and_convert, find_sensor_path, site_from_path, domain_from_path, elevation_from_tile, sensor_index
+
+#Shared state of a worker process, set once by _init_worker
+_context = None
+
+#Ensemble models loaded in this process, by path
+_ensemble_models = {}
+
+def load_label_dict(path, column):
+    """Read a two column class csv into a label -> numeric dict"""
+    classdf = pd.read_csv(path)
+    label_dict = classdf.set_index(column).label.to_dict()
+
+    return label_dict
+
+def conversion_cache(config):
+    """Shared cache of converted hyperspectral tiles if hyperspectral_cache_dir is set in the config"""
+    if not config["hyperspectral_cache_dir"]:
+        return None
+
+    max_gb = config["hyperspectral_cache_max_gb"]
+    max_bytes = None if max_gb is None else max_gb * 1e9
+
+    return ConversionCache(config["hyperspectral_cache_dir"], max_bytes=max_bytes)
+
+def ensemble_model(config):
+    """The ensemble model in neighbors: model_dir that embeds neighbor crowns, loaded once per process. None if model_dir is not set, then no neighbor features are written."""
+    if not config["neighbors"]["model_dir"]:
+        return None
+
+    model_path = os.path.join(config["neighbors"]["model_dir"], "Ensemble.h5")
+    if model_path not in _ensemble_models:
+        from tensorflow import keras as tfk
+        from DeepTreeAttention.models.layers import WeightedSum
+        _ensemble_models[model_path] = tfk.models.load_model(model_path, custom_objects={"WeightedSum": WeightedSum})
+
+    return _ensemble_models[model_path]
+
+def embedding_store(config, model):
+    """Store of neighbor embeddings of this model if neighbors: embedding_store is set in the config"""
+    if model is None or not config["neighbors"]["embedding_store"]:
+        return None
+
+    model_key = model_hash(model, HSI_size=config["train"]["HSI"]["crop_size"])
+
+    return EmbeddingStore(config["neighbors"]["embedding_store"], model_key)
+
+def crop_cache_bytes(config):
+    """Size limit of the in memory cache of resized HSI crops shared by targets and neighbors"""
+    return config["neighbors"]["crop_cache_gb"] * 1e9
+
+def create_context(config, species_classes_file, site_classes_file, domain_classes_file):
+    """Everything a worker needs to generate a tile, built once and shipped to each worker
+    Args:
+        config: a parsed tree_config.yml
+        species_classes_file: csv with taxonID and label columns
+        site_classes_file: csv with siteID and label columns
+        domain_classes_file: csv with domainID and label columns
+    Returns:
+        context: dict of config, SensorIndex lookups, label dicts and an optional ConversionCache
+    """
+    context = {
+        "config": config,
+        "rgb_pool": sensor_index(config["rgb_sensor_pool"], config["sensor_catalog"]),
+        "hyperspectral_pool": sensor_index(config["hyperspectral_sensor_pool"], config["sensor_catalog"]),
+        "species_label_dict": load_label_dict(species_classes_file, "taxonID"),
+        "site_label_dict": load_label_dict(site_classes_file, "siteID"),
+        "domain_label_dict": load_label_dict(domain_classes_file, "domainID"),
+        "conversion_cache": conversion_cache(config)
+    }
+
+    return context
+
+def generate_tile(record, context, label_column="filtered_taxonID", chunk_size=500):
+    """Generate tfrecords for the crowns of one tile
+    Args:
+        record: csv file of crowns, named after the tile it was predicted from
+        context: see create_context
+        label_column: column of taxonID labels
+        chunk_size: number of crops per tfrecord
+    Returns:
+        result: dict of the record, created tfrecords and number of crowns
+    """
+    config = context["config"]
+    conversion_cache = context["conversion_cache"]
+    if conversion_cache is not None:
+        cache_before = conversion_cache.stats()
+
+    #Convert h5 hyperspec, or crop the h5 directly
+    renamed_record = record.replace("itc_predictions", "image")
+    savedir = config["hyperspectral_tif_dir"] if config["convert_h5"] else None
+    hyperspec_path = lookup_and_convert(shapefile=renamed_record, rgb_pool=context["rgb_pool"], hyperspectral_pool=context["hyperspectral_pool"], savedir=savedir, options=config["hyperspectral_tif_options"], conversion_cache=context["conversion_cache"])
+    rgb_path = find_sensor_path(shapefile=renamed_record, lookup_pool=context["rgb_pool"])
+
+    #infer site and domain
+    numeric_site = context["site_label_dict"][site_from_path(renamed_record)]
+    numeric_domain = context["domain_label_dict"][domain_from_path(renamed_record)]
+
+    #infer elevation
+    h5_path = find_sensor_path(shapefile=renamed_record, lookup_pool=context["hyperspectral_pool"])
+    elevation = elevation_from_tile(h5_path)
+
+    df = pd.read_csv(record)
+
+    #Neighbor features, if an ensemble model is configured
+    model = ensemble_model(config)
+
+    # hot fix the heights for the moment.
+    heights = np.repeat(10, df.shape[0])
+
+    tfrecords = boxes.generate_tfrecords(
+        csv_file=record,
+        HSI_sensor_path=hyperspec_path,
+        RGB_sensor_path=rgb_path,
+        domain=numeric_domain,
+        site=numeric_site,
+        elevation=elevation,
+        heights=heights,
+        species_label_dict=context["species_label_dict"],
+        HSI_size=config["train"]["HSI"]["crop_size"],
+        RGB_size=config["train"]["RGB"]["crop_size"],
+        savedir=config["train"]["tfrecords"],
+        train=True,
+        number_of_sites=len(context["site_label_dict"]),
+        number_of_domains=len(context["domain_label_dict"]),
+        classes=len(context["species_label_dict"]),
+        chunk_size=chunk_size,
+        extend_HSI_box=config["train"]["HSI"]["extend_box"],
+        extend_RGB_box=config["train"]["RGB"]["extend_box"],
+        label_column=label_column,
+        shuffle=True,
+        encoding=config["train"]["tfrecord_encoding"],
+        ensemble_model=model,
+        embedding_store=embedding_store(config, model),
+        crop_cache_bytes=crop_cache_bytes(config))
+
+    result = {"record": record, "tfrecords": tfrecords, "crowns": df.shape[0]}
+    if conversion_cache is not None:
+        result["conversion_cache"] = {key: value - cache_before[key] for key, value in conversion_cache.stats().items()}
+
+    return result
+
+def _init_worker(context):
+    global _context
+    _context = context
+
+def _generate_tile(record, label_column, chunk_size):
+    """Run generate_tile with the worker context, failures are returned instead of raised so one tile cannot stop the run"""
+    try:
+        return generate_tile(record, _context, label_column=label_column, chunk_size=chunk_size)
+    except Exception:
+        return {"record": record, "error": traceback.format_exc()}
+
+def _dask_generate_tile(record, context, label_column, chunk_size):
+    _init_worker(context)
+    return _generate_tile(record, label_column, chunk_size)
+
+def run(records, context, workers=1, client=None, label_column="filtered_taxonID", chunk_size=500, summary_path=None):
+    """Generate tfrecords for many tiles and report progress as tiles complete
+    Args:
+        records: list of crown csv files, one per tile
+        context: see create_context
+        workers: number of local processes, ignored if a dask client is given. 1 runs in this process.
+        client: optional dask client, for example from a distributed LocalCluster
+        label_column: column of taxonID labels
+        chunk_size: number of crops per tfrecord
+        summary_path: optional json file to write the run summary
+    Returns:
+        summary: dict with created tfrecords, failures and throughput
+    """
+    start_time = time.time()
+    summary = {"tiles": len(records), "completed": 0, "crowns": 0, "tfrecords": [], "failures": [], "conversion_cache": {}}
+
+    def report(result):
+        if "error" in result:
+            summary["failures"].append(result)
+            print("{} failed with {}".format(result["record"], result["error"]))
+        else:
+            summary["completed"] += 1
+            summary["crowns"] += result["crowns"]
+            summary["tfrecords"].extend(result["tfrecords"])
+            for key, value in result.get("conversion_cache", {}).items():
+                summary["conversion_cache"][key] = summary["conversion_cache"].get(key, 0) + value
+
+        elapsed = time.time() - start_time
+        finished = summary["completed"] + len(summary["failures"])
+        print("{}/{} tiles, {} failed, {:.1f} crowns/sec".format(finished, len(records), len(summary["failures"]), summary["crowns"] / elapsed))
+
+    if client is not None:
+        from distributed import as_completed as dask_as_completed
+        scattered_context = client.scatter(context, broadcast=True)
+        futures = [client.submit(_dask_generate_tile, record, scattered_context, label_column, chunk_size, pure=False) for record in records]
+        for future in dask_as_completed(futures):
+            report(future.result())
+    elif workers > 1:
+        #spawn so workers do not inherit tensorflow state from this process
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(context,)) as executor:
+            futures = [executor.submit(_generate_tile, record, label_column, chunk_size) for record in records]
+            for future in as_completed(futures):
+                report(future.result())
+    else:
+        _init_worker(context)
+        for record in records:
+            report(_generate_tile(record, label_column, chunk_size))
+
+    summary["elapsed"] = time.time() - start_time
+    summary["tiles_per_minute"] = summary["completed"] / summary["elapsed"] * 60
+    print("Generated {} tfrecords from {} crowns in {}/{} tiles in {:.0f} seconds, {} failed".format(
+        len(summary["tfrecords"]), summary["crowns"], summary["completed"], len(records), summary["elapsed"], len(summary["failures"])))
+    if summary["conversion_cache"]:
+        print("Hyperspectral conversion cache: {}".format(summary["conversion_cache"]))
+
+    if summary_path is not None:
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    return summary
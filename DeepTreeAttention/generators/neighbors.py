@@ -1,19 +1,16 @@
 #Context module. Use a pretrain model to extract the penultimate layer of the model for surrounding trees.
+import multiprocessing
 import tensorflow as tf
 import rasterio
-import cv2
 import numpy as np
 import pandas as pd
 
 from DeepTreeAttention.utils.paths import find_sensor_path, elevation_from_tile
-from sklearn.neighbors import BallTree
-
-def resize(img, height, width):
-    # resize image
-    dim = (width, height)
-    resized = cv2.resize(img, dim, interpolation=cv2.INTER_NEAREST)
-
-    return resized
+from DeepTreeAttention.utils.Hyperspectral import open_raster
+from DeepTreeAttention.generators.preprocess import resize_batch
+from DeepTreeAttention.generators.crops import crop_images
+from sklearn.neighbors import KDTree
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def crop_image(src, box, expand=0): 
     """Read sensor data and crop a bounding box
@@ -58,6 +55,61 @@ def crop_image(src, box, expand=0):
         
     return masked_image
 
+def centroid_coordinates(gdf):
+    """n x 2 array of crown centroid coordinates in the projected units of the dataframe"""
+    centroids = gdf.geometry.centroid
+    
+    return np.column_stack([centroids.x.values, centroids.y.values])
+
+def crown_ids(gdf, tile):
+    """Embedding store keys that identify the same crown across runs, unlike row positions in a regenerated file
+    Args:
+        gdf: geopandas dataframe of crowns
+        tile: name of the sensor tile of the crowns, for example the RGB tile basename with its year and geoindex
+    Returns:
+        ids: list of the individualID of each crown if the crowns have one, otherwise the tile and crown bounds rounded to centimeters
+    """
+    if "individualID" in gdf.columns:
+        return [str(x) for x in gdf["individualID"]]
+    
+    bounds = np.round(gdf.geometry.bounds.values, 2)
+    ids = ["{}_{:.2f}_{:.2f}_{:.2f}_{:.2f}".format(tile, *x) for x in bounds]
+    
+    return ids
+
+def query_neighbors(gdf, k_neighbors=5):
+    """Find the nearest crowns of every crown in a tile with a single tree query
+    Args:
+        gdf: geopandas dataframe of crowns in projected coordinates, for example UTM meters
+        k_neighbors: number of neighbors
+    Returns:
+        indices: n x k_neighbors positions in gdf of each crown's neighbors, nearest first. -1 where there are fewer than k_neighbors other crowns
+        distances: n x k_neighbors euclidean distances between centroids. 9999 where there are fewer than k_neighbors other crowns
+    """
+    n = gdf.shape[0]
+    indices = np.full((n, k_neighbors), -1, dtype=np.int64)
+    distances = np.full((n, k_neighbors), 9999, dtype=np.float64)
+    if n < 2:
+        return indices, distances
+    
+    #Query one extra neighbor, each crown is its own nearest point
+    coordinates = centroid_coordinates(gdf)
+    tree = KDTree(coordinates, leaf_size=15)
+    effective_neighbors = min(k_neighbors + 1, n)
+    query_distances, query_indices = tree.query(coordinates, k=effective_neighbors)
+    
+    #Remove self, a crown with an identical centroid can be returned first so match on position. If self is missing, drop the furthest.
+    is_self = query_indices == np.arange(n)[:, None]
+    missing_self = ~is_self.any(axis=1)
+    is_self[missing_self, -1] = True
+    query_indices = query_indices[~is_self].reshape(n, effective_neighbors - 1)
+    query_distances = query_distances[~is_self].reshape(n, effective_neighbors - 1)
+    
+    indices[:, :effective_neighbors - 1] = query_indices
+    distances[:, :effective_neighbors - 1] = query_distances
+    
+    return indices, distances
+
 def get_nearest(src_points, candidates, k_neighbors=1, distance_threshold=None):
     """Find nearest neighbors for all source points from a set of candidate points
     Args:
@@ -68,8 +120,7 @@ def get_nearest(src_points, candidates, k_neighbors=1, distance_threshold=None):
     """
 
     # Create tree from the candidate points
-    coordinates = np.vstack(candidates.geometry.centroid.apply(lambda geom: (geom.x,geom.y)))
-    tree = BallTree(coordinates, leaf_size=15, metric='haversine')
+    tree = KDTree(centroid_coordinates(candidates), leaf_size=15)
 
     # Find closest points and distances
     #src_points = src_points.reset_index()    
@@ -86,7 +137,8 @@ def get_nearest(src_points, candidates, k_neighbors=1, distance_threshold=None):
     
     distances, indices = tree.query(src_points, k=effective_neighbors)
     
-    neighbor_geoms = candidates[candidates.index.isin(indices[0])]
+    #Neighbors in order of distance
+    neighbor_geoms = candidates.iloc[indices[0]].copy()
     neighbor_geoms["distance"] = distances[0]
 
     if distance_threshold:
@@ -95,7 +147,33 @@ def get_nearest(src_points, candidates, k_neighbors=1, distance_threshold=None):
     # Return indices and distances
     return neighbor_geoms
 
-def predict_neighbors(target, HSI_size, neighbor_pool, metadata, raster, model, k_neighbors=5):
+def embed_crops(model, crops, metadata, HSI_size=20, batch_size=256):
+    """Predict features of many crops from one tile in batches
+    Args:
+        model: A model object to predict features
+        crops: list of crops in height, width, channels order
+        metadata: [elevation, one hot site, one hot domain], identical for all crops
+        HSI_size: size of HSI crop
+        batch_size: number of crops per model call
+    Returns:
+        features: n x m array of features
+        model_calls: number of model calls
+    """
+    features = []
+    model_calls = 0
+    for i in range(0, len(crops), batch_size):
+        images = resize_batch(crops[i:i + batch_size], HSI_size, HSI_size)
+        n = images.shape[0]
+        elevation = np.repeat(metadata[0], n)
+        site = np.repeat(np.expand_dims(metadata[1], axis=0), n, axis=0)
+        domain = np.repeat(np.expand_dims(metadata[2], axis=0), n, axis=0)
+        
+        features.append(np.asarray(model([images, elevation, site, domain])))
+        model_calls += 1
+    
+    return np.concatenate(features), model_calls
+
+def predict_neighbors(target, HSI_size, neighbor_pool, metadata, raster, model, k_neighbors=5, neighbor_indices=None, neighbor_distances=None, store=None, id_column="individual"):
     """Get features of surrounding n trees
     Args:
         target: geometry object of the target point
@@ -103,44 +181,153 @@ def predict_neighbors(target, HSI_size, neighbor_pool, metadata, raster, model,
     metadata: The metadata layer for each of the points, assumed to be identical for all neighbors
     n: Number of neighbors
     model: A model object to predict features
+    neighbor_indices: optional positions in neighbor_pool of the target's neighbors from query_neighbors, -1 for padding. If None, neighbors are searched in neighbor_pool
+    neighbor_distances: distances matching neighbor_indices
+    store: optional cache.EmbeddingStore, neighbors already in the store are not cropped or predicted
+    id_column: column of neighbor_pool with the individual ids used as store keys
     Returns:
     n * m feature matrix, where n is number of neighbors and m is length of the penultimate model layer
     """
         
     #Find neighbors
-    neighbor_geoms = get_nearest(target, candidates = neighbor_pool , k_neighbors=k_neighbors)
+    if neighbor_indices is None:
+        neighbor_geoms = get_nearest(target, candidates = neighbor_pool , k_neighbors=k_neighbors)
+    else:
+        found = np.asarray(neighbor_indices) >= 0
+        neighbor_geoms = neighbor_pool.iloc[np.asarray(neighbor_indices)[found]].copy()
+        neighbor_geoms["distance"] = np.asarray(neighbor_distances)[found]
+    
+    if store is not None:
+        ids = [str(x) for x in neighbor_geoms[id_column]]
+        stored = store.get(ids)
+    else:
+        ids = [None] * neighbor_geoms.shape[0]
+        stored = {}
+    
+    #extract crop for each neighbor that is not stored, and predict them together
+    crops = [crop_image(src=raster, box=geometry) for geometry, x in zip(neighbor_geoms.geometry, ids) if x not in stored]
+    if crops:
+        predicted, model_calls = embed_crops(model, crops, metadata, HSI_size=HSI_size, batch_size=k_neighbors)
+        predicted = list(predicted)
+        if store is not None:
+            store.put([x for x in ids if x not in stored], predicted)
     
-    #extract crop for each neighbor
     features = [ ]
     distances = [ ]
-    for index, row in neighbor_geoms.iterrows():
-        crop = crop_image(src=raster, box=row["geometry"])
-        
-        #reorder to channels last
-        crop = resize(crop, HSI_size, HSI_size)
-        crop = np.expand_dims(crop, 0)
-        
-        #create batch
-        elevation = np.expand_dims(metadata[0],axis=0)
-        site = np.expand_dims(metadata[1],axis=0)
-        domain = np.expand_dims(metadata[2],axis=0)
-        
-        batch  = [crop,elevation,site,domain]
-        feature = model(batch)
-        features.append(feature)
-        distances.append(row["distance"])
+    for x, distance in zip(ids, neighbor_geoms["distance"]):
+        if x in stored:
+            features.append(stored[x])
+        else:
+            features.append(predicted.pop(0))
+        distances.append(distance)
     
     #if there are fewer than k_neighbors, pad with 0's and large distances (?)
     if len(features) < k_neighbors:
         for x in np.arange(k_neighbors - len(features)):
-            features.append(np.zeros(feature.shape))
+            features.append(np.zeros(model.outputs[0].shape[-1]))
             distances.append(9999)
             
     features = np.vstack(features)
     
     return features, distances
 
-def extract_features(df, x, model_class, hyperspectral_pool, site_label_dict, domain_label_dict, HSI_size=20, k_neighbors=5):
+class NeighborFeatures():
+    """Neighbor features for every crown of a tile, embedding each crown once.
+    Neighbors come from one query_neighbors call. Crowns are cropped with grouped reads and passed through the model in large batches, and their embeddings are cached so a crown shared by many targets is only embedded once.
+    Args:
+        gdf: geopandas dataframe of the crowns in the tile
+        raster: an opened raster of the HSI tile, see Hyperspectral.open_raster
+        metadata: [elevation, one hot site, one hot domain], identical for all crowns in a tile
+        model: A model object to predict features
+        HSI_size: size of HSI crop
+        k_neighbors: number of neighbors
+        batch_size: number of crowns per model call
+        store: optional cache.EmbeddingStore, crowns already in the store are not cropped or predicted
+        ids: individual ids of the gdf rows used as store keys, unique across tiles
+        crop_cache: optional boxes.CropCache of the tile shared with target cropping
+    """
+    
+    def __init__(self, gdf, raster, metadata, model, HSI_size=20, k_neighbors=5, batch_size=256, store=None, ids=None, crop_cache=None):
+        self.gdf = gdf
+        self.raster = raster
+        self.metadata = metadata
+        self.model = model
+        self.HSI_size = HSI_size
+        self.k_neighbors = k_neighbors
+        self.batch_size = batch_size
+        self.store = store
+        self.crop_cache = crop_cache
+        self.ids = None if ids is None else [str(x) for x in ids]
+        self.indices, self.distances = query_neighbors(gdf, k_neighbors=k_neighbors)
+        self.n_features = model.outputs[0].shape[-1]
+        
+        #position in gdf -> embedding, None if the crown could not be cropped
+        self.embeddings = {}
+        self.model_calls = 0
+    
+    def embed(self, positions):
+        """Embed the crowns at positions in gdf that are not cached yet"""
+        missing = sorted(set([x for x in positions if x >= 0 and x not in self.embeddings]))
+        if len(missing) == 0:
+            return
+        
+        if self.store is not None:
+            stored = self.store.get([self.ids[x] for x in missing])
+            for position in missing:
+                if self.ids[position] in stored:
+                    self.embeddings[position] = stored[self.ids[position]]
+            missing = [x for x in missing if x not in self.embeddings]
+            if len(missing) == 0:
+                return
+        
+        crowns = self.gdf.iloc[missing]
+        if self.crop_cache is None:
+            crops, stats = crop_images(self.raster, crowns)
+        else:
+            crops = self.crop_cache.crop(self.raster, crowns, size=self.HSI_size)
+        
+        cropped = []
+        for position, index in zip(missing, crowns.index):
+            if index in crops:
+                cropped.append(position)
+            else:
+                self.embeddings[position] = None
+        
+        if len(cropped) == 0:
+            return
+        
+        features, model_calls = embed_crops(self.model, [crops[self.gdf.index[x]] for x in cropped], self.metadata, HSI_size=self.HSI_size, batch_size=self.batch_size)
+        self.model_calls += model_calls
+        for position, feature in zip(cropped, features):
+            self.embeddings[position] = feature
+        
+        if self.store is not None:
+            self.store.put([self.ids[x] for x in cropped], features)
+    
+    def features(self, position):
+        """Neighbor features of the crown at a position in gdf, see predict_neighbors
+        Returns:
+            features: k_neighbors x m feature matrix, padded with zeros
+            distances: k_neighbors distances, padded with 9999
+        """
+        self.embed(self.indices[position])
+        
+        features = []
+        distances = []
+        for neighbor, distance in zip(self.indices[position], self.distances[position]):
+            if neighbor < 0 or self.embeddings[neighbor] is None:
+                continue
+            features.append(self.embeddings[neighbor])
+            distances.append(distance)
+        
+        #if there are fewer than k_neighbors, pad with 0's and large distances
+        for x in np.arange(self.k_neighbors - len(features)):
+            features.append(np.zeros(self.n_features))
+            distances.append(9999)
+        
+        return np.vstack(features), distances
+
+def extract_features(df, x, model_class, hyperspectral_pool, site_label_dict, domain_label_dict, HSI_size=20, k_neighbors=5, store=None):
     """Generate features
     Args:
     df: a geopandas dataframe
@@ -151,6 +338,7 @@ def extract_features(df, x, model_class, hyperspectral_pool, site_label_dict, do
     site_label_dict: dictionary of numeric site labels
     domain_label_dict: dictionary of numeric domain labels
     k_neighbors: number of neighbors to extract
+    store: optional cache.EmbeddingStore of neighbor embeddings keyed by individual
     Returns:
     feature_array: a feature matrix of encoded bottleneck layer
     """
@@ -174,14 +362,49 @@ def extract_features(df, x, model_class, hyperspectral_pool, site_label_dict, do
     metadata = [elevation, one_hot_sites, one_hot_domains]
     
     neighbor_pool = df[~(df.individual == x)].reset_index(drop=True)
-    raster = rasterio.open(sensor_path)
-    feature_array, distances = predict_neighbors(target, metadata=metadata, HSI_size=HSI_size, raster=raster, neighbor_pool=neighbor_pool, model=model_class.ensemble_model, k_neighbors=k_neighbors)
+    raster = open_raster(sensor_path)
+    feature_array, distances = predict_neighbors(target, metadata=metadata, HSI_size=HSI_size, raster=raster, neighbor_pool=neighbor_pool, model=model_class.ensemble_model, k_neighbors=k_neighbors, store=store)
     
     return feature_array, distances
 
     
-def predict_dataframe(df, model_class, hyperspectral_pool, site_label_dict, domain_label_dict, HSI_size=20, k_neighbors=5):
-    """Iterate through a geopandas dataframe and get neighbors for each tree.
+#Feature model of a worker process, loaded once by _init_worker
+_model = None
+
+def _init_worker(model_path):
+    global _model
+    from tensorflow import keras as tfk
+    from DeepTreeAttention.models.layers import WeightedSum
+    _model = tfk.models.load_model(model_path, custom_objects={"WeightedSum": WeightedSum})
+
+def predict_tile(crowns, sensor_path, metadata, model, HSI_size=20, k_neighbors=5, store=None):
+    """Neighbor features of the crowns of one sensor tile, opening the tile once
+    Args:
+        crowns: geopandas dataframe with one row per individual in the tile
+        sensor_path: hyperspectral tile of the crowns
+        metadata: [elevation, one hot site, one hot domain], identical for all crowns in a tile
+        model: A model object to predict features
+        HSI_size: size of HSI crop
+        k_neighbors: number of neighbors to extract
+        store: optional cache.EmbeddingStore of neighbor embeddings keyed by individual
+    Returns:
+        results: dict of individual -> (feature_array, distances)
+    """
+    crowns = crowns.reset_index(drop=True)
+    with open_raster(sensor_path) as raster:
+        extractor = NeighborFeatures(crowns, raster=raster, metadata=metadata, model=model, HSI_size=HSI_size, k_neighbors=k_neighbors, store=store, ids=crowns.individual.values)
+        extractor.embed(extractor.indices.ravel())
+        results = {individual: extractor.features(position) for position, individual in enumerate(crowns.individual)}
+    
+    return results
+
+def _predict_tile(crowns, sensor_path, metadata, HSI_size, k_neighbors, store):
+    return predict_tile(crowns, sensor_path, metadata, model=_model, HSI_size=HSI_size, k_neighbors=k_neighbors, store=store)
+
+def predict_dataframe(df, model_class, hyperspectral_pool, site_label_dict, domain_label_dict, HSI_size=20, k_neighbors=5, store=None, workers=1, model_path=None):
+    """Get neighbors for each tree in a geopandas dataframe, grouping trees by sensor tile.
+    Each tile is opened once, its neighbors are found with one query and its crowns are embedded in batches, see NeighborFeatures.
+    Neighbors are the other individuals in the same tile, rows repeated by resampling are counted once.
     Args:
     df: a geopandas dataframe
     model_class: A deeptreeattention model class to extract layer features
@@ -190,21 +413,39 @@ def predict_dataframe(df, model_class, hyperspectral_pool, site_label_dict, doma
     site_label_dict: dictionary of numeric site labels
     domain_label_dict: dictionary of numeric domain labels
     k_neighbors: number of neighbors to extract
+    store: optional cache.EmbeddingStore of neighbor embeddings keyed by individual
+    workers: number of local processes to spread tiles over, 1 runs in this process
+    model_path: saved feature model loaded by each worker, required if workers > 1
     Returns:
-    feature_array: a feature matrix of encoded bottleneck layer
+    neighbor_features: dict of df index -> (feature_array, distances)
     """
+    if workers > 1 and model_path is None:
+        raise ValueError("model_path of the saved feature model is required to predict with {} workers".format(workers))
+    
+    #Due to resampling, there will be multiple rows of the same point, all are identical.
+    individuals = df.drop_duplicates(subset="individual")
+    sensor_paths = [find_sensor_path(bounds=geometry.bounds, lookup_pool=hyperspectral_pool) for geometry in individuals.geometry]
+    
+    #Encode metadata per tile, all crowns in a tile share a site and domain
+    tasks = []
+    for sensor_path, crowns in individuals.groupby(np.array(sensor_paths)):
+        one_hot_sites = np.asarray(tf.one_hot(site_label_dict[crowns.siteID.values[0]], model_class.sites))
+        one_hot_domains = np.asarray(tf.one_hot(domain_label_dict[crowns.domainID.values[0]], model_class.domains))
+        #ToDO bring h5 into here.
+        elevation = 100/1000
+        tasks.append((crowns, sensor_path, [elevation, one_hot_sites, one_hot_domains]))
+    
+    results = {}
+    if workers > 1:
+        #spawn so workers do not inherit tensorflow state from this process
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(model_path,)) as executor:
+            futures = [executor.submit(_predict_tile, crowns, sensor_path, metadata, HSI_size, k_neighbors, store) for crowns, sensor_path, metadata in tasks]
+            for future in as_completed(futures):
+                results.update(future.result())
+    else:
+        for crowns, sensor_path, metadata in tasks:
+            results.update(predict_tile(crowns, sensor_path, metadata, model=model_class.ensemble_model, HSI_size=HSI_size, k_neighbors=k_neighbors, store=store))
+    
+    neighbor_features = {index: results[individual] for index, individual in zip(df.index, df.individual)}
     
-    #for each target in a dataframe, lookup the correct tile
-    neighbor_features = {}
-    for index, row in df.iterrows():  
-        row = pd.DataFrame(row).transpose()
-        neighbor_features[index] = extract_features(
-            df=df,
-            x=row["individual"].values[0],
-            model_class=model_class,
-            hyperspectral_pool=hyperspectral_pool,
-            site_label_dict=site_label_dict,
-            domain_label_dict=domain_label_dict
-        )
-        
-    return neighbor_features
\ No newline at end of file
+    return neighbor_features
@@ -0,0 +1,92 @@
+#Shared image preprocessing for sensor crops. Resize and standardize whole chunks of crops at once.
+import math
+import numpy as np
+
+def nearest_indices(size, new_size):
+    """Source pixel for each output pixel of a nearest neighbor resize, identical to cv2.INTER_NEAREST"""
+    scale = 1.0 / (new_size / size)
+    indices = np.floor(np.arange(new_size) * scale).astype(np.int64)
+
+    return np.minimum(indices, size - 1)
+
+def resize(img, height, width):
+    """Nearest neighbor resize of a single image in height, width, channels order"""
+    rows = nearest_indices(img.shape[0], height)
+    cols = nearest_indices(img.shape[1], width)
+    resized = img[rows[:, None], cols]
+
+    return resized
+
+def image_normalize(image):
+    """normalize a 3d numoy array simiiar to tf.image.per_image_standardization"""
+    mean = image.mean()
+    stddev = image.std()
+    adjusted_stddev = max(stddev, 1.0/math.sqrt(image.size))
+    standardized_image = (image - mean) / adjusted_stddev
+
+    return standardized_image
+
+def resize_batch(crops, height, width, out=None):
+    """Resize a list of variable size crops into a single float32 array
+    Args:
+        crops: list of numpy arrays in height, width, channels order, all with the same number of channels
+        height: height in pixels of the resized crops
+        width: width in pixels of the resized crops
+        out: optional preallocated (N, height, width, channels) float32 array to fill
+    Returns:
+        out: a (N, height, width, channels) float32 array
+    """
+    if out is None:
+        channels = crops[0].shape[2]
+        out = np.empty((len(crops), height, width, channels), dtype=np.float32)
+
+    for index, crop in enumerate(crops):
+        rows = nearest_indices(crop.shape[0], height)
+        cols = nearest_indices(crop.shape[1], width)
+        out[index] = crop[rows[:, None], cols]
+
+    return out
+
+def normalize_batch(images):
+    """Standardize each image of a (N, height, width, channels) float32 array in place, similar to tf.image.per_image_standardization
+    Args:
+        images: a contiguous (N, height, width, channels) float32 array
+    Returns:
+        images: the same array, standardized per image
+    """
+    if not images.flags.c_contiguous:
+        raise ValueError("normalize_batch standardizes in place and needs a contiguous array")
+    
+    n = images.shape[0]
+    if n == 0:
+        return images
+
+    flat = images.reshape(n, -1)
+    size = flat.shape[1]
+
+    mean = flat.mean(axis=1)
+    flat -= mean[:, None]
+
+    #Mean of squares after centering, einsum avoids a squared copy of the batch
+    stddev = np.sqrt(np.einsum("ij,ij->i", flat, flat) / size)
+    adjusted_stddev = np.maximum(stddev, 1.0/math.sqrt(size))
+    flat /= adjusted_stddev[:, None].astype(images.dtype)
+
+    return images
+
+def preprocess_crops(crops, height, width, normalize=True, out=None):
+    """Resize a list of crops into a single float32 array and optionally standardize each image
+    Args:
+        crops: list of numpy arrays in height, width, channels order
+        height: height in pixels of the resized crops
+        width: width in pixels of the resized crops
+        normalize: standardize each image to zero mean and unit variance
+        out: optional preallocated (N, height, width, channels) float32 array to fill
+    Returns:
+        images: a (N, height, width, channels) float32 array
+    """
+    images = resize_batch(crops, height, width, out=out)
+    if normalize:
+        normalize_batch(images)
+
+    return images
@@ -0,0 +1,121 @@
+#Re-shard tfrecords into equal size, globally shuffled shards with a manifest of class and site counts.
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import tensorflow as tf
+
+from DeepTreeAttention.generators import boxes
+
+MANIFEST_FILE = "manifest.json"
+
+def _read_records(path):
+    """Yield serialized records from a tfrecord file"""
+    for record in tf.data.TFRecordDataset(path):
+        yield record.numpy()
+
+def _record_counts(record, classes, sites):
+    """Add the label and site of a serialized record to running counts"""
+    features = tf.train.Example.FromString(record).features.feature
+    if "label" in features:
+        label = str(features["label"].int64_list.value[0])
+        classes[label] = classes.get(label, 0) + 1
+    site = str(features["site"].int64_list.value[0])
+    sites[site] = sites.get(site, 0) + 1
+
+def shard_records(tfrecords, savedir, n_shards, memory_limit=2e9, basename="shard", seed=None):
+    """Rewrite tfrecords into n_shards files of equal size with a global shuffle in bounded memory.
+    Records are first scattered into random buckets small enough to fit in memory, then each bucket is shuffled in memory and written out in order.
+    Args:
+        tfrecords: list of tfrecord paths, all with the same schema
+        savedir: directory to write shards, schema and manifest
+        n_shards: number of output shards
+        memory_limit: approximate bytes of records to hold in memory at once
+        basename: shard filename prefix
+        seed: optional random seed
+    Returns:
+        shards: list of shard paths
+    """
+    if n_shards < 1:
+        raise ValueError("n_shards must be at least 1, not {}".format(n_shards))
+
+    schemas = [boxes.record_schema(x) for x in tfrecords]
+    schemas = [x for x in schemas if x is not None]
+    if len(schemas) == 0:
+        raise ValueError("No records found in {} tfrecords".format(len(tfrecords)))
+    if any([x != schemas[0] for x in schemas]):
+        raise ValueError("tfrecords have different schemas, shard each schema separately")
+
+    rng = random.Random(seed)
+    os.makedirs(savedir, exist_ok=True)
+
+    #Twice as many buckets as needed on average, so a bucket rarely exceeds the memory limit
+    total_bytes = sum([os.path.getsize(x) for x in tfrecords])
+    n_buckets = max(1, int(math.ceil(2 * total_bytes / memory_limit)))
+
+    bucket_dir = tempfile.mkdtemp(dir=savedir)
+    try:
+        #Pass 1, scatter records into random buckets
+        bucket_paths = [os.path.join(bucket_dir, "bucket_{}.tfrecord".format(x)) for x in range(n_buckets)]
+        writers = [tf.io.TFRecordWriter(x) for x in bucket_paths]
+        n_records = 0
+        for path in tfrecords:
+            for record in _read_records(path):
+                writers[rng.randrange(n_buckets)].write(record)
+                n_records += 1
+        for writer in writers:
+            writer.close()
+
+        #Equal shard sizes, the first shards take one extra record if the division is uneven
+        shard_sizes = [n_records // n_shards + (1 if x < n_records % n_shards else 0) for x in range(n_shards)]
+
+        #Pass 2, shuffle each bucket in memory and stream it into the shards in order
+        shards = []
+        manifest = {"n_records": n_records, "shards": []}
+        shard_index = 0
+        writer = None
+        for bucket_path in bucket_paths:
+            records = list(_read_records(bucket_path))
+            rng.shuffle(records)
+            os.remove(bucket_path)
+
+            for record in records:
+                #Open the next shard when the current one is full
+                while writer is None or written == shard_sizes[shard_index]:
+                    if writer is not None:
+                        writer.close()
+                        manifest["shards"].append({"filename": os.path.basename(shards[-1]), "records": written, "classes": classes, "sites": sites})
+                        shard_index += 1
+                    shards.append(os.path.join(savedir, "{}_{}.tfrecord".format(basename, shard_index)))
+                    writer = tf.io.TFRecordWriter(shards[-1])
+                    written = 0
+                    classes = {}
+                    sites = {}
+
+                writer.write(record)
+                _record_counts(record, classes, sites)
+                written += 1
+
+        if writer is not None:
+            writer.close()
+            manifest["shards"].append({"filename": os.path.basename(shards[-1]), "records": written, "classes": classes, "sites": sites})
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+
+    boxes.write_schema(savedir, schemas[0])
+
+    tmp_path = os.path.join(savedir, "{}.{}.tmp".format(MANIFEST_FILE, os.getpid()))
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(savedir, MANIFEST_FILE))
+
+    return shards
+
+def read_manifest(savedir):
+    """Read the shard manifest of a directory written by shard_records"""
+    with open(os.path.join(savedir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    return manifest
@@ -18,8 +18,10 @@ from DeepTreeAttention.models import Hang2020_geographic as Hang
 from DeepTreeAttention.models import metadata
 from  DeepTreeAttention.models import layers
 from DeepTreeAttention.generators import boxes
+from DeepTreeAttention.generators import driver
 from DeepTreeAttention.callbacks import callbacks
 from DeepTreeAttention.generators import cleaning
+from DeepTreeAttention.utils import cache
 
 class AttentionModel():
     """The main class holding train, predict and evaluate methods"""
@@ -73,7 +75,7 @@ class AttentionModel():
         except:
             self.test_shp = None
                 
-    def generate(self, HSI_sensor_path, RGB_sensor_path, elevation, heights, domain, site, species_label_dict=None, train=True, chunk_size=1000, shapefile=None, csv_file=None,label_column="label"):
+    def generate(self, HSI_sensor_path, RGB_sensor_path, elevation, heights, domain, site, species_label_dict=None, train=True, chunk_size=1000, shapefile=None, csv_file=None,label_column="label", ensemble_model=None):
         """Predict species class for each DeepForest bounding box
             Args:
                 shapefile: a DeepForest shapefile (see NeonCrownMaps) with a bounding box and utm projection
@@ -83,6 +85,7 @@ class AttentionModel():
                 sensor_path: supply a known path to a sensor geoTIFF tile. 
                 chunk_size: number of crops per tfrecord
                 label_column: name of column to take taxonID labels
+                ensemble_model: optional ensemble model to write neighbor features, embeddings are reused from neighbors: embedding_store in the config
             """
         #set savedir
         if train:
@@ -111,7 +114,11 @@ class AttentionModel():
                                                    extend_HSI_box=self.config["train"]["HSI"]["extend_box"],
                                                    extend_RGB_box=self.config["train"]["RGB"]["extend_box"],
                                                    label_column=label_column,
-                                                   shuffle=True)
+                                                   shuffle=True,
+                                                   encoding=self.config["train"]["tfrecord_encoding"],
+                                                   ensemble_model=ensemble_model,
+                                                   embedding_store=driver.embedding_store(self.config, ensemble_model),
+                                                   crop_cache_bytes=driver.crop_cache_bytes(self.config))
 
         return created_records
 
@@ -172,6 +179,11 @@ class AttentionModel():
         if len(self.train_records) == 0:
             raise IOError("Cannot find .tfrecords at {}".format(
                 self.config["train"]["tfrecords"]))
+        
+        #Optional on disk cache of decoded records, shared across modes and runs
+        cache_dir = self.config["train"]["cache_dir"]
+        if cache_dir is not None:
+            cache.evict(cache_dir, max_bytes=self.config["train"]["cache_max_gb"] * 1e9)
 
         if validation_split:
             print("Splitting training set into train-test")
@@ -190,6 +202,7 @@ class AttentionModel():
                 mode=mode,
                 ids=ids,
                 cache=False,
+                cache_dir=cache_dir,
                 augmentation=self.config["train"]["augment"],
                 cores=self.config["cpu_workers"])
 
@@ -202,6 +215,7 @@ class AttentionModel():
                 ids=ids,
                 augmentation=False,
                 cache=False,
+                cache_dir=cache_dir,
                 cores=self.config["cpu_workers"])
             
             self.val_split_with_ids = boxes.tf_dataset(
@@ -212,6 +226,7 @@ class AttentionModel():
                 ids=True,
                 augmentation=False,     
                 cache=False,
+                cache_dir=cache_dir,
                 cores=self.config["cpu_workers"])                  
         else:
             #Create training tf.data
@@ -222,6 +237,7 @@ class AttentionModel():
                 mode=mode,
                 ids=ids,
                 cache=False,
+                cache_dir=cache_dir,
                 augmentation=self.config["train"]["augment"],                
                 cores=self.config["cpu_workers"])
 
@@ -239,6 +255,7 @@ class AttentionModel():
                     ids=ids,
                     augmentation=False,    
                     cache=False,
+                    cache_dir=cache_dir,
                     cores=self.config["cpu_workers"])  
                 
                 self.val_split_with_ids = boxes.tf_dataset(
@@ -248,6 +265,7 @@ class AttentionModel():
                     mode=mode,
                     ids=True,
                     cache=False,
+                    cache_dir=cache_dir,
                     augmentation=False,
                     cores=self.config["cpu_workers"])                   
                 
@@ -7,31 +7,46 @@ import ogr
 import os
 import rasterio
 
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
 
-def h5refl2array(refl_filename, epsg):
+from DeepTreeAttention.utils.windows import window_indices
+
+
+#Layout of converted tiles, see creation_options
+TIF_OPTIONS = {
+    "tiled": True,
+    "blocksize": 256,
+    "interleave": "band",
+    "compress": None,
+    "predictor": None,
+    "overviews": None
+}
+
+
+def read_metadata(hdf5_file, epsg=None):
     """
-    Extract metadata from h5 object and reflectance values
-    returns: metadata and a numpy array
+    Extract metadata from an open h5 object without reading the reflectance values
+    returns: metadata and the h5py reflectance dataset
     """
-    hdf5_file = h5py.File(refl_filename, 'r')
-    file_attrs_string = str(list(hdf5_file.items()))
-    file_attrs_string_split = file_attrs_string.split("'")
-    sitename = file_attrs_string_split[1]
+    sitename = list(hdf5_file.keys())[0]
 
     #Extract the reflectance & wavelength datasets
     reflArray = hdf5_file[sitename]['Reflectance']
-    wavelengths = reflArray['Reflectance_Data'].value
+    reflData = reflArray['Reflectance_Data']
 
     # Create dictionary containing relevant metadata information
     metadata = {}
-    metadata['mapInfo'] = reflArray['Metadata']['Coordinate_System']['Map_Info'].value
-    metadata['wavelength'] = reflArray['Metadata']['Spectral_Data']['Wavelength'].value
-    metadata['shape'] = wavelengths.shape
+    metadata['mapInfo'] = reflArray['Metadata']['Coordinate_System']['Map_Info'][()]
+    metadata['wavelength'] = reflArray['Metadata']['Spectral_Data']['Wavelength'][()]
+    metadata['shape'] = reflData.shape
 
     #Extract no data value & scale factor
-    metadata['noDataVal'] = float(
-        reflArray['Reflectance_Data'].attrs['Data_Ignore_Value'])
-    metadata['scaleFactor'] = float(reflArray['Reflectance_Data'].attrs['Scale_Factor'])
+    metadata['noDataVal'] = float(reflData.attrs['Data_Ignore_Value'])
+    metadata['scaleFactor'] = float(reflData.attrs['Scale_Factor'])
 
     #metadata['interleave'] = reflData.attrs['Interleave']
     metadata['bad_band_window1'] = np.array([1340, 1445])
@@ -40,7 +55,6 @@ def h5refl2array(refl_filename, epsg):
 
     mapInfo_string = str(metadata['mapInfo'])
     mapInfo_split = mapInfo_string.split(",")
-    mapInfo_split
 
     # Extract the resolution & convert to floating decimal number
     metadata['res'] = {}
@@ -62,11 +76,45 @@ def h5refl2array(refl_filename, epsg):
     metadata['ext_dict']['xMax'] = xMax
     metadata['ext_dict']['yMin'] = yMin
     metadata['ext_dict']['yMax'] = yMax
+
+    return metadata, reflData
+
+
+def h5refl2array(refl_filename, epsg):
+    """
+    Extract metadata from h5 object and reflectance values
+    returns: metadata and a numpy array
+    """
+    hdf5_file = h5py.File(refl_filename, 'r')
+    metadata, reflData = read_metadata(hdf5_file, epsg=epsg)
+    wavelengths = reflData[()]
     hdf5_file.close()
 
     return metadata, wavelengths
 
 
+def band_indices(bands=None):
+    """
+    bands: "All" bands without the water absorption bands, "false_color" bands or None for every band
+    returns: sorted numpy array of band indices
+    """
+    #Select nanometers RGB see NeonTreeEvaluation/utilities/neon_aop_bands.csv
+    if bands == "All":
+        #Delete water absorption bands
+        index = np.r_[0:425]
+        index = np.delete(index, np.r_[419:425])
+        index = np.delete(index, np.r_[283:315])
+        index = np.delete(index, np.r_[192:210])
+    elif bands == "false_color":
+        index = np.array([16, 54, 112])
+    elif bands is None:
+        index = np.r_[0:426]
+    else:
+        raise ValueError("bands must be 'All', 'false_color' or None, not {}".format(bands))
+
+    return index
+
+
 def stack_subset_bands(reflArray, reflArray_metadata, bands, clipIndex):
     subArray_rows = clipIndex['yMax'] - clipIndex['yMin']
     subArray_cols = clipIndex['xMax'] - clipIndex['xMin']
@@ -180,63 +228,69 @@ def create_raster(subInd, rgb, refl):
     return hcp
 
 
-def generate_raster(h5_path, save_dir, rgb_filename=None, bands=None):
+def creation_options(options=None):
     """
-    h5_path: input path to h5 file on disk
-    bands: "All" bands or "false color" bands
-    save_dir: Directory to save raster object
-    rgb_filename= Path to rgb image to draw extent and crs definition
-    
-    returns: True if saved file exists
+    options: dict overriding TIF_OPTIONS, for example {"compress": "deflate", "predictor": 2}
+        tiled: write square blocks instead of strips
+        blocksize: side of a block in pixels, a multiple of 16
+        interleave: "band" or "pixel"
+        compress: None, "deflate", "zstd" or "lzw"
+        predictor: None, or 2 for horizontal differencing before compression
+        overviews: None or a list of decimation factors, for example [2, 4, 8]
+    returns: rasterio creation options and the overview factors
     """
+    merged = dict(TIF_OPTIONS)
+    if options:
+        unknown = [x for x in options if x not in TIF_OPTIONS]
+        if unknown:
+            raise ValueError("Unknown GeoTIFF options {}, expected some of {}".format(unknown, list(TIF_OPTIONS)))
+        merged.update(options)
 
-    #Load h5 hyperspectral tile and extractr epsg from rgb, epsg as string.
-    if rgb_filename:
-        with rasterio.open(rgb_filename) as dataset:
-            bounds = dataset.bounds
+    if merged["interleave"] not in ["band", "pixel"]:
+        raise ValueError("interleave must be 'band' or 'pixel', not {}".format(merged["interleave"]))
 
-        epsg = str(dataset.crs).split(":")[-1]
+    profile = {"tiled": merged["tiled"], "interleave": merged["interleave"]}
+    if merged["tiled"]:
+        if merged["blocksize"] % 16 != 0:
+            raise ValueError("blocksize must be a multiple of 16, not {}".format(merged["blocksize"]))
+        profile["blockxsize"] = merged["blocksize"]
+        profile["blockysize"] = merged["blocksize"]
 
-    #Get numpy array and metadata
-    metadata, refl = h5refl2array(h5_path, epsg=epsg)
+    if merged["compress"]:
+        profile["compress"] = merged["compress"]
+        if merged["predictor"]:
+            profile["predictor"] = merged["predictor"]
 
-    #Select nanometers RGB see NeonTreeEvaluation/utilities/neon_aop_bands.csv
-    if bands:
-        if bands == "All":
-            #Delete water absorption bands
-            rgb = np.r_[0:425]
-            rgb = np.delete(rgb, np.r_[419:425])
-            rgb = np.delete(rgb, np.r_[283:315])
-            rgb = np.delete(rgb, np.r_[192:210])
-        elif bands == "false_color":
-            rgb = [16, 54, 112]
-    else:
-        rgb = np.r_[0:426]
+    return profile, merged["overviews"]
 
-    #print(itc_id, itc_xmin, itc_xmax, itc_ymin, itc_ymax, epsg)
-    xmin, xmax, ymin, ymax = metadata['extent']
 
-    #Optional clip
-    if bounds:
-        #Set extent in utm
-        clipExtent = {}
-        clipExtent['xMin'] = bounds.left
-        clipExtent['xMax'] = bounds.right
-        clipExtent['yMin'] = bounds.bottom
-        clipExtent['yMax'] = bounds.top
+def generate_raster(h5_path, save_dir, rgb_filename=None, bands=None, block_rows=256, options=None, filename=None):
+    """
+    h5_path: input path to h5 file on disk
+    bands: "All" bands or "false color" bands
+    save_dir: Directory to save raster object
+    rgb_filename= Path to rgb image to draw extent and crs definition
+    block_rows: number of rows read from the h5 file and written at a time, bounds memory to a few blocks instead of the full tile
+    options: GeoTIFF layout and compression, see creation_options
+    filename: optional full path to write instead of the tilename in save_dir, for example a temporary name that is renamed once complete
+    
+    returns: tilename of the saved raster
+    """
 
-    #Get hyperspectral array extent with respect to the pixel index
-    subInd = calc_clip_index(clipExtent, metadata['ext_dict'])
-    #Turn to integer
-    for x in subInd:
-        subInd[x] = int(subInd[x])
+    #Load h5 hyperspectral tile extent and crs from rgb
+    with rasterio.open(rgb_filename) as dataset:
+        bounds = dataset.bounds
+        crs = dataset.crs
 
-    #Index numpy array of hyperspec reflectance
-    refl = refl[(subInd['yMin']):subInd['yMax'], (subInd['xMin']):subInd['xMax'], :]
+    index = band_indices(bands)
+    layout, overviews = creation_options(options)
 
-    #Create raster object from numpy array
-    hyperspec_raster = create_raster(subInd, rgb, refl)
-    sub_meta = metadata
+    #Set extent in utm
+    clipExtent = {}
+    clipExtent['xMin'] = bounds.left
+    clipExtent['xMax'] = bounds.right
+    clipExtent['yMin'] = bounds.bottom
+    clipExtent['yMax'] = bounds.top
 
     #Create new filepath
     if bands == "false_color":
@@ -246,12 +300,137 @@ def generate_raster(h5_path, save_dir, rgb_filename=None, bands=None):
         tilename = os.path.splitext(
             os.path.basename(rgb_filename))[0] + "_hyperspectral.tif"
 
-    #Save georeference crop to file
-    array2raster(tilename, hyperspec_raster, sub_meta, clipExtent, save_dir)
+    with h5py.File(h5_path, 'r') as hdf5_file:
+        metadata, reflData = read_metadata(hdf5_file)
+
+        #Get hyperspectral array extent with respect to the pixel index, within the h5 tile
+        subInd = calc_clip_index(clipExtent, metadata['ext_dict'])
+        row_min = max(int(subInd['yMin']), 0)
+        row_max = min(int(subInd['yMax']), metadata['shape'][0])
+        col_min = max(int(subInd['xMin']), 0)
+        col_max = min(int(subInd['xMax']), metadata['shape'][1])
+
+        pixelWidth = metadata['res']['pixelWidth']
+        pixelHeight = metadata['res']['pixelHeight']
+        transform = Affine(pixelWidth, 0, metadata['ext_dict']['xMin'] + col_min * pixelWidth, 0,
+                           -pixelHeight, metadata['ext_dict']['yMax'] - row_min * pixelHeight)
+
+        profile = {
+            "driver": "GTiff",
+            "height": row_max - row_min,
+            "width": col_max - col_min,
+            "count": len(index),
+            "dtype": "int16",
+            "crs": crs,
+            "transform": transform
+        }
+        profile.update(layout)
+
+        #Stream row blocks of the clipped tile, a crop only touches the tiles it overlaps
+        if filename is None:
+            filename = os.path.join(save_dir, tilename)
+
+        with rasterio.open(filename, "w", **profile) as dst:
+            for row in range(row_min, row_max, block_rows):
+                block_end = min(row + block_rows, row_max)
+                block = reflData[row:block_end, col_min:col_max, :]
+                block = np.moveaxis(block[:, :, index], 2, 0).astype(np.int16)
+                window = Window(0, row - row_min, col_max - col_min, block_end - row)
+                dst.write(block, window=window)
+
+            if overviews:
+                dst.build_overviews(overviews, Resampling.nearest)
 
     return tilename
 
 
+class H5Raster():
+    """
+    Read windows of a NEON reflectance h5 tile with the interface of an opened rasterio dataset.
+    Crops read only the h5 hyperslab under the window, so sparse crowns can be read without converting the tile to a GeoTIFF.
+    A read has no fixed cost beyond the chunks it touches, so crops.crop_images reads each box on its own instead of grouping boxes into larger windows.
+    Reads return the same pixels as rasterio reading the converted tile, see utils/windows.py
+    
+    h5_path: input path to h5 file on disk
+    bands: "All" bands, "false_color" bands or None for every band, see band_indices
+    crs: optional crs of the tile, read from the h5 EPSG code if not given
+    """
+
+    #See crops.crop_images
+    group_reads = False
+
+    def __init__(self, h5_path, bands="All", crs=None):
+        self.name = h5_path
+        self.hdf5_file = h5py.File(h5_path, 'r')
+        self.metadata, self.reflData = read_metadata(self.hdf5_file)
+        self.bands = band_indices(bands)
+
+        self.height, self.width = self.metadata['shape'][:2]
+        self.count = len(self.bands)
+        self.dtypes = tuple(["int16"] * self.count)
+        self.res = (self.metadata['res']['pixelWidth'], self.metadata['res']['pixelHeight'])
+        self.transform = Affine(self.res[0], 0, self.metadata['ext_dict']['xMin'], 0, -self.res[1],
+                                self.metadata['ext_dict']['yMax'])
+        self.bounds = BoundingBox(self.metadata['ext_dict']['xMin'], self.metadata['ext_dict']['yMin'],
+                                  self.metadata['ext_dict']['xMax'], self.metadata['ext_dict']['yMax'])
+
+        if crs is None:
+            coordinate_system = self.reflData.parent['Metadata']['Coordinate_System']
+            if 'EPSG Code' in coordinate_system:
+                crs = CRS.from_epsg(int(coordinate_system['EPSG Code'][()]))
+        self.crs = crs
+
+        #h5 chunks play the role of raster blocks
+        chunks = self.reflData.chunks
+        if chunks is None:
+            chunks = (self.height, self.width)
+        self.block_shapes = [tuple(chunks[:2])] * self.count
+
+    def read(self, window=None):
+        """
+        window: a rasterio.windows.Window, offsets and lengths can be fractional
+        returns: numpy array of bands, rows, cols
+        """
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        rows, cols = window_indices(window, height=self.height, width=self.width)
+        if rows.size == 0 or cols.size == 0:
+            return np.zeros((self.count, rows.size, cols.size), dtype=np.int16)
+
+        #Read the hyperslab under the window in one call. Selecting bands inside the h5py read, with a band list or one read per run of bands, is many times slower per crown than taking them from the small crop.
+        data = self.reflData[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1, :]
+
+        #Sample pixels in memory only if the window is resampled, then take bands in one copy
+        if rows.size != data.shape[0]:
+            data = data[rows - rows[0]]
+        if cols.size != data.shape[1]:
+            data = data[:, cols - cols[0]]
+        data = data[:, :, self.bands].astype(np.int16, copy=False)
+
+        #A view in bands, rows, cols order, rolling it back to channels last does not copy
+        return np.moveaxis(data, 2, 0)
+
+    def close(self):
+        self.hdf5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_raster(path, bands="All"):
+    """
+    path: a .tif opened with rasterio or a NEON reflectance .h5 opened as an H5Raster
+    returns: an opened raster
+    """
+    if path.endswith(".h5"):
+        return H5Raster(path, bands=bands)
+
+    return rasterio.open(path)
+
+
 if __name__ == "__main__":
     #Load RGB raster and get bounds
     rgb_filename = "/Users/ben/Downloads/2018_SJER_3_258000_4106000_image.tif"
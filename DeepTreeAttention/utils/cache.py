@@ -0,0 +1,451 @@
+#File-backed caches. Decoded tf.data datasets are written once to local scratch and reused across modes, stages and jobs.
+#Converted hyperspectral tiles are written once by one worker and shared by every worker on the filesystem.
+#Neighbor crown embeddings are stored per feature model so re-running a model only costs a lookup.
+import fcntl
+import hashlib
+import json
+import h5py
+import numpy as np
+import os
+import shutil
+import time
+
+#Name of the tf.data cache files inside each entry, tf.data adds .index and .data-* suffixes
+CACHE_NAME = "data"
+
+#A writer that has not finished within this many seconds is assumed to have died
+STALE_LOCK_SECONDS = 6 * 60 * 60
+
+#Converted tiles used within this many seconds are not evicted, a worker may have just been given them
+GRACE_SECONDS = 10 * 60
+
+#Lock held by the job writing an entry, released when the job exits
+LOCK_NAME = "writer.lock"
+
+#Locks of the entries this process is writing
+_writing = {}
+
+
+def dataset_key(tfrecords, mode, schema, ids=False, batch_size=None):
+    """Hash a set of tfrecords and the way they are parsed into a cache key
+    Args:
+        tfrecords: list of tfrecord paths
+        mode: tf_dataset mode
+        schema: record schema dict, see boxes.record_schema
+        ids: whether box ids are parsed with the data
+        batch_size: batch size if records are parsed in batches, otherwise None
+    Returns:
+        key: hex digest, changes whenever a record file is added, removed or rewritten
+    """
+    files = []
+    for path in sorted(tfrecords):
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+
+    description = {
+        "files": files,
+        "mode": mode,
+        "schema": schema,
+        "ids": ids,
+        "batch_size": batch_size
+    }
+    key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    return key
+
+
+def _entry_size(entry):
+    size = 0
+    for name in os.listdir(entry):
+        size += os.path.getsize(os.path.join(entry, name))
+
+    return size
+
+
+def is_complete(entry):
+    """A tf.data file cache is only usable once the iterator that wrote it reached the end and wrote the index"""
+    return os.path.exists(os.path.join(entry, "{}.index".format(CACHE_NAME)))
+
+
+def _is_writing(entry):
+    """Another iterator holds a recent lock on the entry"""
+    for name in os.listdir(entry):
+        if name.endswith(".lockfile"):
+            age = time.time() - os.path.getmtime(os.path.join(entry, name))
+            if age < STALE_LOCK_SECONDS:
+                return True
+
+    return False
+
+
+def dataset_cache(cache_dir, key):
+    """Find the tf.data cache filename for a key. The job that creates an entry holds an fcntl lock on it until it exits, so two jobs never write the same entry.
+    Args:
+        cache_dir: root directory of the cache, ideally on local scratch
+        key: see dataset_key
+    Returns:
+        filename: a path to pass to tf.data.Dataset.cache, or None if another job is currently writing this entry
+    """
+    entry = os.path.join(cache_dir, key)
+    filename = os.path.join(entry, CACHE_NAME)
+
+    if os.path.exists(entry) and is_complete(entry):
+        #Mark as recently used for eviction
+        os.utime(entry)
+        return filename
+
+    os.makedirs(entry, exist_ok=True)
+    lock = open(os.path.join(entry, LOCK_NAME), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        print("Cache entry {} is being written by another job, reading records directly".format(key))
+        return None
+
+    #The writer may have finished while we checked
+    if is_complete(entry):
+        lock.close()
+        os.utime(entry)
+        return filename
+
+    #tf.data's own lockfile covers writers on other hosts, where fcntl locks may not be shared
+    if _is_writing(entry):
+        lock.close()
+        print("Cache entry {} is being written by another job, reading records directly".format(key))
+        return None
+
+    #Partial entry from an interrupted run
+    for name in os.listdir(entry):
+        if name != LOCK_NAME:
+            os.remove(os.path.join(entry, name))
+
+    _writing[entry] = lock
+
+    return filename
+
+
+def evict(cache_dir, max_bytes):
+    """Delete least recently used complete entries until the cache is under max_bytes
+    Args:
+        cache_dir: root directory of the cache
+        max_bytes: size limit of the cache in bytes
+    Returns:
+        removed: list of removed keys
+    """
+    if not os.path.exists(cache_dir):
+        return []
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry) and is_complete(entry):
+            entries.append((os.path.getmtime(entry), _entry_size(entry), key))
+
+    total = sum([x[1] for x in entries])
+    removed = []
+    for last_used, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        removed.append(key)
+
+    return removed
+
+
+def clear_cache(cache_dir, key=None):
+    """Remove one cache entry, or the whole cache if key is None"""
+    if key is None:
+        path = cache_dir
+    else:
+        path = os.path.join(cache_dir, key)
+
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def conversion_key(h5_path, bands, extent, options=None):
+    """Hash a hyperspectral conversion into a cache key
+    Args:
+        h5_path: NEON reflectance .h5 tile
+        bands: band selection, see Hyperspectral.band_indices
+        extent: left, bottom, right, top of the clip, usually the RGB tile bounds
+        options: GeoTIFF layout, see Hyperspectral.creation_options
+    Returns:
+        key: hex digest, changes whenever the .h5 tile is rewritten
+    """
+    stat = os.stat(h5_path)
+    description = {
+        "h5": [os.path.abspath(h5_path), stat.st_size, stat.st_mtime_ns],
+        "bands": bands,
+        "extent": [round(x, 3) for x in extent],
+        "options": options
+    }
+    key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    return key
+
+
+class ConversionCache():
+    """Content addressed cache of converted hyperspectral tiles shared by many workers.
+    One worker converts a tile while holding a lock, the others wait and then reuse it. Tiles are written to a temporary name and renamed once complete, so a half-written tile is never read.
+    Hit, miss and eviction counters belong to this instance. A copy pickled to a dask or pool worker counts on its own, so report them from the worker, as driver.generate_tile does.
+    Args:
+        cache_dir: directory of converted tiles, on a filesystem shared by the workers
+        max_bytes: optional size limit, least recently used tiles are removed above it
+        grace_seconds: tiles used within this many seconds are never evicted, since a worker may have just been given them
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, grace_seconds=GRACE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "{}.tif".format(key))
+
+    def _lock(self, path, operation):
+        """Open and flock the lock file of a tile. Evicting a tile removes its lock file, so a lock taken on a removed file is retried on the new one.
+        Args:
+            path: path of the tile
+            operation: fcntl.LOCK_SH or fcntl.LOCK_EX, optionally with fcntl.LOCK_NB
+        Returns:
+            lock: the open lock file, closing it releases the lock. None if LOCK_NB is set and another worker holds the lock.
+        """
+        lock_path = "{}.lock".format(path)
+        while True:
+            lock = open(lock_path, "a")
+            try:
+                fcntl.flock(lock, operation)
+            except BlockingIOError:
+                lock.close()
+                return None
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _touch(self, path):
+        #Mark as recently used for eviction
+        os.utime(path)
+        self.hits += 1
+
+        return path
+
+    def _hit(self, path):
+        """Path of a complete tile, or None if there is no tile. The shared lock keeps evict from removing it while it is marked as used."""
+        lock = self._lock(path, fcntl.LOCK_SH)
+        try:
+            return self._touch(path)
+        except FileNotFoundError:
+            return None
+        finally:
+            lock.close()
+
+    def fetch(self, key, create):
+        """Path of the cached tile for a key, calling create(filename) to write it on a miss
+        Args:
+            key: see conversion_key
+            create: function that writes the tile to the filename it is given
+        Returns:
+            path: path of the complete tile
+        """
+        path = self.path(key)
+        if self._hit(path) is not None:
+            return path
+
+        lock = self._lock(path, fcntl.LOCK_EX)
+        try:
+            #Another worker may have converted the tile while we waited for the lock
+            if os.path.exists(path):
+                return self._touch(path)
+
+            self.misses += 1
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                create(tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        finally:
+            lock.close()
+
+        if self.max_bytes is not None:
+            self.evict(keep=path)
+
+        return path
+
+    def evict(self, keep=None):
+        """Delete least recently used tiles and their lock files until the cache is under max_bytes.
+        The tile in keep, tiles used within grace_seconds and tiles locked by a worker converting or fetching them are never removed, so the cache can stay over max_bytes.
+        Args:
+            keep: optional path of a tile about to be returned
+        Returns:
+            removed: list of removed paths
+        """
+        tiles = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tif"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    tiles.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except FileNotFoundError:
+                    #Removed by another worker
+                    continue
+
+        total = sum([x[1] for x in tiles])
+        removed = []
+        for last_used, size, path in sorted(tiles):
+            if total <= self.max_bytes:
+                break
+            if path == keep or time.time() - last_used < self.grace_seconds:
+                continue
+            lock = self._lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if lock is None:
+                continue
+            try:
+                try:
+                    recently_used = time.time() - os.path.getmtime(path) < self.grace_seconds
+                except FileNotFoundError:
+                    #Removed by another worker
+                    os.remove(lock.name)
+                    total -= size
+                    continue
+                #Used since it was listed
+                if recently_used:
+                    continue
+                os.remove(path)
+                os.remove(lock.name)
+            finally:
+                lock.close()
+            total -= size
+            removed.append(path)
+
+        self.evictions += len(removed)
+
+        return removed
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def model_hash(model, HSI_size=None):
+    """Hash the weights of a feature model, and the crop size it is fed, into an embedding store key"""
+    digest = hashlib.sha1()
+    for weight in model.get_weights():
+        digest.update(np.ascontiguousarray(weight).tobytes())
+    digest.update(str(HSI_size).encode())
+
+    return digest.hexdigest()
+
+
+class EmbeddingStore():
+    """HDF5 store of crown embeddings indexed by individual id, with one group per feature model.
+    Readers take a shared lock and writers an exclusive lock, so workers on one filesystem can share a store.
+    Args:
+        path: .h5 file of the store, created if needed
+        model_key: see model_hash, embeddings of other models in the same file are ignored
+    """
+
+    def __init__(self, path, model_key):
+        self.path = path
+        self.model_key = model_key
+        self.hits = 0
+        self.misses = 0
+
+    def _open(self, mode, lock_type):
+        lock = open("{}.lock".format(self.path), "w")
+        fcntl.flock(lock, lock_type)
+        try:
+            if mode == "r" and not os.path.exists(self.path):
+                hdf5_file = None
+            else:
+                hdf5_file = h5py.File(self.path, mode)
+        except Exception:
+            lock.close()
+            raise
+
+        return lock, hdf5_file
+
+    def _close(self, lock, hdf5_file):
+        if hdf5_file is not None:
+            hdf5_file.close()
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    def get(self, ids):
+        """Stored embeddings of individual ids
+        Returns:
+            embeddings: dict of id -> embedding for the ids in the store
+        """
+        ids = [str(x) for x in ids]
+        lock, hdf5_file = self._open("r", fcntl.LOCK_SH)
+        try:
+            if hdf5_file is None or self.model_key not in hdf5_file:
+                found = {}
+            else:
+                group = hdf5_file[self.model_key]
+                rows = {x.decode(): index for index, x in enumerate(group["ids"][()])}
+                found_ids = [x for x in set(ids) if x in rows]
+                #h5py reads need increasing indices
+                found_rows = sorted([rows[x] for x in found_ids])
+                embeddings = group["embeddings"][found_rows] if found_rows else []
+                row_ids = {rows[x]: x for x in found_ids}
+                found = {row_ids[row]: embedding for row, embedding in zip(found_rows, embeddings)}
+        finally:
+            self._close(lock, hdf5_file)
+
+        self.hits += len([x for x in ids if x in found])
+        self.misses += len([x for x in ids if x not in found])
+
+        return found
+
+    def put(self, ids, embeddings):
+        """Add embeddings of individual ids, ids already in the store are skipped"""
+        if len(ids) == 0:
+            return
+        ids = [str(x) for x in ids]
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        lock, hdf5_file = self._open("a", fcntl.LOCK_EX)
+        try:
+            if self.model_key not in hdf5_file:
+                group = hdf5_file.create_group(self.model_key)
+                group.create_dataset("ids", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+                group.create_dataset("embeddings", shape=(0, embeddings.shape[1]), maxshape=(None, embeddings.shape[1]), dtype=np.float32, chunks=True)
+            group = hdf5_file[self.model_key]
+
+            #Skip stored ids, and keep the first of repeated ids
+            seen = set([x.decode() for x in group["ids"][()]])
+            new = []
+            for index, x in enumerate(ids):
+                if x not in seen:
+                    seen.add(x)
+                    new.append(index)
+            if new:
+                n = group["ids"].shape[0]
+                group["ids"].resize((n + len(new),))
+                group["ids"][n:] = [ids[x] for x in new]
+                group["embeddings"].resize((n + len(new), embeddings.shape[1]))
+                group["embeddings"][n:] = embeddings[new]
+        finally:
+            self._close(lock, hdf5_file)
+
+    def __len__(self):
+        lock, hdf5_file = self._open("r", fcntl.LOCK_SH)
+        try:
+            if hdf5_file is None or self.model_key not in hdf5_file:
+                return 0
+            return hdf5_file[self.model_key]["ids"].shape[0]
+        finally:
+            self._close(lock, hdf5_file)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
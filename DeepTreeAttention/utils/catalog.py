@@ -0,0 +1,171 @@
+#Persisted catalog of NEON sensor files. Walk the sensor roots once into a sqlite file, then look up paths without recursive globbing.
+import os
+import re
+import sqlite3
+
+from DeepTreeAttention.utils.paths import geoindex_from_path, year_from_path, product_from_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT,
+    product TEXT,
+    geoindex TEXT,
+    year INTEGER,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_geoindex ON files (geoindex);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+"""
+
+def connect(catalog_path):
+    """Open a catalog, creating the tables if needed"""
+    connection = sqlite3.connect(catalog_path)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+def _remove_directory(connection, directory):
+    """Remove a directory that no longer exists, and everything below it"""
+    prefix = directory + os.sep
+    connection.execute("DELETE FROM files WHERE directory = ? OR substr(directory, 1, ?) = ?", (directory, len(prefix), prefix))
+    connection.execute("DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?", (directory, len(prefix), prefix))
+
+def _scan_directory(connection, directory, extensions):
+    """List a directory, replace its files in the catalog and return its subdirectories"""
+    files = []
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.name.endswith(extensions):
+                stat = entry.stat()
+                files.append((entry.path, directory, product_from_path(entry.path), geoindex_from_path(entry.path), year_from_path(entry.path), stat.st_size, stat.st_mtime))
+
+    connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+    connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", files)
+
+    #Forget subdirectories that were removed
+    known = connection.execute("SELECT path FROM directories WHERE parent = ?", (directory,)).fetchall()
+    for (path,) in known:
+        if path not in subdirectories:
+            _remove_directory(connection, path)
+
+    return subdirectories
+
+def build_catalog(roots, catalog_path, extensions=(".tif", ".h5")):
+    """Walk sensor roots and record every sensor file in a sqlite catalog.
+    On later calls only directories whose mtime changed are listed again, unchanged directories are only stat'd to find changes below them.
+    Args:
+        roots: list of root directories, for example ["/orange/ewhite/NeonData"]
+        catalog_path: path of the sqlite catalog file
+        extensions: file extensions to record
+    Returns:
+        counts: dict with the number of directories scanned, skipped and files in the catalog
+    """
+    connection = connect(catalog_path)
+    extensions = tuple(extensions)
+    counts = {"scanned": 0, "skipped": 0}
+
+    with connection:
+        stack = [(os.path.abspath(x), None) for x in roots]
+        while stack:
+            directory, parent = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+            except FileNotFoundError:
+                _remove_directory(connection, directory)
+                continue
+
+            row = connection.execute("SELECT mtime FROM directories WHERE path = ?", (directory,)).fetchone()
+            if row is not None and row[0] == mtime:
+                #Files in this directory are unchanged, subdirectories may have changed
+                subdirectories = [x[0] for x in connection.execute("SELECT path FROM directories WHERE parent = ?", (directory,))]
+                counts["skipped"] += 1
+            else:
+                subdirectories = _scan_directory(connection, directory, extensions)
+                connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory, parent, mtime))
+                counts["scanned"] += 1
+
+            for subdirectory in subdirectories:
+                stack.append((subdirectory, directory))
+
+    counts["files"] = connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    connection.close()
+
+    return counts
+
+def _pattern_prefix(pattern):
+    """Literal directory prefix of a glob pattern, used to narrow the catalog query"""
+    match = re.search(r"[\*\?\[]", pattern)
+    if match is None:
+        return pattern
+
+    return os.path.dirname(pattern[:match.start()])
+
+def _translate_part(part):
+    """Regular expression of one path component of a glob pattern, wildcards never match "/" and a leading wildcard never matches a hidden name"""
+    regex = "" if part.startswith(".") else r"(?!\.)"
+    i = 0
+    while i < len(part):
+        character = part[i]
+        i += 1
+        if character == "*":
+            regex += "[^/]*"
+        elif character == "?":
+            regex += "[^/]"
+        elif character == "[":
+            end = part.find("]", i + 1 if part[i:i + 1] in ("!", "]") else i)
+            if end < 0:
+                regex += re.escape(character)
+                continue
+            content = part[i:end].replace("\\", "\\\\")
+            i = end + 1
+            if content.startswith("!"):
+                content = "^/" + content[1:]
+            elif content.startswith("^"):
+                content = "\\" + content
+            regex += "[{}]".format(content)
+        else:
+            regex += re.escape(character)
+
+    return regex
+
+def _translate(pattern):
+    """Regular expression matching the files glob.glob(pattern, recursive=True) returns. "**" matches zero or more directories."""
+    parts = pattern.split("/")
+    regex = ""
+    for position, part in enumerate(parts):
+        last = position == len(parts) - 1
+        if part == "**":
+            regex += r"(?:(?!\.)[^/]+/)*" + (r"(?!\.)[^/]+" if last else "")
+        else:
+            regex += _translate_part(part) + ("" if last else "/")
+
+    return regex
+
+def catalog_paths(catalog_path, pattern):
+    """Paths in the catalog matching a glob pattern, the same files as glob.glob(pattern, recursive=True)
+    Args:
+        catalog_path: path of the sqlite catalog file
+        pattern: glob pattern, for example the sensor pools in tree_config.yml
+    Returns:
+        paths: list of matching paths
+    """
+    connection = connect(catalog_path)
+    prefix = os.path.abspath(_pattern_prefix(pattern))
+    rows = connection.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+    connection.close()
+
+    regex = re.compile(_translate(os.path.abspath(pattern)))
+    paths = [x[0] for x in rows if regex.fullmatch(x[0])]
+
+    return paths
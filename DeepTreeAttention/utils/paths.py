@@ -4,8 +4,10 @@ import glob
 import math
 import re
 import h5py
+import rasterio
 
 from DeepTreeAttention.utils import Hyperspectral
+from DeepTreeAttention.utils import cache
 
 
 def bounds_to_geoindex(bounds):
@@ -26,62 +28,205 @@ def bounds_to_geoindex(bounds):
     return geoindex
 
 
-def find_sensor_path(lookup_pool, shapefile=None, bounds=None):
+def geoindex_from_path(path):
+    """Parse the NEON {easting}_{northing} tile index from a filename, None if there is none"""
+    match = re.findall(r"(?<!\d)(\d{6}_\d{7})(?!\d)", os.path.basename(path))
+    if len(match) == 0:
+        return None
+    
+    return match[-1]
+
+def year_from_path(path):
+    """Parse the flight year from a NEON path, either a {year}_{site}_ basename or a year directory"""
+    match = re.search(r"(?<!\d)((?:19|20)\d{2})_[A-Z]{4}_", os.path.basename(path))
+    if match is None:
+        match = re.search(r"/((?:19|20)\d{2})/", path)
+    if match is None:
+        return None
+    
+    return int(match.group(1))
+
+def site_from_sensor_path(path):
+    """Parse the four letter site code from a NEON sensor path"""
+    basename = os.path.basename(path)
+    match = re.search(r"NEON_D\d+_([A-Z]{4})_", basename)
+    if match is None:
+        match = re.search(r"\d{4}_([A-Z]{4})_\d", basename)
+    if match is None:
+        return None
+    
+    return match.group(1)
+
+def product_from_path(path):
+    """Parse the NEON data product code, for example DP3.30010.001, from a sensor path. Falls back to the product name after the geoindex, for example reflectance or image."""
+    match = re.search(r"DP\d\.\d{5}\.\d{3}", path)
+    if match is not None:
+        return match.group(0)
+    
+    match = re.search(r"\d{6}_\d{7}_([A-Za-z]+)", os.path.basename(path))
+    if match is not None:
+        return match.group(1)
+    
+    return None
+
+class SensorIndex():
+    """Lookup of NEON sensor tiles by geoindex, built once from a list of paths.
+    Each path is parsed into its geoindex, year, site and product. Lookups are a dict access instead of a scan of the pool.
+    The index only holds dicts of strings, so it pickles cheaply to dask workers.
+    """
+    def __init__(self, paths):
+        """
+        Args:
+            paths: list of sensor paths, for example from glob.glob(sensor_pool, recursive=True)
+        """
+        self.tiles = {}
+        self.metadata = {}
+        for path in paths:
+            geoindex = geoindex_from_path(path)
+            if geoindex is None:
+                continue
+            self.metadata[path] = {
+                "geoindex": geoindex,
+                "year": year_from_path(path),
+                "site": site_from_sensor_path(path),
+                "product": product_from_path(path)}
+            self.tiles.setdefault(geoindex, []).append(path)
+        
+        #Sort by year and then path, so the latest year is last
+        for geoindex in self.tiles:
+            self.tiles[geoindex].sort(key=lambda x: (self.metadata[x]["year"] or 0, x))
+    
+    @classmethod
+    def from_glob(cls, pattern):
+        """Build an index from a recursive glob of sensor paths"""
+        return cls(glob.glob(pattern, recursive=True))
+    
+    @classmethod
+    def from_catalog(cls, catalog_path, pattern):
+        """Build an index from the paths in a sensor catalog that match a glob pattern, see utils/catalog.py"""
+        from DeepTreeAttention.utils import catalog
+        return cls(catalog.catalog_paths(catalog_path, pattern))
+    
+    def __len__(self):
+        return len(self.metadata)
+    
+    def lookup(self, geoindex, year=None):
+        """Find the sensor path for a geoindex
+        Args:
+            geoindex: str {easting}_{northing}
+            year: None for the latest year, or a specific flight year
+        Returns:
+            path: full path to sensor tile
+        """
+        match = self.tiles.get(geoindex, [])
+        if year is not None:
+            match = [x for x in match if self.metadata[x]["year"] == int(year)]
+        if len(match) == 0:
+            raise ValueError("No matches for geoindex {} in sensor pool".format(geoindex))
+        
+        return match[-1]
+
+def sensor_index(pattern, catalog_path=None):
+    """Build a SensorIndex from a sensor catalog if one is given, otherwise from a recursive glob
+    Args:
+        pattern: glob pattern of sensor files
+        catalog_path: optional sqlite catalog, see utils/catalog.py
+    Returns:
+        index: a SensorIndex
+    """
+    if catalog_path is not None and os.path.exists(catalog_path):
+        return SensorIndex.from_catalog(catalog_path, pattern)
+    
+    return SensorIndex.from_glob(pattern)
+
+def find_sensor_path(lookup_pool, shapefile=None, bounds=None, year=None):
     """Find a hyperspec path based on the shapefile using NEONs schema
     Args:
         bounds: Optional: list of top, left, bottom, right bounds, usually from geopandas.total_bounds. Instead of providing a shapefile
-        lookup_pool: glob string to search for matching files for geoindex
+        lookup_pool: a SensorIndex, or a list of sensor paths to search for matching files for geoindex
+        year: Optional: a specific flight year, only used with a SensorIndex. Default is the latest year.
     Returns:
         year_match: full path to sensor tile
     """
 
     if shapefile is None:
         geo_index = bounds_to_geoindex(bounds=bounds)
-        match = [x for x in lookup_pool if geo_index in x]
-        match.sort()
-        try:
-            year_match = match[-1]
-        except Exception as e:
-            raise ValueError("No matches for geoindex {} in sensor pool".format(geo_index))
     else:
-
         #Get file metadata from name string
         basename = os.path.splitext(os.path.basename(shapefile))[0]
         geo_index = re.search("(\d+_\d+)_image", basename).group(1)
-        match = [x for x in lookup_pool if geo_index in x]
-        match.sort()
-        try:
-            year_match = match[-1]
-        except Exception as e:
-            raise ValueError("No matches for geoindex {} in sensor pool".format(geo_index))
+    
+    if isinstance(lookup_pool, SensorIndex):
+        return lookup_pool.lookup(geo_index, year=year)
+    
+    match = [x for x in lookup_pool if geo_index in x]
+    match.sort()
+    try:
+        year_match = match[-1]
+    except Exception as e:
+        raise ValueError("No matches for geoindex {} in sensor pool".format(geo_index))
 
     return year_match
 
 
-def convert_h5(hyperspectral_h5_path, rgb_path, savedir):
+def convert_h5(hyperspectral_h5_path, rgb_path, savedir, options=None, conversion_cache=None):
+    """Convert a .h5 hyperspec tile to a .tif clipped to the RGB tile
+    Args:
+        hyperspectral_h5_path: NEON reflectance .h5 tile
+        rgb_path: RGB tile giving the clip extent and crs
+        savedir: directory of converted tiles, named after the RGB tile
+        options: GeoTIFF layout, see Hyperspectral.creation_options
+        conversion_cache: optional cache.ConversionCache, used instead of savedir so that concurrent workers convert each tile once
+    Returns:
+        tif_path: path of the converted tile
+    """
+    if conversion_cache is not None:
+        with rasterio.open(rgb_path) as src:
+            extent = tuple(src.bounds)
+        key = cache.conversion_key(hyperspectral_h5_path, bands="All", extent=extent, options=options)
+
+        def create(filename):
+            Hyperspectral.generate_raster(h5_path=hyperspectral_h5_path,
+                                          rgb_filename=rgb_path,
+                                          bands="All",
+                                          save_dir=savedir,
+                                          options=options,
+                                          filename=filename)
+
+        return conversion_cache.fetch(key, create)
+
     tif_basename = os.path.splitext(os.path.basename(rgb_path))[0] + "_hyperspectral.tif"
     tif_path = "{}/{}".format(savedir, tif_basename)
 
     if not os.path.exists(tif_path):
+        #Write to a temporary name so a partly written tile is never found by os.path.exists
+        tmp_path = "{}.{}.tmp".format(tif_path, os.getpid())
         Hyperspectral.generate_raster(h5_path=hyperspectral_h5_path,
                                       rgb_filename=rgb_path,
                                       bands="All",
-                                      save_dir=savedir)
+                                      save_dir=savedir,
+                                      options=options,
+                                      filename=tmp_path)
+        os.replace(tmp_path, tif_path)
 
     return tif_path
 
 
-def lookup_and_convert(shapefile, rgb_pool, hyperspectral_pool, savedir):
+def lookup_and_convert(shapefile, rgb_pool, hyperspectral_pool, savedir, options=None, conversion_cache=None):
+    """Find the hyperspectral tile of a shapefile, converted to .tif in savedir. If savedir is None the .h5 path is returned to be cropped directly, see Hyperspectral.H5Raster"""
     hyperspectral_h5_path = find_sensor_path(shapefile=shapefile,
                                              lookup_pool=hyperspectral_pool)
+    if savedir is None:
+        return hyperspectral_h5_path
+    
     rgb_path = find_sensor_path(shapefile=shapefile, lookup_pool=rgb_pool)
 
     #convert .h5 hyperspec tile if needed
     tif_basename = os.path.splitext(os.path.basename(rgb_path))[0] + "_hyperspectral.tif"
     tif_path = "{}/{}".format(savedir, tif_basename)
 
-    if not os.path.exists(tif_path):
-        tif_path = convert_h5(hyperspectral_h5_path, rgb_path, savedir)
+    if conversion_cache is not None or not os.path.exists(tif_path):
+        tif_path = convert_h5(hyperspectral_h5_path, rgb_path, savedir, options=options, conversion_cache=conversion_cache)
 
     return tif_path
 
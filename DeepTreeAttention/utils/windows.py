@@ -0,0 +1,39 @@
+#Utility functions for reproducing rasterio windowed reads from data already in memory.
+import math
+import numpy as np
+
+
+def _sample_axis(start, stop):
+    """Pixel indices sampled along one axis between fractional start and stop"""
+    length = stop - start
+    if length <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    size = int(math.floor(length + 0.5))
+    if size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    return np.floor(start + (np.arange(size) + 0.5) * length / size).astype(np.int64)
+
+
+def window_indices(window, height, width):
+    """Find the pixel rows and columns that src.read(window=window) returns
+    GDAL clips a fractional window to the raster and nearest-neighbor samples it into an output of rounded size.
+    Slicing these indices from a larger in-memory read gives the same array as reading the window directly.
+    Args:
+        window: a rasterio.windows.Window, offsets and lengths can be fractional
+        height: number of rows in the raster
+        width: number of columns in the raster
+    Returns:
+        rows: integer array of sampled row indices
+        cols: integer array of sampled column indices
+    """
+    row_start = max(window.row_off, 0)
+    row_stop = min(window.row_off + window.height, height)
+    col_start = max(window.col_off, 0)
+    col_stop = min(window.col_off + window.width, width)
+
+    rows = _sample_axis(row_start, row_stop)
+    cols = _sample_axis(col_start, col_stop)
+
+    return rows, cols
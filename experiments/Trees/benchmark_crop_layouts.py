@@ -0,0 +1,96 @@
+#Benchmark crown crop reads from converted hyperspectral tiles written with different GeoTIFF layouts, see Hyperspectral.creation_options
+import os
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+import geopandas as gpd
+import rasterio
+
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from DeepTreeAttention.generators.crops import crop_image, crop_images
+from DeepTreeAttention.utils import Hyperspectral
+
+LAYOUTS = {
+    "striped": {"tiled": False},
+    "tiled_band": {},
+    "tiled_pixel": {"interleave": "pixel"},
+    "tiled_64_pixel": {"interleave": "pixel", "blocksize": 64},
+    "deflate_band": {"compress": "deflate", "predictor": 2},
+    "deflate_pixel": {"interleave": "pixel", "compress": "deflate", "predictor": 2},
+    "zstd_pixel": {"interleave": "pixel", "compress": "zstd", "predictor": 2}
+}
+
+def synthetic_tile(savedir, size=500, left=320000, top=4882000):
+    """Write a NEON style reflectance h5 and a matching RGB tile. Reflectance is smooth along bands like real spectra so compression ratios are realistic"""
+    h5_path = os.path.join(savedir, "NEON_D01_BART_DP3_{}_{}_reflectance.h5".format(left, top - size))
+    spectra = np.cumsum(np.random.randint(-20, 21, size=(size, size, 426)), axis=2) + 2000
+    with h5py.File(h5_path, "w") as f:
+        refl = f.create_group("BART/Reflectance")
+        data = refl.create_dataset("Reflectance_Data", data=spectra.astype(np.int16), chunks=(73, 73, 426))
+        data.attrs["Data_Ignore_Value"] = -9999
+        data.attrs["Scale_Factor"] = 10000
+        refl.create_dataset("Metadata/Coordinate_System/Map_Info", data="UTM,  1.000,  1.000,  {}.00,  {}.00,  1.0000000000e+00,  1.0000000000e+00,  19,  North,  WGS-84,  units=Meters, 0".format(left, top).encode())
+        refl.create_dataset("Metadata/Spectral_Data/Wavelength", data=np.linspace(380, 2510, 426))
+
+    rgb_path = os.path.join(savedir, "2019_BART_5_{}_{}_image.tif".format(left, top - size))
+    with rasterio.open(rgb_path, "w", driver="GTiff", height=size, width=size, count=3, dtype="uint8", crs="EPSG:32619", transform=from_origin(left, top, 1, 1)) as dst:
+        dst.write(np.zeros((3, size, size), dtype=np.uint8))
+
+    return h5_path, rgb_path
+
+def random_crowns(bounds, n=500, min_size=3, max_size=15):
+    """Random crown boxes in meters within bounds"""
+    left, bottom, right, top = bounds
+    widths = np.random.uniform(min_size, max_size, n)
+    xmin = np.random.uniform(left, right - max_size, n)
+    ymin = np.random.uniform(bottom, top - max_size, n)
+    geometry = [box(x, y, x + w, y + w) for x, y, w in zip(xmin, ymin, widths)]
+
+    return gpd.GeoDataFrame(geometry=geometry)
+
+def benchmark(src, crowns):
+    """Crowns per second cropping one at a time with crop_image and grouped with crop_images"""
+    start = time.time()
+    for geometry in crowns.geometry:
+        crop_image(src, geometry)
+    single = crowns.shape[0] / (time.time() - start)
+
+    start = time.time()
+    crop_images(src, crowns)
+    grouped = crowns.shape[0] / (time.time() - start)
+
+    return single, grouped
+
+if __name__ == "__main__":
+    #Optionally pass a NEON h5 tile and its RGB tile, otherwise benchmark a synthetic tile
+    savedir = tempfile.mkdtemp()
+    if len(sys.argv) > 2:
+        h5_path, rgb_path = sys.argv[1], sys.argv[2]
+    else:
+        h5_path, rgb_path = synthetic_tile(savedir)
+
+    with rasterio.open(rgb_path) as src:
+        crowns = random_crowns(src.bounds)
+
+    #Tiles are read back from the page cache, so this measures decoding and read amplification rather than disk speed
+    for name, options in LAYOUTS.items():
+        layout_dir = os.path.join(savedir, name)
+        os.mkdir(layout_dir)
+        try:
+            tilename = Hyperspectral.generate_raster(h5_path=h5_path, save_dir=layout_dir, rgb_filename=rgb_path, bands="All", options=options)
+        except Exception as e:
+            print("layout: {} failed with {}".format(name, e))
+            continue
+
+        path = os.path.join(layout_dir, tilename)
+        with rasterio.open(path) as src:
+            single, grouped = benchmark(src, crowns)
+        print("layout: {}, {:.0f} MB, crop_image {:.0f} crowns/sec, crop_images {:.0f} crowns/sec".format(name, os.path.getsize(path) / 1e6, single, grouped))
+
+    with Hyperspectral.H5Raster(h5_path, bands="All") as src:
+        single, grouped = benchmark(src, crowns)
+    print("layout: h5, {:.0f} MB, crop_image {:.0f} crowns/sec, crop_images {:.0f} crowns/sec".format(os.path.getsize(h5_path) / 1e6, single, grouped))
@@ -0,0 +1,62 @@
+#Benchmark tfrecord parsing, one record at a time versus batched tf.io.parse_example
+import glob
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+from DeepTreeAttention.generators import boxes
+
+def synthetic_records(savedir, n_files=4, records_per_file=500, k_neighbors=5, n_neighbor_features=64, encoding="float32"):
+    """Write random records in the shape of generate_tfrecords output"""
+    filenames = []
+    for x in range(n_files):
+        filename = os.path.join(savedir, "synthetic_{}.tfrecord".format(x))
+        boxes.write_tfrecord(
+            filename=filename,
+            HSI_images=np.random.normal(size=(records_per_file, 20, 20, 369)).astype(np.float32),
+            RGB_images=np.random.randint(0, 255, size=(records_per_file, 100, 100, 3)).astype(np.float32),
+            domains=np.random.randint(0, 10, records_per_file),
+            sites=np.random.randint(0, 10, records_per_file),
+            elevations=np.random.random(records_per_file),
+            heights=np.random.random(records_per_file) * 10,
+            indices=np.arange(records_per_file),
+            labels=np.random.randint(0, 6, records_per_file),
+            number_of_domains=10,
+            number_of_sites=10,
+            classes=6,
+            neighbor_arrays=np.random.random((records_per_file, k_neighbors, n_neighbor_features)).astype(np.float32),
+            neighbor_distances=np.random.random((records_per_file, k_neighbors)),
+            encoding=encoding)
+        filenames.append(filename)
+
+    return filenames
+
+def benchmark(tfrecords, mode, batch_parse, batch_size=256, cores=8):
+    """Records per second for a full pass over tfrecords"""
+    dataset = boxes.tf_dataset(tfrecords, mode=mode, batch_size=batch_size, shuffle=True, augmentation=True, cores=cores, batch_parse=batch_parse)
+
+    #Warm up the pipeline before timing
+    for batch in dataset.take(1):
+        pass
+
+    counter = 0
+    start = time.time()
+    for data, label in dataset:
+        counter += label.shape[0]
+    elapsed = time.time() - start
+
+    return counter / elapsed
+
+if __name__ == "__main__":
+    #Optionally pass a glob of records, otherwise benchmark synthetic records
+    if len(sys.argv) > 1:
+        tfrecords = glob.glob(sys.argv[1])
+    else:
+        tfrecords = synthetic_records(tempfile.mkdtemp())
+
+    for mode in ["HSI", "ensemble", "neighbors", "metadata"]:
+        for batch_parse in [False, True]:
+            rate = benchmark(tfrecords, mode=mode, batch_parse=batch_parse)
+            print("mode: {}, batch_parse: {}, {:.0f} records/sec".format(mode, batch_parse, rate))
@@ -0,0 +1,49 @@
+#Benchmark the taxonID/siteID check of a plot split, the former per row filter against the anti-join in create_training_shp.validate_split
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from DeepTreeAttention.generators.create_training_shp import validate_split
+
+def synthetic_vst(n=500000, plots=15000, sites=47, taxa=600):
+    """A vst like table, plots nested in sites and a long tailed species distribution"""
+    plot = np.random.randint(0, plots, n)
+    taxon = np.random.zipf(1.3, n) % taxa
+    vst = pd.DataFrame({
+        "plotID": ["PLOT_{}".format(x) for x in plot],
+        "siteID": ["SITE_{}".format(x % sites) for x in plot],
+        "taxonID": ["TAXON_{}".format(x) for x in taxon]})
+
+    return vst
+
+def row_filter(train, test):
+    """The per row check formerly in train_test_split"""
+    to_remove = []
+    for index,row in test.iterrows():
+        if train[(train.taxonID==row["taxonID"]) & (train.siteID==row["siteID"])].empty:
+            to_remove.append(index)
+
+    return to_remove
+
+if __name__ == "__main__":
+    #Usage: python benchmark_split_validation.py <rows>
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    np.random.seed(1)
+    vst = synthetic_vst(n)
+    test_plots = vst.plotID.drop_duplicates().sample(frac=0.10)
+    test = vst[vst.plotID.isin(test_plots)]
+    train = vst[~vst.plotID.isin(test_plots)]
+
+    start = time.time()
+    validated_train, validated_test = validate_split(train, test)
+    anti_join = time.time() - start
+    print("validate_split: {} train and {} test rows checked in {:.2f} seconds".format(train.shape[0], test.shape[0], anti_join))
+
+    #The row filter is far too slow for the whole test set, time a sample and extrapolate
+    sample = test.sample(min(200, test.shape[0]))
+    start = time.time()
+    row_filter(train, sample)
+    per_row = (time.time() - start) / sample.shape[0]
+    print("row filter: {:.1f} ms per test row, about {:.0f} seconds for all {} test rows, {:.0f}x slower".format(
+        per_row * 1000, per_row * test.shape[0], test.shape[0], per_row * test.shape[0] / anti_join))
@@ -0,0 +1,15 @@
+#Build or refresh the sqlite catalog of NEON sensor files. Set sensor_catalog in the config to the catalog path to use it.
+import sys
+import time
+
+from DeepTreeAttention.utils import catalog
+
+if __name__ == "__main__":
+    #Usage: python build_catalog.py <catalog path> <root> [<root> ...]
+    catalog_path = sys.argv[1]
+    roots = sys.argv[2:]
+
+    start = time.time()
+    counts = catalog.build_catalog(roots, catalog_path)
+    print("Catalog {} holds {} files, scanned {} directories and skipped {} unchanged in {:.0f} seconds".format(
+        catalog_path, counts["files"], counts["scanned"], counts["skipped"], time.time() - start))
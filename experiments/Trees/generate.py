@@ -5,13 +5,12 @@ import os
 import pandas as pd
 from dask import dataframe as dd
 
-from DeepTreeAttention.trees import AttentionModel, __file__
-from DeepTreeAttention.generators import boxes
+from DeepTreeAttention.trees import __file__
+from DeepTreeAttention.generators import driver
+from DeepTreeAttention.utils.config import parse_yaml
 from DeepTreeAttention.utils.start_cluster import start
 from DeepTreeAttention.utils.paths import *
 
-from distributed import wait
-
 #Delete any file previous run
 old_files = glob.glob("/orange/idtrees-collab/DeepTreeAttention/WeakLabels/*")
 [os.remove(x) for x in old_files]
@@ -74,75 +73,13 @@ df.groupby("path").apply(write_csv)
 records_to_run = glob.glob("/orange/idtrees-collab/DeepTreeAttention/WeakLabels/*.csv")
 print("Running records: {}".format(records_to_run))
 
-def run(record):
-    
-    att = AttentionModel(config="/home/b.weinstein/DeepTreeAttention/conf/tree_config.yml")
-    
-    ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    site_classes_file = "{}/data/processed/site_class_labels.csv".format(ROOT)
-    site_classdf  = pd.read_csv(site_classes_file)
-    site_label_dict = site_classdf.set_index("siteID").label.to_dict()    
-    
-    domain_classes_file = "{}/data/processed/domain_class_labels.csv".format(ROOT)
-    domain_classdf  = pd.read_csv(domain_classes_file)
-    domain_label_dict = domain_classdf.set_index("domainID").label.to_dict()  
-    
-    species_classes_file = "{}/data/processed/species_class_labels.csv".format(ROOT)
-    species_classdf  = pd.read_csv(species_classes_file)
-    species_label_dict = species_classdf.set_index("taxonID").label.to_dict()
-    
-    rgb_pool = glob.glob(att.config["rgb_sensor_pool"], recursive=True)
-    hyperspectral_pool = glob.glob(att.config["hyperspectral_sensor_pool"], recursive=True)
-    
-    #Convert h5 hyperspec
-    renamed_record = record.replace("itc_predictions", "image")
-    hyperspec_path = lookup_and_convert(shapefile=renamed_record, rgb_pool=rgb_pool, hyperspectral_pool=hyperspectral_pool, savedir=att.config["hyperspectral_tif_dir"])
-    
-    rgb_path = find_sensor_path(shapefile=renamed_record, lookup_pool=rgb_pool)
-    
-    #infer site
-    site = site_from_path(renamed_record)
-    numeric_site = site_label_dict[site] 
-    
-    domain = domain_from_path(renamed_record)
-    numeric_domain = domain_label_dict[domain] 
-    
-    #infer elevation
-    h5_path = find_sensor_path(shapefile=renamed_record, lookup_pool=hyperspectral_pool)    
-    elevation = elevation_from_tile(h5_path)
-    
-    #Generate record when complete   
-    df = pd.read_csv(record)
-    
-    # hot fix the heights for the moment.
-    heights = np.repeat(10, df.shape[0])
-    
-    tfrecords = att.generate(
-        csv_file=record,
-        HSI_sensor_path=hyperspec_path,
-        RGB_sensor_path=rgb_path,
-        chunk_size=500,
-        train=True,
-        domain=numeric_domain,
-        site=numeric_site,
-        heights=heights,
-        elevation=elevation,
-        label_column="filtered_taxonID",
-        species_label_dict=species_label_dict
-    )
-    
-    return tfrecords
-    
-train_tfrecords = []
-for record in records_to_run:
-    future = client.submit(run, record=record)
-    train_tfrecords.append(future)
-    
-wait(train_tfrecords)
-for x in train_tfrecords:
-    try:
-        print(x.result())
-    except Exception as e:
-        print("{} failed with {}".format(x, e))
-        pass
-        
+#Build the sensor lookup and label dicts once and generate tiles in parallel
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+config = parse_yaml("/home/b.weinstein/DeepTreeAttention/conf/tree_config.yml")
+context = driver.create_context(
+    config,
+    species_classes_file="{}/data/processed/species_class_labels.csv".format(ROOT),
+    site_classes_file="{}/data/processed/site_class_labels.csv".format(ROOT),
+    domain_classes_file="{}/data/processed/domain_class_labels.csv".format(ROOT))
+
+summary = driver.run(records_to_run, context, client=client, label_column="filtered_taxonID", chunk_size=500, summary_path="/orange/idtrees-collab/DeepTreeAttention/tfrecords/pretraining_summary.json")
@@ -0,0 +1,23 @@
+#Generate tfrecords from crown csv files on a single workstation, no SLURM needed
+import glob
+import os
+import sys
+
+from DeepTreeAttention.generators import driver
+from DeepTreeAttention.utils.config import parse_yaml
+
+if __name__ == "__main__":
+    ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    config = parse_yaml("{}/conf/tree_config.yml".format(ROOT))
+
+    #Usage: python generate_local.py "<glob of crown csv files>" <workers>
+    records = glob.glob(sys.argv[1])
+    workers = int(sys.argv[2])
+
+    context = driver.create_context(
+        config,
+        species_classes_file="{}/data/processed/species_class_labels.csv".format(ROOT),
+        site_classes_file="{}/data/processed/site_class_labels.csv".format(ROOT),
+        domain_classes_file="{}/data/processed/domain_class_labels.csv".format(ROOT))
+
+    driver.run(records, context, workers=workers, summary_path=os.path.join(config["train"]["tfrecords"], "summary.json"))
@@ -1,5 +1,4 @@
 #Convert NEON field sample points into bounding boxes of cropped image data for model training
-import cv2
 import os
 import glob
 import sys
@@ -14,32 +13,18 @@ import traceback
 
 from matplotlib import pyplot
 from DeepTreeAttention.generators.boxes import write_tfrecord
-from DeepTreeAttention.utils.paths import find_sensor_path, convert_h5
+from DeepTreeAttention.generators.preprocess import resize, preprocess_crops
+from DeepTreeAttention.utils.paths import find_sensor_path, convert_h5, sensor_index
 from DeepTreeAttention.utils.config import parse_yaml
+from DeepTreeAttention.utils.Hyperspectral import open_raster
 from DeepTreeAttention.utils import start_cluster
-from DeepTreeAttention.generators import create_training_shp
+from DeepTreeAttention.generators import create_training_shp, driver
 from DeepTreeAttention import __file__ as ROOT
 from distributed import wait
 from random import randint
 from time import sleep
 
 
-def normalize(image):
-    """normalize a 3d numoy array simiiar to tf.image.per_image_standardization"""
-    mean = image.mean()
-    stddev = image.std()
-    adjusted_stddev = max(stddev, 1.0/math.sqrt(image.size))
-    standardized_image = (image - mean) / adjusted_stddev
-    
-    return standardized_image
-    
-def resize(img, height, width):
-    # resize image
-    dim = (width, height)    
-    resized = cv2.resize(img, dim, interpolation = cv2.INTER_NEAREST)
-    
-    return resized
-
 def predict_trees(deepforest_model, rgb_path, bounds, expand=10):
     """Predict an rgb path at specific utm bounds
     Args:
@@ -198,7 +183,7 @@ def crop_image(sensor_path, box, expand=0):
     """
     #Read data and mask
     try:    
-        src = rasterio.open(sensor_path)
+        src = open_raster(sensor_path)
         left, bottom, right, top = box.bounds
         window=rasterio.windows.from_bounds(left-expand, bottom-expand, right+expand, top+expand, transform=src.transform)
         masked_image = src.read(window=window)
@@ -215,13 +200,15 @@ def crop_image(sensor_path, box, expand=0):
     
     return masked_image
 
-def create_crops(merged_boxes, hyperspectral_pool=None, rgb_pool=None, sensor="hyperspectral", expand=0, hyperspectral_savedir="."):
+def create_crops(merged_boxes, hyperspectral_pool=None, rgb_pool=None, sensor="hyperspectral", expand=0, hyperspectral_savedir=".", hyperspectral_tif_options=None, conversion_cache=None):
     """Crop sensor data based on a dataframe of geopandas bounding boxes
     Args:
     merged_boxes: geopandas dataframe with bounding box geometry, plotID, siteID, and species label
         hyperspectral_pool: glob string for looking up matching sensor tiles
         expand: units in meters to add to crops to give context around deepforest box
-        hyperspectral_savedir: location to save convert .tif from .h5 files
+        hyperspectral_savedir: location to save convert .tif from .h5 files, None crops the .h5 files directly
+        hyperspectral_tif_options: GeoTIFF layout of converted tiles, see Hyperspectral.creation_options
+        conversion_cache: optional cache.ConversionCache of converted tiles shared by the workers
     Returns:
         crops: list of cropped sensor data
         labels: species id labels
@@ -260,7 +247,11 @@ def create_crops(merged_boxes, hyperspectral_pool=None, rgb_pool=None, sensor="h
             except:
                 raise ValueError("Cannot find hyperspectral data path for box bounds {} for plot_name {}".format(box.bounds,plot_name))
                 
-            sensor_path = convert_h5(hyperspectral_h5_path, rgb_path, savedir=hyperspectral_savedir)
+            #Crop the .h5 directly unless a directory for converted tiles is given
+            if hyperspectral_savedir is None:
+                sensor_path = hyperspectral_h5_path
+            else:
+                sensor_path = convert_h5(hyperspectral_h5_path, rgb_path, savedir=hyperspectral_savedir, options=hyperspectral_tif_options, conversion_cache=conversion_cache)
         
         crop = crop_image(sensor_path=sensor_path, box=box, expand=expand)
         
@@ -274,7 +265,7 @@ def create_crops(merged_boxes, hyperspectral_pool=None, rgb_pool=None, sensor="h
         
     return crops, labels, domains, sites, heights, elevations, box_index
 
-def create_records(HSI_crops, RGB_crops, labels, domains, sites, heights, elevations, box_index, savedir, RGB_size, HSI_size, classes, number_of_domains, number_of_sites, chunk_size=400):
+def create_records(HSI_crops, RGB_crops, labels, domains, sites, heights, elevations, box_index, savedir, RGB_size, HSI_size, classes, number_of_domains, number_of_sites, chunk_size=400, encoding="float32"):
     #get keys and divide into chunks for a single tfrecor
     filenames = []
     counter = 0
@@ -287,12 +278,14 @@ def create_records(HSI_crops, RGB_crops, labels, domains, sites, heights, elevat
         chunk_sites = sites[i:i + chunk_size]
         chunk_elevations = elevations[i:i + chunk_size]
         chunk_heights = heights[i:i + chunk_size]
+        
+        if len(chunk_HSI_crops) == 0:
+            continue
             
-        resized_RGB_crops = [resize(x, RGB_size, RGB_size).astype(np.float32) for x in chunk_RGB_crops]
-        resized_HSI_crops = [resize(x, HSI_size, HSI_size).astype(np.float32) for x in chunk_HSI_crops]
+        resized_RGB_crops = preprocess_crops(chunk_RGB_crops, RGB_size, RGB_size, normalize=False)
         
         #Normalize HSI
-        resized_HSI_crops = [normalize(x) for x in resized_HSI_crops]
+        resized_HSI_crops = preprocess_crops(chunk_HSI_crops, HSI_size, HSI_size, normalize=True)
         
         filename = "{}/field_data_{}.tfrecord".format(savedir, counter)
         write_tfrecord(
@@ -307,14 +300,15 @@ def create_records(HSI_crops, RGB_crops, labels, domains, sites, heights, elevat
             indices=chunk_index,
             number_of_domains=number_of_domains,
             number_of_sites=number_of_sites,
-            classes=classes)
+            classes=classes,
+            encoding=encoding)
         
         filenames.append(filename)
         counter +=1    
     
     return filenames
 
-def run(plot, df, rgb_pool=None, hyperspectral_pool=None, extend_HSI_box=0, extend_RGB_box=0, hyperspectral_savedir=".", saved_model=None, deepforest_model=None):
+def run(plot, df, rgb_pool=None, hyperspectral_pool=None, extend_HSI_box=0, extend_RGB_box=0, hyperspectral_savedir=".", saved_model=None, deepforest_model=None, hyperspectral_tif_options=None, conversion_cache=None):
     """wrapper function for dask, see main.py"""
     from deepforest import deepforest
 
@@ -341,7 +335,9 @@ def run(plot, df, rgb_pool=None, hyperspectral_pool=None, extend_HSI_box=0, exte
         rgb_pool=rgb_pool,
         sensor="hyperspectral",
         expand=extend_HSI_box,
-        hyperspectral_savedir=hyperspectral_savedir)
+        hyperspectral_savedir=hyperspectral_savedir,
+        hyperspectral_tif_options=hyperspectral_tif_options,
+        conversion_cache=conversion_cache)
     
     #Crop RGB, drop repeated elements, leave one for testing
     plot_rgb_crops, plot_rgb_labels, _, _, _, _, _ = create_crops(
@@ -350,7 +346,9 @@ def run(plot, df, rgb_pool=None, hyperspectral_pool=None, extend_HSI_box=0, exte
         rgb_pool=rgb_pool,
         sensor="rgb",
         expand=extend_RGB_box,
-        hyperspectral_savedir=hyperspectral_savedir)    
+        hyperspectral_savedir=hyperspectral_savedir,
+        hyperspectral_tif_options=hyperspectral_tif_options,
+        conversion_cache=conversion_cache)    
     
     #Assert they are the same
     assert len(plot_rgb_crops) == len(plot_HSI_crops)
@@ -374,7 +372,11 @@ def main(
     species_classes_file=None,
     site_classes_file=None,
     domain_classes_file=None,     
-    shuffle=True):
+    shuffle=True,
+    encoding="float32",
+    sensor_catalog=None,
+    hyperspectral_tif_options=None,
+    conversion_cache=None):
     """Prepare NEON field data into tfrecords
     Args:
         field_data: shp file with location and class of each field collected point
@@ -383,19 +385,24 @@ def main(
         savedir: direcory to save completed tfrecords
         extend_HSI_box: units in meters to add to the edge of a predicted box to give more context
         extend_RGB_box: units in meters to add to the edge of a predicted box to give more context
-        hyperspectral_savedir: location to save converted .h5 to .tif
+        hyperspectral_savedir: location to save converted .h5 to .tif, None crops the .h5 files directly
         client: dask client object to use
         species_classes_file: optional path to a two column csv file with index and species labels
         site_classes_file: optional path to a two column csv file with index and site labels
         shuffle: shuffle lists before writing
+        encoding: storage of crops in tfrecords, see boxes.create_record
+        sensor_catalog: optional sensor catalog to search instead of globbing, see utils/catalog.py
+        hyperspectral_tif_options: GeoTIFF layout of converted tiles, see Hyperspectral.creation_options
+        conversion_cache: optional cache.ConversionCache of converted tiles shared by the workers
     Returns:
         tfrecords: list of created tfrecords
     """ 
     df = gpd.read_file(field_data)
     plot_names = df.plotID.unique()
     
-    hyperspectral_pool = glob.glob(hyperspectral_dir, recursive=True)
-    rgb_pool = glob.glob(rgb_dir, recursive=True)
+    #Index the sensor pools once, lookups per crown are then a dict access
+    hyperspectral_pool = sensor_index(hyperspectral_dir, sensor_catalog)
+    rgb_pool = sensor_index(rgb_dir, sensor_catalog)
     
     labels = []
     HSI_crops = []
@@ -406,6 +413,8 @@ def main(
     elevations = []
     heights = []
     if client is not None:
+        #Send the indexes to the workers once instead of with every task
+        rgb_pool, hyperspectral_pool = client.scatter([rgb_pool, hyperspectral_pool], broadcast=True)
         futures = []
         for plot in plot_names:
             future = client.submit(
@@ -417,6 +426,8 @@ def main(
                 extend_HSI_box=extend_HSI_box,
                 extend_RGB_box=extend_RGB_box,                
                 hyperspectral_savedir=hyperspectral_savedir,
+                hyperspectral_tif_options=hyperspectral_tif_options,
+                conversion_cache=conversion_cache,
                 saved_model=saved_model
             )
             futures.append(future)
@@ -452,6 +463,8 @@ def main(
                     extend_HSI_box=extend_HSI_box,
                     extend_RGB_box=extend_RGB_box,   
                     hyperspectral_savedir=hyperspectral_savedir,
+                    hyperspectral_tif_options=hyperspectral_tif_options,
+                    conversion_cache=conversion_cache,
                     saved_model=saved_model,
                     deepforest_model=deepforest_model
                 )
@@ -541,7 +554,8 @@ def main(
         heights=heights,
         RGB_size=RGB_size,
         HSI_size=HSI_size, 
-        chunk_size=chunk_size)
+        chunk_size=chunk_size,
+        encoding=encoding)
     
     return tfrecords
     
@@ -559,7 +573,7 @@ if __name__ == "__main__":
     #client = None
     
     #Create train test split
-    create_training_shp.train_test_split(ROOT, lookup_glob, n=config["train"]["resampled_per_taxa"], client=client, regenerate=False)
+    create_training_shp.train_test_split(ROOT, lookup_glob, n=config["train"]["resampled_per_taxa"], client=client, regenerate=False, catalog_path=config["sensor_catalog"], cache_dir="{}/data/interim".format(ROOT))
     
 
     #test data
@@ -571,12 +585,16 @@ if __name__ == "__main__":
         rgb_dir=config["rgb_sensor_pool"],
         extend_HSI_box = config["train"]["HSI"]["extend_box"],
         extend_RGB_box = config["train"]["RGB"]["extend_box"],        
-        hyperspectral_savedir=config["hyperspectral_tif_dir"],
+        hyperspectral_savedir=config["hyperspectral_tif_dir"] if config["convert_h5"] else None,
         savedir=config["evaluation"]["tfrecords"],
         species_classes_file = "{}/data/processed/species_class_labels.csv".format(ROOT),
         domain_classes_file = "{}/data/processed/domain_class_labels.csv".format(ROOT),             
         site_classes_file =  "{}/data/processed/site_class_labels.csv".format(ROOT),        
         client=client,
+        encoding=config["train"]["tfrecord_encoding"],
+        sensor_catalog=config["sensor_catalog"],
+        hyperspectral_tif_options=config["hyperspectral_tif_options"],
+        conversion_cache=driver.conversion_cache(config),
         saved_model="/home/b.weinstein/miniconda3/envs/DeepTreeAttention_DeepForest/lib/python3.7/site-packages/deepforest/data/NEON.h5"
     )
     
@@ -593,9 +611,13 @@ if __name__ == "__main__":
         rgb_dir=config["rgb_sensor_pool"],
         extend_HSI_box = config["train"]["HSI"]["extend_box"],
         extend_RGB_box = config["train"]["RGB"]["extend_box"],     
-        hyperspectral_savedir=config["hyperspectral_tif_dir"],
+        hyperspectral_savedir=config["hyperspectral_tif_dir"] if config["convert_h5"] else None,
         savedir=config["train"]["tfrecords"],
         client=client,
+        encoding=config["train"]["tfrecord_encoding"],
+        sensor_catalog=config["sensor_catalog"],
+        hyperspectral_tif_options=config["hyperspectral_tif_options"],
+        conversion_cache=driver.conversion_cache(config),
         species_classes_file = "{}/data/processed/species_class_labels.csv".format(ROOT),
         site_classes_file =  "{}/data/processed/site_class_labels.csv".format(ROOT),     
         domain_classes_file = "{}/data/processed/domain_class_labels.csv".format(ROOT),     
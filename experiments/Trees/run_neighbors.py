@@ -13,6 +13,8 @@ from DeepTreeAttention.trees import AttentionModel
 from DeepTreeAttention import __file__ as ROOT
 from DeepTreeAttention.models.layers import WeightedSum
 from DeepTreeAttention.generators import neighbors
+from DeepTreeAttention.utils.paths import sensor_index
+from DeepTreeAttention.utils import cache
 
 sleep(randint(0,20))
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -30,7 +32,13 @@ experiment.log_parameter("log_dir",save_dir)
 model = AttentionModel(config="/home/b.weinstein/DeepTreeAttention/conf/tree_config.yml", log_dir=save_dir)
 model.create()
 model.ensemble_model = tfk.models.load_model("{}/Ensemble.h5".format(model.config["neighbors"]["model_dir"]), custom_objects={"WeightedSum":WeightedSum})
-hyperspectral_pool = glob.glob(model.config["hyperspectral_sensor_pool"], recursive=True)
+hyperspectral_pool = sensor_index(model.config["hyperspectral_sensor_pool"], model.config["sensor_catalog"])
+
+#Neighbor embeddings of this model are computed once and reused across runs
+HSI_size = model.config["train"]["HSI"]["crop_size"]
+store = None
+if model.config["neighbors"]["embedding_store"]:
+    store = cache.EmbeddingStore(model.config["neighbors"]["embedding_store"], cache.model_hash(model.ensemble_model, HSI_size=HSI_size))
 
 #Load field data
 ROOT = os.path.dirname(os.path.dirname(ROOT))
@@ -52,11 +60,13 @@ domain_label_dict = domain_classdf.set_index("domainID").label.to_dict()
 train_ids = train.individual.unique()
 train_dict = {}
 for x in train_ids:
-    train_dict[x] = neighbors.extract_features(df=train, x=x, model=model, hyperspectral_pool=hyperspectral_pool, site_label_dict=site_label_dict, domain_label_dict=domain_label_dict)
+    train_dict[x] = neighbors.extract_features(df=train, x=x, model_class=model, hyperspectral_pool=hyperspectral_pool, site_label_dict=site_label_dict, domain_label_dict=domain_label_dict, HSI_size=HSI_size, store=store)
     
 #Test - unique ids
 test_ids = test.individual.unique()
 test_dict = {}
 for x in test_ids:
-    test_dict[x] = neighbors.extract_features(df=test, x=x, model=model, hyperspectral_pool=hyperspectral_pool, site_label_dict=site_label_dict, domain_label_dict=domain_label_dict)
+    test_dict[x] = neighbors.extract_features(df=test, x=x, model_class=model, hyperspectral_pool=hyperspectral_pool, site_label_dict=site_label_dict, domain_label_dict=domain_label_dict, HSI_size=HSI_size, store=store)
 
+if store is not None:
+    print("Embedding store: {}".format(store.stats()))
@@ -0,0 +1,21 @@
+#Re-shard the training tfrecords into globally shuffled shards. Point train: tfrecords in the config at the new directory to train from the shards.
+import glob
+import os
+import sys
+
+from DeepTreeAttention.generators import shard
+from DeepTreeAttention.utils.config import parse_yaml
+
+if __name__ == "__main__":
+    ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    config = parse_yaml("{}/conf/tree_config.yml".format(ROOT))
+
+    #Usage: python shard_records.py <savedir> <n_shards>
+    savedir = sys.argv[1]
+    n_shards = int(sys.argv[2])
+
+    tfrecords = glob.glob(os.path.join(config["train"]["tfrecords"], "*.tfrecord"))
+    shards = shard.shard_records(tfrecords, savedir=savedir, n_shards=n_shards)
+
+    manifest = shard.read_manifest(savedir)
+    print("Wrote {} records from {} files into {} shards".format(manifest["n_records"], len(tfrecords), len(shards)))
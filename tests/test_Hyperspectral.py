@@ -0,0 +1,116 @@
+#test hyperspectral h5 conversion
+import os
+import geopandas as gpd
+import h5py
+import numpy as np
+import pytest
+import rasterio
+
+from shapely.geometry import box
+
+from DeepTreeAttention.generators.crops import crop_image, crop_images
+from DeepTreeAttention.utils import Hyperspectral, cache, paths
+
+rgb_path = "data/raw/2019_BART_5_320000_4881000_image_crop.tif"
+
+@pytest.fixture()
+def h5_path(tmpdir):
+    """A small NEON style reflectance tile around the RGB crop"""
+    path = "{}/NEON_D01_BART_DP3_320000_4881000_reflectance.h5".format(tmpdir)
+    reflectance = np.random.randint(0, 10000, size=(120, 150, 426)).astype(np.int16)
+    with h5py.File(path, "w") as f:
+        refl = f.create_group("BART/Reflectance")
+        data = refl.create_dataset("Reflectance_Data", data=reflectance, chunks=(40, 50, 426))
+        data.attrs["Data_Ignore_Value"] = -9999
+        data.attrs["Scale_Factor"] = 10000
+        refl.create_dataset("Metadata/Coordinate_System/Map_Info", data=b"UTM,  1.000,  1.000,  320200.00,  4881620.00,  1.0000000000e+00,  1.0000000000e+00,  19,  North,  WGS-84,  units=Meters, 0")
+        refl.create_dataset("Metadata/Spectral_Data/Wavelength", data=np.linspace(380, 2510, 426))
+
+    return path
+
+def test_band_indices():
+    assert len(Hyperspectral.band_indices("All")) == 369
+    assert len(Hyperspectral.band_indices()) == 426
+    with pytest.raises(ValueError):
+        Hyperspectral.band_indices("RGB")
+
+def test_generate_raster(tmpdir, h5_path):
+    tilename = Hyperspectral.generate_raster(h5_path=h5_path, save_dir=tmpdir, rgb_filename=rgb_path, bands="All", block_rows=32)
+    assert tilename == "2019_BART_5_320000_4881000_image_crop_hyperspectral.tif"
+
+    #Same pixels as clipping the full array in memory
+    metadata, refl = Hyperspectral.h5refl2array(h5_path, epsg=32619)
+    with rasterio.open(rgb_path) as src:
+        bounds = src.bounds
+    clipExtent = {"xMin": bounds.left, "xMax": bounds.right, "yMin": bounds.bottom, "yMax": bounds.top}
+    subInd = Hyperspectral.calc_clip_index(clipExtent, metadata["ext_dict"])
+    expected = refl[subInd["yMin"]:subInd["yMax"], subInd["xMin"]:subInd["xMax"], Hyperspectral.band_indices("All")]
+
+    with rasterio.open("{}/{}".format(tmpdir, tilename)) as src:
+        assert src.count == 369
+        assert src.crs.to_epsg() == 32619
+        assert src.profile["tiled"]
+        assert src.transform.c == metadata["ext_dict"]["xMin"] + subInd["xMin"]
+        assert src.transform.f == metadata["ext_dict"]["yMax"] - subInd["yMin"]
+        np.testing.assert_array_equal(np.moveaxis(src.read(), 0, 2), expected)
+
+def test_creation_options(tmpdir, h5_path):
+    with pytest.raises(ValueError):
+        Hyperspectral.creation_options({"compression": "deflate"})
+    with pytest.raises(ValueError):
+        Hyperspectral.creation_options({"blocksize": 100})
+
+    options = {"interleave": "pixel", "blocksize": 64, "compress": "deflate", "predictor": 2, "overviews": [2]}
+    tilename = Hyperspectral.generate_raster(h5_path=h5_path, save_dir=tmpdir, rgb_filename=rgb_path, bands="All", block_rows=32, options=options)
+    with rasterio.open("{}/{}".format(tmpdir, tilename)) as src:
+        assert src.block_shapes[0] == (64, 64)
+        assert src.interleaving.value == "PIXEL"
+        assert src.compression.value == "DEFLATE"
+        assert src.overviews(1) == [2]
+        compressed = src.read()
+
+    os.mkdir("{}/plain".format(tmpdir))
+    Hyperspectral.generate_raster(h5_path=h5_path, save_dir="{}/plain".format(tmpdir), rgb_filename=rgb_path, bands="All")
+    with rasterio.open("{}/plain/{}".format(tmpdir, tilename)) as src:
+        np.testing.assert_array_equal(src.read(), compressed)
+
+def test_H5Raster(tmpdir, h5_path):
+    tilename = Hyperspectral.generate_raster(h5_path=h5_path, save_dir=tmpdir, rgb_filename=rgb_path, bands="All")
+    boxes = gpd.GeoDataFrame(geometry=[box(320220.3, 4881520.6, 320240.1, 4881541.2), box(320300, 4881590, 320310.5, 4881600.5), box(320250.2, 4881560.7, 320251.4, 4881561.9)])
+
+    #Crops read from the h5 match crops read from the converted tile
+    with rasterio.open("{}/{}".format(tmpdir, tilename)) as src, Hyperspectral.H5Raster(h5_path, bands="All") as h5_src:
+        assert h5_src.count == src.count
+        assert h5_src.block_shapes[0] == (40, 50)
+        for geometry in boxes.geometry:
+            np.testing.assert_array_equal(crop_image(h5_src, geometry), crop_image(src, geometry))
+
+        h5_crops, stats = crop_images(h5_src, boxes)
+        #Each box is its own hyperslab read
+        assert stats["reads"] == 3
+        tif_crops, stats = crop_images(src, boxes)
+        for index in boxes.index:
+            np.testing.assert_array_equal(h5_crops[index], tif_crops[index])
+
+def test_open_raster(h5_path):
+    src = Hyperspectral.open_raster(h5_path, bands="false_color")
+    assert isinstance(src, Hyperspectral.H5Raster)
+    assert src.read().shape == (3, 120, 150)
+    src.close()
+
+    with Hyperspectral.open_raster(rgb_path) as src:
+        assert src.count == 3
+
+def test_convert_h5_cache(tmpdir, h5_path):
+    conversion_cache = cache.ConversionCache("{}/tiles".format(tmpdir))
+    tif_path = paths.convert_h5(h5_path, rgb_path, savedir=None, conversion_cache=conversion_cache)
+    assert paths.convert_h5(h5_path, rgb_path, savedir=None, conversion_cache=conversion_cache) == tif_path
+    assert conversion_cache.stats()["misses"] == 1
+    assert conversion_cache.stats()["hits"] == 1
+    with rasterio.open(tif_path) as src:
+        assert src.count == 369
+
+    #Without a cache, the tile is named after the RGB tile
+    tif_path = paths.convert_h5(h5_path, rgb_path, savedir=str(tmpdir))
+    assert os.path.basename(tif_path) == "2019_BART_5_320000_4881000_image_crop_hyperspectral.tif"
+    assert not [x for x in os.listdir(str(tmpdir)) if x.endswith(".tmp")]
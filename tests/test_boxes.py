@@ -3,7 +3,9 @@ import pytest
 import os
 import geopandas as gpd
 import numpy as np
+import rasterio
 import tensorflow as tf
+import threading
 
 from DeepTreeAttention.generators import boxes
 from DeepTreeAttention.models import Hang2020_geographic, metadata
@@ -16,6 +18,27 @@ test_sensor_tile = "data/raw/2019_BART_5_320000_4881000_image_crop.tif"
 
 test_hsi_tile = "data/raw/2019_BART_5_320000_4881000_image_hyperspectral_crop.tif"
 
+def write_records(filename, n, encoding="float32", HSI_shape=(20,20,369), RGB_shape=(100,100,3), **overrides):
+    """Write n random records to a tfrecord, keyword arguments replace the default write_tfrecord arguments"""
+    arguments = dict(
+        filename=filename,
+        HSI_images=np.random.normal(size=(n,) + HSI_shape).astype(np.float32),
+        RGB_images=np.random.randint(0, 255, size=(n,) + RGB_shape).astype(np.float32),
+        domains=[1]*n,
+        sites=[1]*n,
+        elevations=[100.0]*n,
+        heights=[10.0]*n,
+        indices=np.arange(n),
+        labels=[x % 2 for x in range(n)],
+        number_of_domains=10,
+        number_of_sites=10,
+        classes=2,
+        encoding=encoding)
+    arguments.update(overrides)
+    boxes.write_tfrecord(**arguments)
+    
+    return arguments
+
 @pytest.fixture()
 def ensemble_model():
     sensor_inputs, sensor_outputs, spatial, spectral = Hang2020_geographic.define_model(classes=2, height=20, width=20, channels=369)    
@@ -71,6 +94,190 @@ def test_generate_records(tmpdir, ensemble_model):
     )
     
     assert len(created_records) > 0 
+
+def test_generate_records_streaming(tmpdir):
+    #Each chunk is written as soon as it is cropped, no neighbor features without an ensemble model
+    shp = gpd.read_file(test_predictions)    
+    created_records = boxes.generate_tfrecords(
+        shapefile=test_predictions,
+        domain=1,
+        site = 1,
+        heights=np.random.random(shp.shape[0])*10,        
+        elevation=100.0,
+        savedir=tmpdir,
+        HSI_sensor_path=test_hsi_tile,
+        RGB_sensor_path=test_sensor_tile,
+        species_label_dict=None,
+        RGB_size=100,
+        HSI_size=20,
+        classes=6,
+        number_of_sites=10,
+        number_of_domains=10,
+        chunk_size=3
+    )
+    
+    assert len(created_records) == np.ceil(shp.shape[0]/3)
+    
+    records_per_file = [sum(1 for x in tf.data.TFRecordDataset(x)) for x in created_records]
+    assert max(records_per_file) <= 3
+    assert sum(records_per_file) == shp.shape[0]
+    
+def test_crop_cache():
+    shp = gpd.read_file(test_predictions)
+    src = rasterio.open(test_sensor_tile)
+    crop_cache = boxes.CropCache()
+    crops = crop_cache.crop(src, shp.head(6), size=20)
+    
+    #Overlapping requests only read the new boxes
+    crops.update(crop_cache.crop(src, shp.iloc[4:], size=20))
+    stats = crop_cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == shp.shape[0]
+    assert stats["bytes_saved"] > 0
+    assert crop_cache.read_stats["crowns_served"] == shp.shape[0]
+    for index, row in shp.iterrows():
+        expected = boxes.preprocess_crops([boxes.crop_image(src, row["geometry"])], 20, 20, normalize=False)[0]
+        np.testing.assert_array_equal(crops[index], expected)
+    
+    #The least recently used crops are dropped above the size limit
+    crop_cache = boxes.CropCache(max_bytes=2 * crops[0].nbytes)
+    crop_cache.crop(src, shp.head(3), size=20)
+    assert len(crop_cache.crops) == 2
+    crop_cache.crop(src, shp.head(1), size=20)
+    assert crop_cache.stats()["hits"] == 0
+    
+    #Expanded target crops and neighbor crops share reads
+    crop_cache = boxes.CropCache(expands=(0.5, 0))
+    targets = crop_cache.crop(src, shp, expand=0.5, size=20)
+    reads = crop_cache.read_stats["reads"]
+    neighbors = crop_cache.crop(src, shp, size=20)
+    assert crop_cache.stats()["hits"] == shp.shape[0]
+    assert crop_cache.read_stats["reads"] == reads
+    for index, row in shp.iterrows():
+        np.testing.assert_array_equal(targets[index], boxes.preprocess_crops([boxes.crop_image(src, row["geometry"], expand=0.5)], 20, 20, normalize=False)[0])
+        np.testing.assert_array_equal(neighbors[index], crops[index])
+    
+    #A box requested twice is counted once
+    crop_cache = boxes.CropCache()
+    crop_cache.crop(src, shp.iloc[[0, 0]], size=20)
+    assert crop_cache.bytes == crops[0].nbytes
+    
+@pytest.mark.parametrize("encoding",["float32","float16","uint16"])
+def test_record_encoding(tmpdir, encoding):
+    #Compact encodings decode to the written crops within quantization error, mixed schemas are read together
+    HSI_images = np.random.normal(size=(2,20,20,369)).astype(np.float32)
+    RGB_images = np.random.randint(0, 255, size=(2,100,100,3)).astype(np.float32)
+    
+    filenames = []
+    for file_encoding in ["float32", encoding]:
+        filename = "{}/{}.tfrecord".format(tmpdir, len(filenames))
+        write_records(filename, 2, encoding=file_encoding, HSI_images=HSI_images, RGB_images=RGB_images)
+        filenames.append(filename)
+    
+    assert boxes.record_schema(filenames[1])["HSI_encoding"] == encoding
+    
+    dataset = boxes.tf_dataset(filenames[1], mode="HSI", batch_size=2, shuffle=False, augmentation=False)
+    for data, label in dataset.take(1):
+        np.testing.assert_allclose(data.numpy(), HSI_images, atol=0.01)
+    
+    dataset = boxes.tf_dataset(filenames, mode="RGB", batch_size=4, shuffle=False, augmentation=False)
+    for data, label in dataset.take(1):
+        assert data.shape == (4,100,100,3)
+        np.testing.assert_allclose(data.numpy(), RGB_images[np.argmax(label, axis=1)], atol=0.5)
+    
+def test_mixed_schema_shuffle(tmpdir):
+    #Files with different schemas are interleaved when shuffling instead of read one schema after another
+    filenames = []
+    for label, encoding in enumerate(["float32", "float16"]):
+        filename = "{}/{}.tfrecord".format(tmpdir, encoding)
+        write_records(filename, 30, encoding=encoding, labels=[label]*30)
+        filenames.append(filename)
+    
+    dataset = boxes.tf_dataset(filenames, mode="metadata", batch_size=60, shuffle=True, augmentation=False)
+    labels = np.concatenate([np.argmax(label.numpy(), axis=1) for data, label in dataset])
+    assert len(labels) == 60
+    assert not (np.all(labels[:30] == labels[0]) and np.all(labels[30:] == labels[-1]))
+    
+@pytest.mark.parametrize("mode",["HSI","ensemble","metadata"])
+def test_batch_parse(tmpdir, mode):
+    #Parsing batches of serialized records yields the same batches as parsing one record at a time
+    filename = "{}/batch.tfrecord".format(tmpdir)
+    write_records(filename, 5, encoding="uint16", domains=[1,2,3,4,5], sites=[1,2,3,4,5], elevations=np.random.random(5), heights=np.random.random(5))
+    
+    single = boxes.tf_dataset(filename, mode=mode, batch_size=2, shuffle=False, augmentation=False)
+    batched = boxes.tf_dataset(filename, mode=mode, batch_size=2, shuffle=False, augmentation=False, batch_parse=True)
+    
+    single = tf.nest.flatten(list(single))
+    batched = tf.nest.flatten(list(batched))
+    assert len(single) == len(batched)
+    for x, y in zip(single, batched):
+        np.testing.assert_array_equal(x.numpy(), y.numpy())
+    
+def test_ids_aligned(tmpdir):
+    #Box ids are parsed with the data, so they match under shuffle, interleaved reads and augmentation
+    filenames = []
+    for x in range(3):
+        indices = np.arange(x*4, (x+1)*4)
+        filename = "{}/aligned_{}.tfrecord".format(tmpdir, x)
+        write_records(filename, 4, indices=indices, labels=[0]*4,
+                      HSI_images=np.ones((4,20,20,369), dtype=np.float32) * indices[:,None,None,None],
+                      RGB_images=np.ones((4,100,100,3), dtype=np.float32) * indices[:,None,None,None])
+        filenames.append(filename)
+    
+    dataset = boxes.tf_dataset(filenames, mode="RGB", batch_size=5, shuffle=True, augmentation=True, ids=True, cores=3)
+    counter = 0
+    for ids, (data, label) in dataset:
+        np.testing.assert_array_equal(data.numpy()[:,0,0,0], ids.numpy())
+        counter += ids.shape[0]
+    
+    assert counter == 12
+    
+def test_schema_manifest(tmpdir):
+    #Parsers are sized from the directory manifest, so other crop sizes, bands and neighbor counts can be read
+    filename = "{}/small.tfrecord".format(tmpdir)
+    write_records(filename, 3, HSI_shape=(10,10,50), RGB_shape=(40,40,3),
+                  neighbor_arrays=np.random.random((3,3,8)).astype(np.float32), neighbor_distances=np.random.random((3,3)))
+    
+    schema = boxes.read_schema(tmpdir)
+    assert schema["HSI_depth"] == 50
+    assert schema["k_neighbors"] == 3
+    assert boxes.record_schema(filename) == schema
+    
+    dataset = boxes.tf_dataset(filename, mode="neighbors", batch_size=3, shuffle=False)
+    assert dataset.element_spec[0][0].shape[1:] == (10,10,50)
+    for (HSI, neighbor_arrays, elevation, site, domain), label in dataset:
+        assert HSI.shape == (3,10,10,50)
+        assert neighbor_arrays.shape == (3,3,8)
+    
+    #A different schema in the same directory marks it as mixed, each file is then read from its own header
+    write_records("{}/legacy.tfrecord".format(tmpdir), 2, indices=[3,4])
+    
+    assert boxes.read_schema(tmpdir) is None
+    assert boxes.record_schema(filename)["HSI_depth"] == 50
+    
+    dataset = boxes.tf_dataset(["{}/small.tfrecord".format(tmpdir), "{}/legacy.tfrecord".format(tmpdir)], mode="metadata", batch_size=1)
+    assert sum(1 for x in dataset) == 5
+    
+def test_schema_legacy_records(tmpdir):
+    #Records written before manifests existed are checked when a directory gets its first manifest
+    write_records("{}/legacy.tfrecord".format(tmpdir), 2)
+    os.remove("{}/{}".format(tmpdir, boxes.SCHEMA_FILE))
+    write_records("{}/new.tfrecord".format(tmpdir), 2, encoding="float16")
+    assert boxes.read_schema(tmpdir) is None
+    
+    dataset = boxes.tf_dataset(["{}/legacy.tfrecord".format(tmpdir), "{}/new.tfrecord".format(tmpdir)], mode="HSI", batch_size=1, augmentation=False)
+    assert sum(1 for x in dataset) == 4
+    
+    #Parallel writers with different schemas always leave a mixed manifest
+    savedir = "{}/parallel".format(tmpdir)
+    os.mkdir(savedir)
+    schemas = [dict(boxes.LEGACY_SCHEMA, HSI_depth=x % 2) for x in range(16)]
+    threads = [threading.Thread(target=boxes.write_schema, args=(savedir, schema)) for schema in schemas]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert boxes.read_schema(savedir) is None
     
 @pytest.mark.parametrize("train",[True, False])
 def test_tf_dataset(train, created_records):
@@ -0,0 +1,198 @@
+#test on disk dataset cache
+import fcntl
+import os
+import time
+import numpy as np
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from DeepTreeAttention.generators import boxes
+from DeepTreeAttention.utils import cache
+
+def write_records(filename, n=4):
+    boxes.write_tfrecord(
+        filename=filename,
+        HSI_images=np.random.normal(size=(n,20,20,369)).astype(np.float32),
+        RGB_images=np.random.normal(size=(n,100,100,3)).astype(np.float32),
+        domains=[1]*n,
+        sites=[1]*n,
+        elevations=[100.0]*n,
+        heights=[10.0]*n,
+        indices=np.arange(n),
+        labels=[0]*n,
+        number_of_domains=10,
+        number_of_sites=10,
+        classes=2)
+
+    return filename
+
+@pytest.fixture()
+def records(tmpdir):
+    os.mkdir("{}/records".format(tmpdir))
+    return [write_records("{}/records/{}.tfrecord".format(tmpdir, x)) for x in range(2)]
+
+def test_dataset_key(records):
+    schema = boxes.record_schema(records[0])
+    key = cache.dataset_key(records, mode="HSI", schema=schema)
+    assert key == cache.dataset_key(list(reversed(records)), mode="HSI", schema=schema)
+    assert key != cache.dataset_key(records, mode="metadata", schema=schema)
+
+    #Rewriting a record invalidates the key
+    time.sleep(0.01)
+    write_records(records[0], n=2)
+    assert key != cache.dataset_key(records, mode="HSI", schema=schema)
+
+def test_tf_dataset_cache(tmpdir, records):
+    cache_dir = "{}/cache".format(tmpdir)
+    dataset = boxes.tf_dataset(records, mode="metadata", batch_size=2, shuffle=True, cache_dir=cache_dir)
+    first = sum(1 for x in dataset)
+
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 1
+    assert cache.is_complete(os.path.join(cache_dir, entries[0]))
+
+    #A later run reads from the completed cache
+    dataset = boxes.tf_dataset(records, mode="metadata", batch_size=2, shuffle=True, cache_dir=cache_dir)
+    assert sum(1 for x in dataset) == first
+    assert os.listdir(cache_dir) == entries
+
+def test_dataset_cache_writer(tmpdir):
+    #Only one job writes an entry, the others read records directly until it is complete
+    cache_dir = "{}/cache".format(tmpdir)
+    filename = cache.dataset_cache(cache_dir, "key")
+    assert filename is not None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(cache.dataset_cache, cache_dir, "key").result() is None
+
+    #A completed entry is shared
+    open("{}.index".format(filename), "w").close()
+    assert cache.dataset_cache(cache_dir, "key") == filename
+
+def test_tf_dataset_cache_batch_parse(tmpdir):
+    #Cached batches are shuffled by record, not as whole batches
+    os.mkdir("{}/records".format(tmpdir))
+    records = [write_records("{}/records/batch.tfrecord".format(tmpdir), n=40)]
+    dataset = boxes.tf_dataset(records, mode="metadata", batch_size=4, shuffle=True, ids=True, batch_parse=True, cache_dir="{}/cache".format(tmpdir))
+    batches = [ids.numpy() for ids, data in dataset]
+    assert sorted(np.concatenate(batches)) == list(range(40))
+    assert not all([(x // 4 == x[0] // 4).all() for x in batches])
+
+def test_evict(tmpdir, records):
+    cache_dir = "{}/cache".format(tmpdir)
+    for mode in ["metadata", "HSI"]:
+        dataset = boxes.tf_dataset(records, mode=mode, batch_size=2, cache_dir=cache_dir)
+        for x in dataset:
+            pass
+    assert len(os.listdir(cache_dir)) == 2
+
+    #Make the metadata entry the most recently used
+    metadata_key = cache.dataset_key(records, mode="metadata", schema=boxes.record_schema(records[0]))
+    os.utime(os.path.join(cache_dir, metadata_key), (time.time() + 10, time.time() + 10))
+
+    #Only the least recently used entry is removed to fit the limit
+    metadata_size = cache._entry_size(os.path.join(cache_dir, metadata_key))
+    removed = cache.evict(cache_dir, max_bytes=metadata_size)
+    assert len(removed) == 1
+    assert os.listdir(cache_dir) == [metadata_key]
+
+    cache.clear_cache(cache_dir)
+    assert not os.path.exists(cache_dir)
+
+def test_conversion_cache(tmpdir):
+    conversion_cache = cache.ConversionCache("{}/tiles".format(tmpdir), max_bytes=250, grace_seconds=0)
+    created = []
+    def create(filename):
+        #Slow enough that the workers overlap
+        time.sleep(0.2)
+        with open(filename, "w") as f:
+            f.write("x" * 100)
+        created.append(filename)
+
+    #Concurrent workers convert the tile once and all get the complete file
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        paths = list(executor.map(lambda x: conversion_cache.fetch("a", create), range(4)))
+    assert len(created) == 1
+    assert paths == [conversion_cache.path("a")] * 4
+    assert os.path.getsize(paths[0]) == 100
+    assert conversion_cache.stats() == {"hits": 3, "misses": 1, "evictions": 0}
+
+    #The least recently used tile is removed above max_bytes
+    conversion_cache.fetch("b", create)
+    os.utime(conversion_cache.path("a"), (time.time() + 10, time.time() + 10))
+    conversion_cache.fetch("c", create)
+    assert not os.path.exists(conversion_cache.path("b"))
+    assert os.path.exists(conversion_cache.path("a"))
+    assert conversion_cache.stats()["evictions"] == 1
+
+def test_conversion_cache_evict_in_use(tmpdir):
+    conversion_cache = cache.ConversionCache("{}/tiles".format(tmpdir), max_bytes=50)
+    def create(filename):
+        with open(filename, "w") as f:
+            f.write("x" * 100)
+
+    #A tile larger than max_bytes is still returned, and recently used tiles are kept
+    path = conversion_cache.fetch("a", create)
+    assert os.path.exists(path)
+    conversion_cache.fetch("b", create)
+    assert os.path.exists(path)
+    assert conversion_cache.stats()["evictions"] == 0
+
+    #Once the grace window has passed, tiles locked by another worker are kept
+    past = time.time() - 2 * cache.GRACE_SECONDS
+    os.utime(conversion_cache.path("a"), (past, past))
+    os.utime(conversion_cache.path("b"), (past, past))
+    with open("{}.lock".format(conversion_cache.path("a")), "w") as lock:
+        #A worker marking the tile as used holds a shared lock
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        removed = conversion_cache.evict()
+    assert removed == [conversion_cache.path("b")]
+    assert os.path.exists(conversion_cache.path("a"))
+    
+    #Lock files are removed with their tile
+    assert not os.path.exists("{}.lock".format(conversion_cache.path("b")))
+    assert os.path.exists("{}.lock".format(conversion_cache.path("a")))
+    
+    #A tile evicted before it is marked as used is converted again instead of failing
+    assert conversion_cache._hit(conversion_cache.path("b")) is None
+    assert conversion_cache.fetch("b", create) == conversion_cache.path("b")
+    assert conversion_cache.stats()["misses"] == 3
+
+def test_conversion_cache_failure(tmpdir):
+    #A failed conversion leaves nothing behind to be read
+    conversion_cache = cache.ConversionCache("{}/tiles".format(tmpdir))
+    def create(filename):
+        with open(filename, "w") as f:
+            f.write("partial")
+        raise IOError("conversion failed")
+
+    with pytest.raises(IOError):
+        conversion_cache.fetch("a", create)
+    assert [x for x in os.listdir(conversion_cache.cache_dir) if not x.endswith(".lock")] == []
+
+def test_embedding_store(tmpdir):
+    store = cache.EmbeddingStore("{}/embeddings.h5".format(tmpdir), model_key="a")
+    assert store.get(["1", "2"]) == {}
+    
+    store.put([1, 2, 2], np.array([[1, 1], [2, 2], [3, 3]]))
+    assert len(store) == 2
+    found = store.get([2, 3, 1])
+    assert sorted(found) == ["1", "2"]
+    np.testing.assert_array_equal(found["2"], [2, 2])
+    assert store.stats() == {"hits": 2, "misses": 3}
+    
+    #Stored ids are not overwritten and other models do not see them
+    store.put([1], np.array([[9, 9]]))
+    np.testing.assert_array_equal(store.get([1])["1"], [1, 1])
+    assert cache.EmbeddingStore(store.path, model_key="b").get([1, 2]) == {}
+
+def test_model_hash():
+    class Model():
+        def __init__(self, value):
+            self.value = value
+        def get_weights(self):
+            return [np.full((2, 2), self.value, dtype=np.float32)]
+    
+    assert cache.model_hash(Model(1)) == cache.model_hash(Model(1))
+    assert cache.model_hash(Model(1)) != cache.model_hash(Model(2))
+    assert cache.model_hash(Model(1), HSI_size=20) != cache.model_hash(Model(1), HSI_size=40)
@@ -0,0 +1,57 @@
+#test sensor catalog
+import glob
+import os
+import time
+
+from DeepTreeAttention.utils import catalog, paths
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("x")
+
+def test_build_catalog(tmpdir):
+    root = str(tmpdir.mkdir("NeonData"))
+    rgb = os.path.join(root, "BART/DP3.30010.001/2019/FullSite/D01/2019_BART_5/L3/Camera/Mosaic/V01/2019_BART_5_320000_4881000_image.tif")
+    h5 = os.path.join(root, "BART/DP3.30006.001/2019/FullSite/D01/2019_BART_5/L3/Spectrometer/Reflectance/NEON_D01_BART_DP3_320000_4881000_reflectance.h5")
+    touch(rgb)
+    touch(h5)
+    touch(os.path.join(root, "BART/readme.txt"))
+    
+    catalog_path = os.path.join(str(tmpdir), "catalog.sqlite")
+    counts = catalog.build_catalog([root], catalog_path)
+    assert counts["files"] == 2
+    
+    #Glob patterns from the config select paths from the catalog
+    pattern = os.path.join(root, "**/Reflectance/*.h5")
+    assert catalog.catalog_paths(catalog_path, pattern) == [h5]
+    
+    index = paths.sensor_index(os.path.join(root, "**/Camera/**/*.tif"), catalog_path)
+    assert index.lookup("320000_4881000") == rgb
+    
+    #A refresh only lists directories that changed
+    counts = catalog.build_catalog([root], catalog_path)
+    assert counts["scanned"] == 0
+    
+    time.sleep(0.01)
+    new_rgb = rgb.replace("320000", "321000")
+    touch(new_rgb)
+    os.remove(h5)
+    counts = catalog.build_catalog([root], catalog_path)
+    assert counts["scanned"] == 2
+    assert counts["files"] == 2
+    assert sorted(catalog.catalog_paths(catalog_path, os.path.join(root, "**/*.tif"))) == sorted([rgb, new_rgb])
+
+def test_catalog_paths_glob(tmpdir):
+    #The catalog returns the same pool as globbing the filesystem
+    root = str(tmpdir.mkdir("NeonData"))
+    for path in ["top.h5", "Reflectance/a.h5", "Reflectance/old/b.h5", "BART/Reflectance/c.h5", "BART/L3/Reflectance/d.h5",
+                 "BART/.hidden/Reflectance/e.h5", "BART/Reflectance/.f.h5", "BART/Camera/2019_BART_5_320000_4881000_image.tif", "a1/b.h5", "ab/c.tif"]:
+        touch(os.path.join(root, path))
+    catalog_path = os.path.join(str(tmpdir), "catalog.sqlite")
+    catalog.build_catalog([root], catalog_path)
+    
+    for pattern in ["**/Reflectance/*.h5", "**/*.h5", "*.h5", "*/*.h5", "**", "BART/**/*.tif", "a?/[bc]*", "a[!b]/*", "**/.*.h5"]:
+        pattern = os.path.join(root, pattern)
+        expected = [x for x in glob.glob(pattern, recursive=True) if os.path.isfile(x)]
+        assert sorted(catalog.catalog_paths(catalog_path, pattern)) == sorted(expected), pattern
@@ -1,6 +1,12 @@
 from DeepTreeAttention.generators import create_training_shp
+import geopandas as gpd
+import numpy as np
 import os
+import pandas as pd
 import pytest
+import rasterstats
+
+from shapely.geometry import Point
 
 @pytest.fixture()
 def testdata():
@@ -13,4 +19,96 @@ def testdata():
     return shp
     
 def test_train_test_split():
-    create_training_shp.train_test_split(".", debug=True)
\ No newline at end of file
+    create_training_shp.train_test_split(".", debug=True)
+
+def test_CHM_heights():
+    np.random.seed(1)
+    CHM_path = "data/raw/NEON_D01_BART_DP3_320000_4881000_CHM_crop.tif"
+    points = [Point(x, y) for x, y in zip(np.random.uniform(320210, 320340, 50), np.random.uniform(4881500, 4881620, 50))]
+    polygons = [x.buffer(np.random.uniform(0.2, 5)) for x in points[:20]]
+    #A crown west of the tile has no canopy cells
+    geometries = points + polygons + [Point(320200, 4881550).buffer(2)]
+    
+    #Same heights as zonal statistics with the non zero quantile
+    heights = create_training_shp.CHM_heights(CHM_path, geometries)
+    draped_boxes = rasterstats.zonal_stats(gpd.GeoSeries(geometries).__geo_interface__, CHM_path, add_stats={'q99': create_training_shp.non_zero_99_quantile})
+    expected = np.array([x["q99"] for x in draped_boxes], dtype=float)
+    np.testing.assert_allclose(heights, expected, rtol=1e-6)
+    assert np.isnan(heights[-1])
+    
+def test_filter_CHM():
+    shp = gpd.GeoDataFrame({"plotID": np.repeat(["BART_001", "BART_002"], 10), "height": np.nan},
+                           geometry=[Point(x, y) for x, y in zip(np.random.uniform(320214, 320335, 20), np.random.uniform(4881504, 4881615, 20))])
+    shp.loc[0, "height"] = 12
+    filtered = create_training_shp.filter_CHM(shp, "data/raw/*_CHM_crop.tif")
+    assert filtered.shape[0] == 20
+    assert filtered.height[0] == 12
+    assert (filtered.height[1:].dropna() == filtered.CHM_height[1:].dropna()).all()
+    
+    #A process per tile gives the same heights
+    parallel = create_training_shp.filter_CHM(shp, "data/raw/*_CHM_crop.tif", workers=2)
+    np.testing.assert_array_equal(parallel.CHM_height, filtered.CHM_height)
+
+def test_SplitSearch():
+    plots = np.random.randint(0, 100, 2000)
+    shp = pd.DataFrame({"plotID": ["plot_{}".format(x) for x in plots], "siteID": ["site_{}".format(x % 5) for x in plots], "taxonID": ["taxon_{}".format(x) for x in np.random.randint(0, 30, 2000)]})
+    search = create_training_shp.SplitSearch(shp)
+    
+    #Each candidate keeps the same species as splitting the DataFrame
+    candidates = search.sample(10)
+    assert candidates.shape == (10, 100)
+    species = search.score(candidates)
+    for index, row in enumerate(candidates):
+        train, test = create_training_shp.split_plots(shp, search.plots[row.indices])
+        assert species[index] == len(train.taxonID.unique())
+    
+    most_species, test_plots = search.search(100, batch_size=30)
+    assert len(test_plots) == 10
+    train, test = create_training_shp.split_plots(shp, test_plots)
+    assert most_species == len(train.taxonID.unique())
+
+def test_validate_split():
+    train = pd.DataFrame({"taxonID": ["ACRU", "ACRU", "QURU", "PIST"], "siteID": ["BART", "HARV", "BART", "BART"]})
+    test = pd.DataFrame({"taxonID": ["ACRU", "ACRU", "QURU", "QURU", "PIST", "TSCA"], "siteID": ["BART", "OSBS", "HARV", "HARV", "BART", "BART"]}, index=[10, 11, 12, 13, 14, 15])
+    
+    missing = create_training_shp.missing_pairs(train, test)
+    np.testing.assert_array_equal(missing, [False, True, True, True, False, True])
+    
+    #QURU only has test samples at a site without train samples, so it is removed from both
+    train, test = create_training_shp.validate_split(train, test)
+    assert list(test.index) == [10, 14]
+    assert sorted(train.taxonID.unique()) == ["ACRU", "PIST"]
+    assert train.shape[0] == 4
+
+def test_load_field_data(tmpdir, monkeypatch):
+    field = pd.DataFrame({
+        "individualID": ["NEON.PLA.D01.BART.00001", "NEON.PLA.D01.BART.00001", "NEON.PLA.D01.BART.00002", "NEON.PLA.D01.BART.00003A", "NEON.PLA.D01.BART.00004", "NEON.PLA.D01.BART.00005"],
+        "eventID": ["vst_BART_2018", "vst_BART_2019", "vst_BART_2019", "vst_BART_2019", "vst_BART_2014", "vst_BART_2019"],
+        "domainID": "D01", "siteID": "BART", "plotID": "BART_001",
+        "taxonID": ["ACRU", "ACRU", "QURU", "ACRU", "ACRU", "2PLANT"], "scientificName": "Acer rubrum L.", "utmZone": "19N",
+        "itcEasting": 320000.0, "itcNorthing": 4881000.0, "elevation": 300.0, "height": [10, 12, np.nan, 10, 10, 10], "stemDiameter": 20.0,
+        "growthForm": "single bole tree", "plantStatus": ["Live", "Live, disease damaged", "Live", "Live", "Live", "Live"], "canopyPosition": "Full sun",
+        "unused": 1})
+    path = "{}/vst.csv".format(tmpdir)
+    field.to_csv(path, index=False)
+    
+    #Latest event of single bole trees
+    cleaned = create_training_shp.load_field_data(path)
+    assert list(cleaned.individualID) == ["NEON.PLA.D01.BART.00001", "NEON.PLA.D01.BART.00002"]
+    assert list(cleaned.height.fillna(0)) == [12, 0]
+    assert "unused" not in cleaned.columns
+    assert cleaned.taxonID.dtype == "category"
+    
+    #Cached as parquet until the csv changes
+    cache_dir = "{}/cache".format(tmpdir)
+    pd.testing.assert_frame_equal(create_training_shp.load_field_data(path, cache_dir=cache_dir), cleaned)
+    assert len(os.listdir(cache_dir)) == 1
+    pd.testing.assert_frame_equal(create_training_shp.load_field_data(path, cache_dir=cache_dir), cleaned)
+    os.utime(path, ns=(0, 0))
+    create_training_shp.load_field_data(path, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+    
+    #and until the filters change
+    monkeypatch.setattr(create_training_shp, "FIELD_DATA_VERSION", create_training_shp.FIELD_DATA_VERSION + 1)
+    create_training_shp.load_field_data(path, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 3
@@ -0,0 +1,25 @@
+#test cropping sensor data under boxes
+import pytest
+import geopandas as gpd
+import numpy as np
+import rasterio
+
+from DeepTreeAttention.generators import crops
+
+#random label predictions just for testing
+test_predictions = "data/raw/2019_BART_5_320000_4881000_image_small.shp"
+
+#Use a small rgb crop as a example tile
+test_sensor_tile = "data/raw/2019_BART_5_320000_4881000_image_crop.tif"
+
+@pytest.mark.parametrize("expand",[0, 0.5])
+def test_crop_images(expand):
+    #Batched reads return the same crops as reading one box at a time
+    shp = gpd.read_file(test_predictions)
+    src = rasterio.open(test_sensor_tile)
+    cropped, stats = crops.crop_images(src, shp, expand=expand)
+    
+    assert stats["crowns_served"] == shp.shape[0]
+    assert stats["reads"] <= shp.shape[0]
+    for index, row in shp.iterrows():
+        np.testing.assert_array_equal(cropped[index], crops.crop_image(src, row["geometry"], expand=expand))
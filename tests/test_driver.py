@@ -0,0 +1,54 @@
+#test generation driver
+import pytest
+
+from DeepTreeAttention.generators import driver
+from DeepTreeAttention.utils.config import parse_yaml
+
+@pytest.fixture()
+def context():
+    config = parse_yaml("conf/tree_config.yml")
+    #No sensor data on the test machine
+    config["rgb_sensor_pool"] = "data/raw/*.tif"
+    config["hyperspectral_sensor_pool"] = "data/raw/*.h5"
+    context = driver.create_context(
+        config,
+        species_classes_file="data/processed/species_class_labels.csv",
+        site_classes_file="data/processed/site_class_labels.csv",
+        domain_classes_file="data/processed/domain_class_labels.csv")
+
+    return context
+
+def test_create_context(context):
+    assert context["site_label_dict"]["BART"] == 1
+    assert context["domain_label_dict"]["D01"] == 0
+    assert len(context["rgb_pool"]) > 0
+
+def test_run(tmpdir, context, monkeypatch):
+    #A failing tile is reported in the summary without stopping the others
+    def generate_tile(record, context, label_column, chunk_size):
+        if record == "bad.csv":
+            raise ValueError("no sensor data")
+        return {"record": record, "tfrecords": ["{}.tfrecord".format(record)], "crowns": 10}
+
+    monkeypatch.setattr(driver, "generate_tile", generate_tile)
+    summary = driver.run(["a.csv", "bad.csv", "b.csv"], context, workers=1, summary_path="{}/summary.json".format(tmpdir))
+
+    assert summary["completed"] == 2
+    assert summary["crowns"] == 20
+    assert summary["tfrecords"] == ["a.csv.tfrecord", "b.csv.tfrecord"]
+    assert summary["failures"][0]["record"] == "bad.csv"
+    assert "no sensor data" in summary["failures"][0]["error"]
+
+def test_neighbor_plumbing(tmpdir, context):
+    #No ensemble model configured, no neighbor features
+    config = context["config"]
+    assert driver.ensemble_model(config) is None
+    assert driver.embedding_store(config, None) is None
+    assert driver.crop_cache_bytes(config) == config["neighbors"]["crop_cache_gb"] * 1e9
+    
+    #A configured store is keyed by the model weights
+    tfk = pytest.importorskip("tensorflow.keras")
+    model = tfk.Sequential([tfk.Input(shape=(2,)), tfk.layers.Dense(1)])
+    config["neighbors"]["embedding_store"] = "{}/embeddings.h5".format(tmpdir)
+    store = driver.embedding_store(config, model)
+    assert store.path == config["neighbors"]["embedding_store"]
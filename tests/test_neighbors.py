@@ -6,6 +6,7 @@ import pandas as pd
 import numpy as np
 import os
 import rasterio
+import types
 import tensorflow.keras as tfk
 import tensorflow as tf
 
@@ -13,6 +14,7 @@ from DeepTreeAttention.generators import neighbors
 from DeepTreeAttention.models.Hang2020_geographic import create_models, learned_ensemble
 from DeepTreeAttention.models.metadata import create as create_metadata
 from DeepTreeAttention.trees import AttentionModel
+from DeepTreeAttention.utils import cache
 
 
 ##Global variables
@@ -132,3 +134,109 @@ def test_predict_dataframe_with_padding(mod, df):
     
     assert len(results_dict[0][0]) == 5
     assert len(results_dict[0][1]) == 5
+
+def test_query_neighbors(data):
+    indices, distances = neighbors.query_neighbors(data, k_neighbors=3)
+    assert indices.shape == (data.shape[0], 3)
+    
+    #Same as a brute force search on the projected centroids, without self
+    coordinates = np.column_stack([data.geometry.centroid.x, data.geometry.centroid.y])
+    pairwise = np.sqrt(((coordinates[:, None, :] - coordinates[None, :, :]) ** 2).sum(axis=2))
+    np.fill_diagonal(pairwise, np.inf)
+    np.testing.assert_allclose(distances, np.sort(pairwise, axis=1)[:, :3])
+    assert not (indices == np.arange(data.shape[0])[:, None]).any()
+    
+    #Fewer crowns than neighbors are padded
+    indices, distances = neighbors.query_neighbors(data.head(3), k_neighbors=5)
+    assert (indices[:, 2:] == -1).all()
+    assert (distances[:, 2:] == 9999).all()
+    assert (indices[:, :2] >= 0).all()
+
+def test_crown_ids(data):
+    ids = neighbors.crown_ids(data, tile="2019_BART_5_320000_4881000_image")
+    assert len(set(ids)) == data.shape[0]
+    
+    #Same ids for the same crowns in another order, as in a regenerated file
+    shuffled = data.sample(frac=1, random_state=1)
+    assert neighbors.crown_ids(shuffled, tile="2019_BART_5_320000_4881000_image") == [ids[data.index.get_loc(x)] for x in shuffled.index]
+    
+    #Individual ids are used when present
+    assert neighbors.crown_ids(data.assign(individualID="NEON.PLA.D01.BART.00001"), tile="2019_BART_5_320000_4881000_image")[0] == "NEON.PLA.D01.BART.00001"
+
+def feature_model():
+    """A small model with the inputs of the ensemble feature extractor"""
+    image = tfk.Input(shape=(20, 20, 3))
+    elevation = tfk.Input(shape=(1,))
+    site = tfk.Input(shape=(2,))
+    domain = tfk.Input(shape=(2,))
+    pooled = tfk.layers.GlobalAveragePooling2D()(image)
+    features = tfk.layers.Concatenate()([pooled, elevation, site, domain])
+    
+    return tfk.Model([image, elevation, site, domain], tfk.layers.Dense(8)(features))
+
+def test_neighbor_features(data):
+    model = feature_model()
+    metadata = [0.1, tf.one_hot(1, 2), tf.one_hot(0, 2)]
+    raster = rasterio.open(test_sensor_tile)
+    extractor = neighbors.NeighborFeatures(data, raster=raster, metadata=metadata, model=model, k_neighbors=5, batch_size=4)
+    
+    #Every crown is embedded once, in batches
+    extractor.embed(extractor.indices.ravel())
+    assert len(extractor.embeddings) == data.shape[0]
+    assert extractor.model_calls == 3
+    
+    #Same features as cropping and predicting the neighbors of each crown one at a time
+    for position in range(data.shape[0]):
+        features, distances = extractor.features(position)
+        expected_features, expected_distances = neighbors.predict_neighbors(
+            data.iloc[position], HSI_size=20, neighbor_pool=data, metadata=metadata, raster=raster, model=model, k_neighbors=5,
+            neighbor_indices=extractor.indices[position], neighbor_distances=extractor.distances[position])
+        assert features.shape == (5, 8)
+        np.testing.assert_allclose(features, expected_features, rtol=1e-5)
+        assert distances == expected_distances
+    assert extractor.model_calls == 3
+
+def test_neighbor_features_store(data, tmpdir):
+    model = feature_model()
+    metadata = [0.1, tf.one_hot(1, 2), tf.one_hot(0, 2)]
+    raster = rasterio.open(test_sensor_tile)
+    store = cache.EmbeddingStore("{}/embeddings.h5".format(tmpdir), cache.model_hash(model, HSI_size=20))
+    ids = ["tile_{}".format(x) for x in data.index]
+    
+    first = neighbors.NeighborFeatures(data, raster=raster, metadata=metadata, model=model, store=store, ids=ids)
+    expected = first.features(0)
+    assert first.model_calls == 1
+    
+    #A second run with the same model is only a lookup
+    second = neighbors.NeighborFeatures(data, raster=raster, metadata=metadata, model=model, store=store, ids=ids)
+    features, distances = second.features(0)
+    assert second.model_calls == 0
+    np.testing.assert_allclose(features, expected[0])
+    assert distances == expected[1]
+    
+    #predict_neighbors reads the same store
+    neighbor_features, neighbor_distances = neighbors.predict_neighbors(
+        data.iloc[0], HSI_size=20, neighbor_pool=data.assign(individual=ids), metadata=metadata, raster=raster, model=model,
+        neighbor_indices=first.indices[0], neighbor_distances=first.distances[0], store=store)
+    np.testing.assert_allclose(neighbor_features, expected[0])
+
+def test_predict_dataframe_by_tile(df):
+    #Resampled rows of the same individual share features
+    df = pd.concat([df, df.head(2)], ignore_index=True)
+    model_class = types.SimpleNamespace(sites=2, domains=2, ensemble_model=feature_model())
+    results = neighbors.predict_dataframe(df, model_class=model_class, hyperspectral_pool=hyperspectral_pool, site_label_dict={"BART": 1}, domain_label_dict={"D17": 0}, k_neighbors=3)
+    assert len(results) == df.shape[0]
+    np.testing.assert_array_equal(results[0][0], results[df.index[-2]][0])
+    
+    #Same as predicting each individual against the other individuals of the tile
+    individuals = df.drop_duplicates(subset="individual").reset_index(drop=True)
+    metadata = [0.1, tf.one_hot(1, 2), tf.one_hot(0, 2)]
+    raster = rasterio.open(hyperspectral_pool[0])
+    for position in range(individuals.shape[0]):
+        neighbor_pool = individuals[~(individuals.individual == individuals.individual[position])]
+        features, distances = neighbors.predict_neighbors(individuals.iloc[position], HSI_size=20, neighbor_pool=neighbor_pool, metadata=metadata, raster=raster, model=model_class.ensemble_model, k_neighbors=3)
+        np.testing.assert_allclose(results[position][0], features, rtol=1e-5)
+        np.testing.assert_allclose(results[position][1], distances)
+    
+    with pytest.raises(ValueError):
+        neighbors.predict_dataframe(df, model_class=model_class, hyperspectral_pool=hyperspectral_pool, site_label_dict={"BART": 1}, domain_label_dict={"D17": 0}, workers=2)
@@ -0,0 +1,39 @@
+#test sensor path lookups
+import pickle
+import pytest
+
+from DeepTreeAttention.utils import paths
+
+pool = [
+    "/orange/ewhite/NeonData/BART/DP3.30010.001/2018/FullSite/D01/2018_BART_4/L3/Camera/Mosaic/V01/2018_BART_4_320000_4881000_image.tif",
+    "/orange/ewhite/NeonData/BART/DP3.30010.001/2019/FullSite/D01/2019_BART_5/L3/Camera/Mosaic/V01/2019_BART_5_320000_4881000_image.tif",
+    "/orange/ewhite/NeonData/BART/DP3.30010.001/2019/FullSite/D01/2019_BART_5/L3/Camera/Mosaic/V01/2019_BART_5_321000_4881000_image.tif",
+    "/orange/ewhite/NeonData/BART/DP3.30006.001/2019/FullSite/D01/2019_BART_5/L3/Spectrometer/Reflectance/NEON_D01_BART_DP3_320000_4881000_reflectance.h5",
+    "/orange/ewhite/NeonData/BART/DP3.30010.001/2019/FullSite/D01/2019_BART_5/L3/Camera/Mosaic/V01/readme.txt"]
+
+def test_sensor_index():
+    index = paths.SensorIndex(pool)
+    assert len(index) == 4
+    
+    metadata = index.metadata[pool[3]]
+    assert metadata == {"geoindex": "320000_4881000", "year": 2019, "site": "BART", "product": "DP3.30006.001"}
+    
+    rgb_index = paths.SensorIndex([x for x in pool if x.endswith(".tif")])
+    assert rgb_index.lookup("320000_4881000") == pool[1]
+    assert rgb_index.lookup("320000_4881000", year=2018) == pool[0]
+    
+    with pytest.raises(ValueError):
+        rgb_index.lookup("320000_4881000", year=2017)
+    
+    #Workers receive a copy of the index
+    assert pickle.loads(pickle.dumps(rgb_index)).lookup("321000_4881000") == pool[2]
+
+def test_find_sensor_path():
+    #An index gives the same answer as scanning a list
+    rgb_pool = [x for x in pool if x.endswith(".tif")]
+    rgb_index = paths.SensorIndex(rgb_pool)
+    bounds = [320100, 4881100, 320200, 4881200]
+    assert paths.find_sensor_path(lookup_pool=rgb_index, bounds=bounds) == paths.find_sensor_path(lookup_pool=rgb_pool, bounds=bounds)
+    
+    shapefile = "2019_BART_5_321000_4881000_image.shp"
+    assert paths.find_sensor_path(lookup_pool=rgb_index, shapefile=shapefile) == pool[2]
@@ -0,0 +1,32 @@
+#Test batched preprocessing of sensor crops
+import math
+import numpy as np
+import pytest
+
+from DeepTreeAttention.generators import preprocess
+
+@pytest.fixture()
+def crops():
+    crops = [np.random.randint(0, 5000, size=(np.random.randint(3, 40), np.random.randint(3, 40), 10)).astype(np.int16) for x in range(20)]
+    
+    return crops
+
+def test_resize_batch(crops):
+    images = preprocess.resize_batch(crops, 20, 20)
+    assert images.shape == (20, 20, 20, 10)
+    assert images.dtype == np.float32
+    
+    for index, crop in enumerate(crops):
+        np.testing.assert_array_equal(images[index], preprocess.resize(crop, 20, 20))
+
+def test_normalize_batch(crops):
+    images = preprocess.resize_batch(crops, 20, 20)
+    expected = [preprocess.image_normalize(x) for x in images]
+    
+    preprocess.normalize_batch(images)
+    np.testing.assert_allclose(images, np.stack(expected), atol=1e-4)
+    
+def test_normalize_constant_image():
+    images = np.full((1, 5, 5, 3), 7, dtype=np.float32)
+    preprocess.normalize_batch(images)
+    assert np.all(images == 0)
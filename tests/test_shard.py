@@ -0,0 +1,50 @@
+#test re-sharding tfrecords
+import os
+import numpy as np
+import tensorflow as tf
+
+from DeepTreeAttention.generators import boxes, shard
+
+def write_records(filename, indices, site):
+    n = len(indices)
+    boxes.write_tfrecord(
+        filename=filename,
+        HSI_images=np.random.normal(size=(n,20,20,369)).astype(np.float32),
+        RGB_images=np.random.normal(size=(n,100,100,3)).astype(np.float32),
+        domains=[1]*n,
+        sites=[site]*n,
+        elevations=[100.0]*n,
+        heights=[10.0]*n,
+        indices=indices,
+        labels=[x % 3 for x in indices],
+        number_of_domains=10,
+        number_of_sites=10,
+        classes=3)
+
+    return filename
+
+def test_shard_records(tmpdir):
+    os.mkdir("{}/records".format(tmpdir))
+    tfrecords = [
+        write_records("{}/records/a.tfrecord".format(tmpdir), indices=np.arange(0, 7), site=1),
+        write_records("{}/records/b.tfrecord".format(tmpdir), indices=np.arange(7, 10), site=2),
+        write_records("{}/records/c.tfrecord".format(tmpdir), indices=np.arange(10, 15), site=3)]
+
+    #A small memory limit forces several buckets
+    savedir = "{}/shards".format(tmpdir)
+    shards = shard.shard_records(tfrecords, savedir=savedir, n_shards=4, memory_limit=2e6, seed=1)
+    assert len(shards) == 4
+
+    manifest = shard.read_manifest(savedir)
+    assert manifest["n_records"] == 15
+    sizes = [x["records"] for x in manifest["shards"]]
+    assert sum(sizes) == 15
+    assert max(sizes) - min(sizes) <= 1
+    assert sum([x["sites"].get("2", 0) for x in manifest["shards"]]) == 3
+    assert sum([x["classes"].get("0", 0) for x in manifest["shards"]]) == 5
+
+    #Every record is written once and the shards are readable from the copied schema
+    assert boxes.read_schema(savedir) == boxes.read_schema("{}/records".format(tmpdir))
+    dataset = boxes.tf_dataset(shards, mode="metadata", batch_size=15, shuffle=False, ids=True)
+    for ids, batch in dataset:
+        assert sorted(ids.numpy()) == list(range(15))